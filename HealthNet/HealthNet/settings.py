@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/1.6/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+import tempfile
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 
 
@@ -43,12 +44,16 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'health.middleware.InstrumentationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'health.middleware.UserContextMiddleware',
+    'health.middleware.AuditLogMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'health.middleware.ProfilingMiddleware',
 )
 
 ROOT_URLCONF = 'HealthNet.urls'
@@ -63,6 +68,15 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # Test against a file rather than SQLite's shared in-memory
+        # database, whose table locks make concurrent connections fail
+        # instead of waiting for each other like they do in production.
+        # The file is named after the process so concurrent test runs on
+        # one machine don't delete each other's database.
+        'TEST': {
+            'NAME': os.path.join(tempfile.gettempdir(),
+                                 'healthnet_test_%d.sqlite3' % os.getpid()),
+        },
     }
 }
 
@@ -86,3 +100,71 @@ LOGIN_URL = '/login/'
 STATIC_URL = '/static/'
 
 SESSION_COOKIE_SECURE = not DEBUG
+
+# Log the query count, SQL time, and view and template time of every
+# request, and show per-view response time percentiles on the System page.
+INSTRUMENT_REQUESTS = False
+
+# Also log the SQL of each instrumented request's slowest queries. The SQL
+# has placeholders instead of parameter values, but still shows which
+# tables and columns were read.
+INSTRUMENT_LOG_SQL = False
+
+# Profiles of sampled requests are dumped here, keeping the newest
+# PROFILE_KEEP for each view. The sample rate is set on the System page.
+PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+PROFILE_KEEP = 20
+
+# Each server process holds at most this many event streams open, each
+# using a thread, and sends a heartbeat on idle streams this often.
+# Events are published by an in-process broker, so a stream only hears
+# about messages sent through the same process. With several worker
+# processes, open conversations see messages sent through the others when
+# they next poll, which they keep doing every
+# views.CONVERSATION_STREAM_POLL_INTERVAL seconds while the stream is open.
+EVENT_STREAM_MAX_CONNECTIONS = 100
+EVENT_STREAM_HEARTBEAT = 15
+
+# The activity log is written as lines of JSON to this file, which is
+# rotated once it reaches 10MB. Query it with `manage.py activitylog`.
+ACTIVITY_LOG_FILE = os.path.join(BASE_DIR, 'activity.log')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'activity': {
+            'format': '%(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+        'activity_file': {
+            'class': 'health.activitylog.ActivityFileHandler',
+            'maxBytes': 10 * 1024 * 1024,
+            'backupCount': 10,
+            'formatter': 'activity',
+        },
+        # Buffers up to 100 events, or a second's worth, before writing.
+        'activity': {
+            'class': 'health.activitylog.TimedMemoryHandler',
+            'capacity': 100,
+            'interval': 1.0,
+            'target': 'activity_file',
+        },
+    },
+    'loggers': {
+        'health.instrumentation': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'health.activity': {
+            'handlers': ['activity'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
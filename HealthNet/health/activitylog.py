@@ -1,208 +1,284 @@
-__author__ = 'kodigray'
 """
+Receivers that record what users do in HealthNet as an append-only
+activity log. Every event is written to the 'health.activity' logger as a
+single line of JSON. settings.LOGGING buffers those lines in memory and
+writes them in batches to a size-rotated file, so recording an event
+never waits on the disk.
+"""
+__author__ = 'kodigray'
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in, user_logged_out
 from django.dispatch import receiver
-from django.db.models import signals
-from eventlog.models import log
+from django.utils import dateparse, timezone
+from logging.handlers import MemoryHandler, RotatingFileHandler
+from . import signals
+import json
+import logging
+import os
+import threading
 
+logger = logging.getLogger('health.activity')
 
-@receiver(signals.user_logged_in)
-def handle_user_logged_in(sender, **kwargs):
-    log(
-        user = kwargs.get("user"),
-        action = "User Logged In",
-        extra = {}
-    )
 
+class ActivityFileHandler(RotatingFileHandler):
+    """
+    A RotatingFileHandler that writes to settings.ACTIVITY_LOG_FILE as it
+    is when each record is written, so overriding the setting, as the
+    tests do, moves the log without reconfiguring logging.
+    """
 
-@receiver(signals.password_changed)
-def handle_password_changed(sender, **kwargs):
-    log(
-        user = kwargs.get("user"),
-        action = "password changed",
-        extra = {}
-    )
+    def __init__(self, **kwargs):
+        kwargs['delay'] = True
+        super(ActivityFileHandler, self).__init__(settings.ACTIVITY_LOG_FILE,
+                                                  **kwargs)
+
+    def emit(self, record):
+        path = os.path.abspath(settings.ACTIVITY_LOG_FILE)
+        if path != self.baseFilename:
+            self.acquire()
+            try:
+                if self.stream:
+                    self.stream.close()
+                    self.stream = None
+                self.baseFilename = path
+            finally:
+                self.release()
+        super(ActivityFileHandler, self).emit(record)
+
+
+class TimedMemoryHandler(MemoryHandler):
+    """
+    A MemoryHandler that also flushes once its oldest buffered record is
+    `interval` seconds old. Besides checking as records arrive, a
+    background thread flushes the buffer every `interval` seconds, so a
+    quiet process doesn't hold events until the next one is logged.
+    """
+
+    def __init__(self, capacity, interval=1.0, **kwargs):
+        super(TimedMemoryHandler, self).__init__(capacity, **kwargs)
+        self.interval = interval
+        self._pid = None
+        self._closed = threading.Event()
+
+    def shouldFlush(self, record):
+        return (super(TimedMemoryHandler, self).shouldFlush(record) or
+                record.created - self.buffer[0].created >= self.interval)
+
+    def emit(self, record):
+        self._start_timer()
+        super(TimedMemoryHandler, self).emit(record)
+
+    def _start_timer(self):
+        """
+        Starts the flushing thread with the first record a process logs,
+        including in processes forked after the parent started its own.
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        thread = threading.Thread(target=self._run, name='activity-log-flush')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            self.flush()
+
+    def close(self):
+        self._closed.set()
+        super(TimedMemoryHandler, self).close()
+
+
+def log(event, user, action, extra):
+    """
+    Writes one event to the activity log.
+    :param event: The name of the signal that was sent.
+    :param user: The user who acted, if they were logged in.
+    :param action: A readable description of the event.
+    :param extra: A dictionary of details about the event.
+    """
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    logger.info(json.dumps({
+        'time': timezone.now().isoformat(),
+        'event': event,
+        'user_id': user.pk if user else None,
+        'action': action,
+        'extra': extra
+    }, sort_keys=True))
+
+
+def log_files(path=None):
+    """
+    :return: The paths of the activity log and its rotated backups that
+             exist, oldest first.
+    """
+    path = path or settings.ACTIVITY_LOG_FILE
+    backups = []
+    index = 1
+    while os.path.exists('%s.%d' % (path, index)):
+        backups.append('%s.%d' % (path, index))
+        index += 1
+    paths = list(reversed(backups))
+    if os.path.exists(path):
+        paths.append(path)
+    return paths
+
+
+def matches(event, events=None, since=None, until=None, user_id=None):
+    """
+    :return: Whether a decoded event passes all of the provided filters.
+    """
+    if events and event['event'] not in events:
+        return False
+    if user_id is not None and event['user_id'] != user_id:
+        return False
+    if since or until:
+        time = dateparse.parse_datetime(event['time'])
+        if since and time < since:
+            return False
+        if until and time > until:
+            return False
+    return True
+
+
+def read_events(path=None, **filters):
+    """
+    Yields the decoded events in the activity log, oldest first, that pass
+    the filters accepted by `matches`.
+    """
+    for name in log_files(path):
+        with open(name) as f:
+            for line in f:
+                event = json.loads(line)
+                if matches(event, **filters):
+                    yield event
+
+
+@receiver(user_logged_in)
+def handle_user_logged_in(sender, request, user, **kwargs):
+    log('user_logged_in', user, "User Logged In", {})
+
+
+@receiver(user_logged_out)
+def handle_user_logged_out(sender, request, user, **kwargs):
+    log('user_logged_out', user, "User Logged Out", {})
 
 
 @receiver(signals.user_login_attempt)
 def handle_user_login_attempt(sender, **kwargs):
-    log(
-        user = None,
-        action = "login attempted",
-        extra = {
-            "username": kwargs.get("username"),
-            "result": kwargs.get("result")
-        }
-    )
+    log('user_login_attempt', None, "login attempted", {
+        "username": kwargs.get("username"),
+        "result": kwargs.get("result")
+    })
 
 
 @receiver(signals.user_sign_up_attempt)
 def handle_user_sign_up_attempt(sender, **kwargs):
-    log(
-        user = None,
-        action = "signup attempted",
-        extra = {
-            "username": kwargs.get("username"),
-            "email": kwargs.get("email"),
-            "result": kwargs.get("result")
-        }
-    )
+    log('user_sign_up_attempt', None, "signup attempted", {
+        "username": kwargs.get("username"),
+        "email": kwargs.get("email"),
+        "result": kwargs.get("result")
+    })
+
+
+@receiver(signals.user_signed_up)
+def handle_user_signed_up(sender, **kwargs):
+    log('user_signed_up', kwargs.get("user"), "user signed up", {
+        "ID": kwargs.get("id"),
+        "email": kwargs.get("email")
+    })
+
 
 @receiver(signals.user_edit_profile)
 def handle_user_edit_profile(sender, **kwargs):
-    log(
-        user = kwargs.get("user"),
-        action = "user edited profile",
-        extra = {
-            "ID": kwargs.get("id")
-        }
-    )
+    log('user_edit_profile', kwargs.get("user"), "user edited profile", {
+        "ID": kwargs.get("id")
+    })
 
 
-@receiver(signals.user_signed_up)
-def handle_user_signed_up(sender, **kwargs):
-    log(
-        user = kwargs.get("user"),
-        action = "user signed up",
-        extra = {
-            "ID": kwargs.get("id"),
-            "email": kwargs.get("email")
-        }
-    )
+@receiver(signals.edits_patient_profile)
+def handle_edits_patient_profile(sender, **kwargs):
+    log('edits_patient_profile', kwargs.get("user"),
+        "edited patients profile", {"ID": kwargs.get("id")})
 
 
-@receiver(signals.doc_deleted_prescription)
-def handle_doc_deleted_prescription(sender, **kwargs):
-    log(
-        user = kwargs.get("user"),
-        action = "deleted a prescription",
-        extra = {
-            "ID": kwargs.get("id")
-        }
-    )
+@receiver(signals.exports_patient_information)
+def handle_exports_patient_information(sender, **kwargs):
+    log('exports_patient_information', kwargs.get("user"),
+        "exported information of a patient", {"ID": kwargs.get("id")})
+
+
+@receiver(signals.doc_adds_prescription)
+def handle_doc_adds_prescription(sender, **kwargs):
+    log('doc_adds_prescription', kwargs.get("user"),
+        "added a prescription", {"ID": kwargs.get("id")})
 
 
 @receiver(signals.doc_edits_prescription)
 def handle_doc_edits_prescription(sender, **kwargs):
-    log(
-        user = kwargs.get("user"),
-        action = "edited a prescription",
-        extra = {
-            "ID": kwargs.get("id")
-        }
-    )
+    log('doc_edits_prescription', kwargs.get("user"),
+        "edited a prescription", {"ID": kwargs.get("id")})
 
-@receiver(signals.doc_adds_prescription)
-def handle_doc_adds_prescription(sender, **kwargs):
-    log(
-        user = kwargs.get("user"),
-        action = "added a prescription",
-        extra = {
-            "ID": kwargs.get("id")
-        }
-    )
+
+@receiver(signals.doc_deleted_prescription)
+def handle_doc_deleted_prescription(sender, **kwargs):
+    log('doc_deleted_prescription', kwargs.get("user"),
+        "deleted a prescription", {"ID": kwargs.get("id")})
 
 
 @receiver(signals.add_appointment)
 def handle_add_appointment(sender, **kwargs):
-    log(
-        user = kwargs.get("user"),
-        action = "added an appointment",
-        extra = {
-            "ID": kwargs.get("id")
-        }
-    )
+    log('add_appointment', kwargs.get("user"),
+        "added an appointment", {"ID": kwargs.get("id")})
+
 
 @receiver(signals.edits_appointment)
 def handle_edits_appointment(sender, **kwargs):
-    log(
-        user = kwargs.get("user"),
-        action = "edited an appointment",
-        extra = {
-            "ID": kwargs.get("id")
-        }
-    )
+    log('edits_appointment', kwargs.get("user"),
+        "edited an appointment", {"ID": kwargs.get("id")})
 
 
 @receiver(signals.deleted_appointment)
 def handle_deleted_appointment(sender, **kwargs):
-    log(
-        user = kwargs.get("user"),
-        action = "deleted an appointment",
-        extra = {
-            "ID": kwargs.get("id")
-        }
-    )
+    log('deleted_appointment', kwargs.get("user"),
+        "deleted an appointment", {"ID": kwargs.get("id")})
 
-@receiver(signals.edits_patient_profile)
-def handle_edits_patient_profile(sender, **kwargs):
-    log(
-        user = kwargs.get("user"),
-        action = "edited patients profile",
-        extra = {
-            "ID": kwargs.get("id")
-        }
-    )
 
+@receiver(signals.password_changed)
+def handle_password_changed(sender, **kwargs):
+    log('password_changed', kwargs.get("user"), "password changed", {})
+
+
+@receiver(signals.doc_discharges_patient)
+def handle_doc_discharges_patient(sender, **kwargs):
+    log('doc_discharges_patient', kwargs.get("user"),
+        "patient was discharged by doctor", {"ID": kwargs.get("id")})
 
-@receiver(signals.exports_patient_information)
-def handle_exports_patient_information(sender, **kwargs):
-    log(
-        user = kwargs.get("user"),
-        action = "exported information of a patient",
-        extra = {
-            "ID": kwargs.get("id")
-        }
-    )
 
 @receiver(signals.doc_releases_test_results)
 def handle_doc_releases_test_results(sender, **kwargs):
-    log(
-        user = kwargs.get("user"),
-        action = "released test results of patient",
-        extra = {
-            "ID": kwargs.get("id")
-        }
-    )
-
+    log('doc_releases_test_results', kwargs.get("user"),
+        "released test results of patient", {"ID": kwargs.get("id")})
 
-@receiver(signals.hospital_transferred_patient)
-def handle_hospital_transferred_patient(sender, **kwargs):
-    log(
-        user = kwargs.get("user"),
-        action = "patient was transferred from hospital",
-        extra = {
-            "ID": kwargs.get("id")
-        }
-    )
 
 @receiver(signals.extended_stay_for_patient)
 def handle_extended_stay_for_patient(sender, **kwargs):
-    log(
-        user = kwargs.get("user"),
-        action = "Patient was put on extended stay by doctor",
-        extra = {
-            "ID": kwargs.get("id")
-        }
-    )
+    log('extended_stay_for_patient', kwargs.get("user"),
+        "Patient was put on extended stay by doctor", {"ID": kwargs.get("id")})
 
 
-@receiver(signals.doc_discharges_patient)
-def handle_doc_discharges_patient(sender, **kwargs):
-    log(
-        user = kwargs.get("user"),
-        action = "patient was discharged by doctor",
-        extra = {
-            "ID": kwargs.get("id")
-        }
-    )
-
 @receiver(signals.doc_uploads_update)
 def handle_doc_uploads_update(sender, **kwargs):
-    log(
-        user = kwargs.get("user"),
-        action = "doctor uploaded an update to patient profile",
-        extra = {
-            "ID": kwargs.get("id")
-        }
-    )
-"""
\ No newline at end of file
+    log('doc_uploads_update', kwargs.get("user"),
+        "doctor uploaded an update to patient profile",
+        {"ID": kwargs.get("id")})
+
+
+@receiver(signals.hospital_transferred_patient)
+def handle_hospital_transferred_patient(sender, **kwargs):
+    log('hospital_transferred_patient', kwargs.get("user"),
+        "patient was transferred from hospital", {
+            "ID": kwargs.get("id"),
+            "hospital": kwargs.get("hospital")
+        })
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class HealthConfig(AppConfig):
+    name = 'health'
+    verbose_name = 'HealthNet'
+
+    def ready(self):
+        # Connect the signal receivers that live outside of models.py.
+        from . import activitylog, auditlog, search
@@ -0,0 +1,165 @@
+"""
+Queries over the audit log that form_utilities writes to Django's
+LogEntry table. Entries are always read newest first and paged with a
+keyset cursor on (action_time, id), so reading any page costs the same no
+matter how many entries came before it.
+"""
+from django.contrib.admin.models import LogEntry
+from django.db import connections
+from django.db.models import Q
+from django.db.models.signals import post_migrate
+from django.dispatch import receiver
+from django.utils import timezone
+from .form_utilities import parse_local_datetime
+import csv
+import datetime
+
+# The number of entries shown on each page of the System page.
+PAGE_SIZE = 50
+
+# The number of entries fetched at a time while streaming a CSV export.
+EXPORT_BATCH_SIZE = 1000
+
+CURSOR_TIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+# Indexes on django_admin_log backing the filters below. LogEntry belongs
+# to django.contrib.admin, so they're created after migrating instead of
+# being declared on the model.
+INDEXES = {
+    'health_admin_log_time': ('action_time', 'id'),
+    'health_admin_log_user_time': ('user_id', 'action_time', 'id'),
+    'health_admin_log_object_time': ('content_type_id', 'object_id',
+                                     'action_time', 'id'),
+}
+
+
+@receiver(post_migrate)
+def create_indexes(sender, using='default', **kwargs):
+    """
+    Creates any of the audit log indexes that don't exist yet.
+    """
+    connection = connections[using]
+    if sender.name != 'health' or connection.vendor not in ('sqlite',
+                                                            'postgresql'):
+        return
+    with connection.cursor() as cursor:
+        existing = connection.introspection.get_constraints(
+            cursor, LogEntry._meta.db_table)
+        for name, columns in INDEXES.items():
+            if name not in existing:
+                cursor.execute('CREATE INDEX %s ON %s (%s)' % (
+                    name, LogEntry._meta.db_table, ', '.join(columns)))
+
+
+def filtered_entries(params):
+    """
+    Filters the audit log by the provided query parameters. Values that
+    can't be parsed are ignored.
+    Accepts:
+        user: The id of the user who made the change.
+        content_type: The id of the changed object's content type.
+        object_id: The id of the changed object.
+        since: The earliest time, in the site's timezone.
+        until: The latest time, in the site's timezone.
+    :param params: A dictionary-like object, such as request.GET.
+    :return: A LogEntry queryset, newest first.
+    """
+    entries = LogEntry.objects.select_related('user', 'content_type')
+    user = params.get('user', '')
+    if user.isdigit():
+        entries = entries.filter(user_id=int(user))
+    content_type = params.get('content_type', '')
+    if content_type.isdigit():
+        entries = entries.filter(content_type_id=int(content_type))
+    object_id = params.get('object_id')
+    if object_id:
+        entries = entries.filter(object_id=object_id)
+    since = parse_local_datetime(params.get('since'))
+    if since:
+        entries = entries.filter(action_time__gte=since)
+    until = parse_local_datetime(params.get('until'))
+    if until:
+        entries = entries.filter(action_time__lte=until)
+    return entries.order_by('-action_time', '-id')
+
+
+def cursor_for(entry):
+    """
+    :return: An opaque string identifying the position just after the
+             provided entry.
+    """
+    action_time = entry.action_time.astimezone(timezone.utc)
+    return '%s-%d' % (action_time.strftime(CURSOR_TIME_FORMAT), entry.pk)
+
+
+def entries_before(entries, cursor):
+    """
+    Restricts entries to the ones after a cursor from cursor_for.
+    Invalid cursors are ignored.
+    """
+    try:
+        stamp, pk = cursor.split('-')
+        action_time = datetime.datetime.strptime(stamp, CURSOR_TIME_FORMAT)\
+                                       .replace(tzinfo=timezone.utc)
+        pk = int(pk)
+    except (AttributeError, ValueError):
+        return entries
+    return entries.filter(Q(action_time__lt=action_time) |
+                          Q(action_time=action_time, pk__lt=pk))
+
+
+def page(entries, cursor=None, count=PAGE_SIZE):
+    """
+    Fetches one page of entries.
+    :param entries: A queryset from filtered_entries.
+    :param cursor: The cursor returned with the previous page, if any.
+    :return: A tuple containing the page's entries and the cursor of the
+             next page, or None if this is the last page.
+    """
+    if cursor:
+        entries = entries_before(entries, cursor)
+    entries = list(entries[:count + 1])
+    next_cursor = cursor_for(entries[count - 1]) \
+        if len(entries) > count else None
+    return entries[:count], next_cursor
+
+
+def iterate(entries, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields every entry, fetching them a batch at a time so only one batch
+    is ever held in memory.
+    """
+    cursor = None
+    while True:
+        batch, cursor = page(entries, cursor, count=batch_size)
+        for entry in batch:
+            yield entry
+        if cursor is None:
+            return
+
+
+class Echo(object):
+    """
+    A file-like object that hands back whatever is written to it, so
+    csv.writer can format one row at a time.
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_rows(entries):
+    """
+    Yields the entries as lines of CSV, starting with a header.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(['id', 'time', 'user_id', 'user', 'content_type',
+                           'object_id', 'object', 'action', 'message'])
+    for entry in iterate(entries):
+        yield writer.writerow([
+            entry.pk, entry.action_time.isoformat(), entry.user_id,
+            entry.user.email,
+            entry.content_type.model if entry.content_type else '',
+            entry.object_id, entry.object_repr, entry.action_flag,
+            entry.change_message
+        ])
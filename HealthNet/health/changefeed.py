@@ -0,0 +1,113 @@
+"""
+A change feed over the audit log that form_utilities writes, for systems
+that keep their own copy of HealthNet's records. Changes are read in
+LogEntry id order after a cursor (the id of the last change a consumer
+has seen), so resuming only scans the primary key index from that point.
+"""
+from django.conf import settings
+from django.contrib.admin.models import LogEntry, ADDITION, CHANGE, DELETION
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Min
+from django.utils import timezone
+from .models import User, Appointment, Prescription, HospitalStay
+import datetime
+
+# The most changes returned at a time. Keeps the id lists loaded for
+# each model under SQLite's parameter limit.
+MAX_LIMIT = 500
+
+ACTIONS = {
+    ADDITION: 'addition',
+    CHANGE: 'change',
+    DELETION: 'deletion',
+}
+
+# The models in the feed, and how to load the current state of a batch of
+# changed objects.
+MODELS = (
+    (User, lambda: User.with_export_data(User.objects)),
+    (Appointment, lambda: Appointment.objects.select_related('patient',
+                                                             'doctor')),
+    (Prescription, lambda: Prescription.objects.all()),
+    (HospitalStay, lambda: HospitalStay.objects.select_related('hospital')),
+)
+
+
+def settle_delay():
+    """
+    Entries are saved in batches by several processes, so a batch with
+    lower ids can be committed just after one with higher ids, and ids
+    don't follow action times exactly. The feed stops at the first entry
+    newer than this delay, holding it and every later id back, so
+    consumers never skip one.
+    """
+    return datetime.timedelta(
+        seconds=getattr(settings, 'CHANGE_FEED_DELAY', 5))
+
+
+def content_types():
+    """
+    :return: A dictionary of the feed's models, keyed by content type id.
+    """
+    return dict((ContentType.objects.get_for_model(model).pk, (model, loader))
+                for model, loader in MODELS)
+
+
+def serialize(obj):
+    data = obj.json_object()
+    data['id'] = obj.pk
+    if hasattr(obj, 'patient_id'):
+        data['patient_id'] = obj.patient_id
+    return data
+
+
+def changes(after=0, limit=MAX_LIMIT):
+    """
+    Reads the changes to the feed's models after a cursor.
+    :param after: The id of the last change already read.
+    :param limit: The most changes to return.
+    :return: A tuple containing the list of changes, oldest first, and the
+             cursor to read the next changes from.
+    """
+    types = content_types()
+    entries = LogEntry.objects.filter(pk__gt=after, content_type_id__in=types)
+    # Only read up to the first unsettled entry. Skipping over it would
+    # move the cursor past it for good. This reads the recent end of the
+    # action time index.
+    unsettled = LogEntry.objects.filter(
+        pk__gt=after, action_time__gt=timezone.now() - settle_delay())\
+        .aggregate(first=Min('pk'))['first']
+    if unsettled is not None:
+        entries = entries.filter(pk__lt=unsettled)
+    entries = list(entries.order_by('pk')[:limit])
+
+    # Load the current state of every changed object that still exists,
+    # once per model.
+    ids = {}
+    for entry in entries:
+        if entry.action_flag != DELETION and entry.object_id.isdigit():
+            ids.setdefault(entry.content_type_id, set()).add(
+                int(entry.object_id))
+    objects = {}
+    for content_type_id, pks in ids.items():
+        model, loader = types[content_type_id]
+        objects[content_type_id] = loader().in_bulk(list(pks))
+
+    results = []
+    for entry in entries:
+        model, loader = types[entry.content_type_id]
+        obj = None
+        if entry.object_id.isdigit():
+            obj = objects.get(entry.content_type_id, {})\
+                         .get(int(entry.object_id))
+        results.append({
+            'id': entry.pk,
+            'time': entry.action_time.isoformat(),
+            'model': model._meta.model_name,
+            'object_id': entry.object_id,
+            'action': ACTIONS.get(entry.action_flag),
+            'user_id': entry.user_id,
+            'object': serialize(obj) if obj else None,
+        })
+    cursor = entries[-1].pk if entries else after
+    return results, cursor
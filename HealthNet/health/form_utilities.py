@@ -1,11 +1,17 @@
 __author__ = 'harlanhaskins'
+import logging
 import re
+import threading
 from django.core import validators
 from django.core.exceptions import ValidationError
 from django.contrib.admin import models
 from django.contrib.contenttypes.models import ContentType
+from django.utils import dateparse, timezone
+from django.utils.encoding import smart_text
 from django.utils.text import get_text_list
 
+logger = logging.getLogger(__name__)
+
 
 def sanitize_phone(number):
     """
@@ -42,6 +48,21 @@ def email_is_valid(email):
         return False
 
 
+def parse_local_datetime(date_string):
+    """
+    Parses a date and time entered in the site's timezone.
+    :param date_string: An ISO 8601 date and time, without a UTC offset.
+    :return: An aware datetime, or None if the string is invalid.
+    """
+    try:
+        parsed = dateparse.parse_datetime(date_string)
+        if not parsed:
+            return None
+        return timezone.make_aware(parsed, timezone.get_current_timezone())
+    except:
+        return None
+
+
 def get_change_message(fields):
     """
     Create a change message for *fields* (a sequence of field names).
@@ -49,17 +70,87 @@ def get_change_message(fields):
     return 'Changed %s.' % get_text_list(fields, 'and')
 
 
-def addition(request, obj):
+class AuditLogWriter(object):
     """
-    Log that an object has been successfully added.
+    Collects the audit log entries made while handling a request and saves
+    them with a single bulk_create when it finishes (see
+    AuditLogMiddleware), instead of one INSERT each. Each thread has its
+    own buffer, so a request only ever saves its own entries. Entries
+    made outside a request are saved right away.
+    If saving a request's entries fails, they're kept and retried with
+    the next request that finishes in this process. They're lost if the
+    process exits first.
     """
-    models.LogEntry.objects.log_action(
+
+    def __init__(self):
+        self._local = threading.local()
+        self._failed = []
+        self._lock = threading.Lock()
+
+    def begin(self):
+        """
+        Starts buffering this thread's entries until the next flush.
+        """
+        self._local.entries = []
+
+    def enqueue(self, entry):
+        entries = getattr(self._local, 'entries', None)
+        if entries is None:
+            models.LogEntry.objects.bulk_create([entry])
+        else:
+            entries.append(entry)
+
+    def pending(self):
+        """
+        :return: The number of entries waiting to be saved, counting this
+                 thread's buffer and the entries that failed to save.
+        """
+        with self._lock:
+            failed = len(self._failed)
+        return len(getattr(self._local, 'entries', None) or []) + failed
+
+    def flush(self):
+        """
+        Saves this thread's entries, and any that earlier flushes failed
+        to save, in one transaction, and stops buffering. If that fails,
+        the entries are kept for the next flush and the error is raised.
+        """
+        entries = getattr(self._local, 'entries', None) or []
+        self._local.entries = None
+        with self._lock:
+            entries, self._failed = self._failed + entries, []
+        if not entries:
+            return
+        try:
+            models.LogEntry.objects.bulk_create(entries)
+        except Exception:
+            with self._lock:
+                self._failed[:0] = entries
+            raise
+
+
+audit_log = AuditLogWriter()
+
+
+def log_action(request, obj, action_flag, object_repr=None, message=''):
+    """
+    Records an audit log entry about an object through the audit log writer.
+    """
+    audit_log.enqueue(models.LogEntry(
         user_id=request.user.pk,
         content_type_id=ContentType.objects.get_for_model(obj).pk,
-        object_id=obj.pk,
-        object_repr=repr(obj),
-        action_flag=models.ADDITION
-    )
+        object_id=smart_text(obj.pk),
+        object_repr=(object_repr or repr(obj))[:200],
+        action_flag=action_flag,
+        change_message=message
+    ))
+
+
+def addition(request, obj):
+    """
+    Log that an object has been successfully added.
+    """
+    log_action(request, obj, models.ADDITION)
 
 
 def change(request, obj, message_or_fields):
@@ -73,24 +164,11 @@ def change(request, obj, message_or_fields):
         message = message_or_fields
     else:
         message = get_change_message(message_or_fields)
-    models.LogEntry.objects.log_action(
-        user_id=request.user.pk,
-        content_type_id=ContentType.objects.get_for_model(obj).pk,
-        object_id=obj.pk,
-        object_repr=repr(obj),
-        action_flag=models.CHANGE,
-        change_message=message
-    )
+    log_action(request, obj, models.CHANGE, message=message)
 
 
 def deletion(request, obj, object_repr=None):
     """
     Log that an object will be deleted.
     """
-    models.LogEntry.objects.log_action(
-        user_id=request.user.id,
-        content_type_id=ContentType.objects.get_for_model(obj).pk,
-        object_id=obj.pk,
-        object_repr=object_repr or repr(obj),
-        action_flag=models.DELETION
-    )
+    log_action(request, obj, models.DELETION, object_repr=object_repr)
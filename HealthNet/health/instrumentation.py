@@ -0,0 +1,162 @@
+"""
+Request timings gathered by InstrumentationMiddleware: time spent rendering
+templates and running queries during the current request, and rolling
+latency percentiles for each view. Timings are kept per process, so each server worker reports
+the requests it served.
+"""
+from collections import deque
+from django.db.backends.utils import CursorWrapper
+from django.template.base import Template
+import logging
+import threading
+import time
+
+logger = logging.getLogger('health.instrumentation')
+
+# The number of most recent requests to each view used for percentiles.
+WINDOW_SIZE = 500
+
+# The number of slowest queries included in each request's log line.
+SLOWEST_QUERY_COUNT = 3
+
+_state = threading.local()
+
+
+def percentile(values, fraction):
+    """
+    :param values: A sorted list of numbers.
+    :return: The nearest-rank percentile of the values.
+    """
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def start_request():
+    """
+    Resets the current thread's template timer and starts recording the
+    queries it runs.
+    """
+    _state.template_seconds = 0.0
+    _state.queries = []
+
+
+def finish_request():
+    """
+    Stops recording the current thread's queries.
+    :return: A list of dictionaries with the 'sql' and 'seconds' of each
+             query run since start_request. The SQL is as passed to the
+             database driver, with placeholders instead of parameter values,
+             so patient data and password hashes never reach the log.
+    """
+    queries = getattr(_state, 'queries', None) or []
+    _state.queries = None
+    return queries
+
+
+def template_seconds():
+    """
+    :return: Seconds spent rendering templates since start_request.
+    """
+    return getattr(_state, 'template_seconds', 0.0)
+
+
+def install_template_timer():
+    """
+    Wraps Template.render to add the time spent rendering the outermost
+    template to the current thread's template timer. Included templates
+    are counted as part of the template that includes them.
+    """
+    if getattr(Template.render, 'instrumented', False):
+        return
+    render = Template.render
+
+    def timed_render(self, context):
+        if getattr(_state, 'rendering', False):
+            return render(self, context)
+        _state.rendering = True
+        started = time.time()
+        try:
+            return render(self, context)
+        finally:
+            _state.rendering = False
+            _state.template_seconds = (template_seconds() +
+                                       time.time() - started)
+
+    timed_render.instrumented = True
+    Template.render = timed_render
+
+
+def install_query_timer():
+    """
+    Wraps CursorWrapper.execute and executemany to record each query's SQL
+    and duration while the current thread is between start_request and
+    finish_request.
+    """
+    if getattr(CursorWrapper.execute, 'instrumented', False):
+        return
+
+    def timed(method):
+        def timed_method(self, sql, params=None):
+            queries = getattr(_state, 'queries', None)
+            if queries is None:
+                return method(self, sql, params)
+            started = time.time()
+            try:
+                return method(self, sql, params)
+            finally:
+                queries.append({'sql': sql,
+                                'seconds': time.time() - started})
+
+        timed_method.instrumented = True
+        return timed_method
+
+    CursorWrapper.execute = timed(CursorWrapper.execute)
+    CursorWrapper.executemany = timed(CursorWrapper.executemany)
+
+
+class RollingTimings(object):
+    """
+    Keeps the most recent timings of each view and summarizes them.
+    """
+
+    def __init__(self, size=WINDOW_SIZE):
+        self.size = size
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, total_ms, sql_ms, queries):
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = deque(maxlen=self.size)
+            samples.append((total_ms, sql_ms, queries))
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+    def summary(self):
+        """
+        :return: A list of dictionaries describing each view's recent
+                 requests, sorted by view name.
+        """
+        with self._lock:
+            snapshot = [(name, list(samples))
+                        for name, samples in self._samples.items()]
+        rows = []
+        for name, samples in sorted(snapshot):
+            totals = sorted(sample[0] for sample in samples)
+            rows.append({
+                'name': name,
+                'count': len(samples),
+                'p50_ms': round(percentile(totals, 0.5), 1),
+                'p95_ms': round(percentile(totals, 0.95), 1),
+                'p99_ms': round(percentile(totals, 0.99), 1),
+                'sql_ms': round(sum(sample[1] for sample in samples) /
+                                len(samples), 1),
+                'queries': round(float(sum(sample[2] for sample in samples)) /
+                                 len(samples), 1),
+            })
+        return rows
+
+
+timings = RollingTimings()
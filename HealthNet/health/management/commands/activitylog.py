@@ -0,0 +1,71 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from health.activitylog import read_events, matches
+from health.form_utilities import parse_local_datetime
+import json
+import os
+import time
+
+
+class Command(BaseCommand):
+    help = 'Prints activity log events, optionally filtered by event type, ' \
+           'user, and time, and can keep following the log as it grows.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event', action='append', dest='events',
+                            help='Only show this event type. May be repeated.')
+        parser.add_argument('--user', type=int, dest='user_id',
+                            help='Only show events by this user id.')
+        parser.add_argument('--since',
+                            help='Only show events at or after this local time.')
+        parser.add_argument('--until',
+                            help='Only show events at or before this local time.')
+        parser.add_argument('--follow', action='store_true',
+                            help='Keep printing new events as they are logged.')
+
+    def _time(self, options, name):
+        value = options[name]
+        if value is None:
+            return None
+        parsed = parse_local_datetime(value)
+        if parsed is None:
+            raise CommandError('Invalid --%s time: %s' % (name, value))
+        return parsed
+
+    def _follow(self, filters):
+        """
+        Prints events as they're appended to the current log file, starting
+        over from the top of the file whenever it's rotated.
+        """
+        path = settings.ACTIVITY_LOG_FILE
+        position = os.path.getsize(path) if os.path.exists(path) else 0
+        while True:
+            if os.path.exists(path):
+                if os.path.getsize(path) < position:
+                    position = 0
+                with open(path, 'rb') as f:
+                    f.seek(position)
+                    for line in iter(f.readline, b''):
+                        if not line.endswith(b'\n'):
+                            break
+                        position += len(line)
+                        event = json.loads(line.decode())
+                        if matches(event, **filters):
+                            self.stdout.write(json.dumps(event,
+                                                         sort_keys=True))
+            time.sleep(0.5)
+
+    def handle(self, *args, **options):
+        filters = {
+            'events': options['events'],
+            'user_id': options['user_id'],
+            'since': self._time(options, 'since'),
+            'until': self._time(options, 'until'),
+        }
+        for event in read_events(**filters):
+            self.stdout.write(json.dumps(event, sort_keys=True))
+        if options['follow']:
+            try:
+                self._follow(filters)
+            except KeyboardInterrupt:
+                pass
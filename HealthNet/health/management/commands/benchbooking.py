@@ -0,0 +1,72 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from health.models import User, Appointment
+from datetime import date, timedelta
+import json
+import time
+
+
+class Command(BaseCommand):
+    help = 'Times appointment conflict checks as a doctor\'s history ' \
+           'grows. Runs against a throwaway test database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='100,1000,10000,100000',
+                            help='Comma-separated history sizes to test.')
+        parser.add_argument('--checks', type=int, default=500,
+                            help='Conflict checks to time at each size.')
+
+    def _user(self, username):
+        return User.objects.create_user(username, email=username,
+                                        password=None, phone_number='0',
+                                        date_of_birth=date(1980, 1, 1))
+
+    def _grow_history(self, doctor, patient, start, count):
+        """
+        Books `count` back-to-back, half hour appointments in the past,
+        ending at `start`.
+        """
+        appointments = []
+        for i in range(count):
+            begin = start - timedelta(minutes=30 * (i + 1))
+            appointments.append(Appointment(
+                doctor=doctor, patient=patient, date=begin, duration=30,
+                end_date=begin + timedelta(minutes=30)))
+        with transaction.atomic():
+            Appointment.objects.bulk_create(appointments, batch_size=500)
+        return start - timedelta(minutes=30 * count)
+
+    def _time_checks(self, doctor, checks):
+        now = timezone.now()
+        timings = []
+        for i in range(checks):
+            started = time.time()
+            doctor.is_free(now + timedelta(hours=i), 30)
+            timings.append(time.time() - started)
+        timings.sort()
+        return timings[len(timings) // 2] * 1000
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            doctor = self._user('doctor@example.com')
+            patient = self._user('patient@example.com')
+            oldest = timezone.now()
+            booked = 0
+            results = []
+            for size in sizes:
+                oldest = self._grow_history(doctor, patient, oldest,
+                                            size - booked)
+                booked = size
+                results.append({
+                    'history': size,
+                    'median_ms': round(self._time_checks(doctor,
+                                                         options['checks']),
+                                       4)
+                })
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        self.stdout.write(json.dumps(results, indent=4))
@@ -0,0 +1,142 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from health.instrumentation import percentile
+from health.models import User, Membership
+from io import StringIO
+import django
+import json
+import time
+
+# The views driven for each role, by name and path. `{group}` is replaced
+# with a conversation the user belongs to.
+VIEWS = (
+    ('home', '/'),
+    ('messages', '/messages/'),
+    ('conversation', '/messages/{group}/'),
+    ('schedule', '/schedule/'),
+    ('prescriptions', '/prescriptions/'),
+    ('users', '/users/'),
+    ('logs', '/logs/'),
+    ('export', '/users/me/info.json'),
+)
+
+ROLES = ('Administrator', 'Doctor', 'Nurse', 'Patient')
+
+
+class Command(BaseCommand):
+    help = 'Seeds a throwaway test database with populatedb and reports ' \
+           'the latency, query count and SQL time of the main views for ' \
+           'each role as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=2000)
+        parser.add_argument('--doctors', type=int, default=20)
+        parser.add_argument('--nurses', type=int, default=10)
+        parser.add_argument('--messages-per-group', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--iterations', type=int, default=10,
+                            help='Timed requests per view and role.')
+        parser.add_argument('--output',
+                            help='Also write the report to this file.')
+
+    def _users(self):
+        """
+        Picks a user for each role, preferring ones in a conversation so
+        every view has something to show.
+        :return: A dictionary of roles to (user, conversation id) tuples.
+        """
+        users = {'Administrator': User.objects.get(username='admin')}
+        for role in ROLES[1:]:
+            membership = Membership.objects.filter(user__role=role)\
+                                           .select_related('user')\
+                                           .order_by('pk').first()
+            users[role] = membership.user if membership else \
+                User.objects.filter(role=role).order_by('pk').last()
+        chosen = {}
+        for role, user in users.items():
+            group = Membership.objects.filter(user=user)\
+                                      .values_list('group_id', flat=True)\
+                                      .order_by('pk').first()
+            chosen[role] = (user, group)
+        return chosen
+
+    def _measure(self, client, path, iterations):
+        """
+        Requests the path once to warm up, then `iterations` more times.
+        Query counts are capped at the connection's queries_limit.
+        :return: A dictionary of the view's statistics.
+        """
+        timings = []
+        query_counts = []
+        sql_times = []
+        status = None
+        for i in range(iterations + 1):
+            reset_queries()
+            started = time.time()
+            response = client.get(path)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            elapsed = time.time() - started
+            status = response.status_code
+            if i == 0:
+                continue
+            timings.append(elapsed * 1000)
+            query_counts.append(len(connection.queries))
+            sql_times.append(sum(float(query['time'])
+                                 for query in connection.queries) * 1000)
+        timings.sort()
+        sql_times.sort()
+        return {
+            'status': status,
+            'p50_ms': round(percentile(timings, 0.5), 2),
+            'p95_ms': round(percentile(timings, 0.95), 2),
+            'queries': max(query_counts),
+            'sql_p50_ms': round(percentile(sql_times, 0.5), 2),
+        }
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 1:
+            raise CommandError('--iterations must be positive.')
+        old_name = connection.settings_dict['NAME']
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        connection.force_debug_cursor = True
+        try:
+            call_command('populatedb', patients=options['patients'],
+                         doctors=options['doctors'], nurses=options['nurses'],
+                         messages_per_group=options['messages_per_group'],
+                         seed=options['seed'], stdout=StringIO())
+            results = []
+            for role, (user, group) in sorted(self._users().items()):
+                client = Client()
+                # populatedb gives every user the same password.
+                client.login(username=user.username, password='p@ssword')
+                for name, path in VIEWS:
+                    if '{group}' in path and group is None:
+                        continue
+                    result = {'view': name, 'role': role}
+                    result.update(self._measure(
+                        client, path.format(group=group),
+                        options['iterations']))
+                    results.append(result)
+        finally:
+            connection.force_debug_cursor = False
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'options': dict((name, options[name]) for name in (
+                'patients', 'doctors', 'nurses', 'messages_per_group',
+                'seed', 'iterations')),
+            'results': results,
+        }
+        output = json.dumps(report, indent=4, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
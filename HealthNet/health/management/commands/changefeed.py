@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from health import changefeed
+import json
+import time
+
+
+class Command(BaseCommand):
+    help = 'Prints changes to users, appointments, prescriptions and ' \
+           'hospital stays after a cursor, one JSON object per line.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--after', type=int, default=0,
+                            help='The id of the last change already read.')
+        parser.add_argument('--limit', type=int,
+                            help='The most changes to print.')
+        parser.add_argument('--follow', action='store_true',
+                            help='Keep printing new changes as they arrive.')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds between polls while following.')
+
+    def handle(self, *args, **options):
+        cursor = options['after']
+        remaining = options['limit']
+        while remaining is None or remaining > 0:
+            count = changefeed.MAX_LIMIT if remaining is None else \
+                min(remaining, changefeed.MAX_LIMIT)
+            results, cursor = changefeed.changes(cursor, count)
+            for change in results:
+                self.stdout.write(json.dumps(change, sort_keys=True))
+            if remaining is not None:
+                remaining -= len(results)
+            if len(results) < count:
+                if not options['follow']:
+                    break
+                time.sleep(options['interval'])
+        self.stderr.write('cursor: %d' % cursor)
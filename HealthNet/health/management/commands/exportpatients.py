@@ -0,0 +1,188 @@
+from django.contrib.admin.models import LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Min, Max
+from django.utils import timezone
+from health.form_utilities import parse_local_datetime
+from health.models import *
+import bisect
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+
+# SQLite limits the number of parameters in a single query.
+PK_BATCH_SIZE = 500
+
+# Models whose audit log entries change a patient's export, along with a
+# function finding the patients affected by a batch of the model's ids.
+CHANGE_SOURCES = (
+    (User, lambda ids: User.objects.filter(pk__in=ids)
+                                   .values_list('pk', flat=True)),
+    (MedicalInformation, lambda ids: User.objects
+        .filter(medical_information_id__in=ids)
+        .values_list('pk', flat=True)),
+    (Insurance, lambda ids: User.objects
+        .filter(medical_information__insurance_id__in=ids)
+        .values_list('pk', flat=True)),
+    (EmergencyContact, lambda ids: User.objects
+        .filter(emergency_contact_id__in=ids)
+        .values_list('pk', flat=True)),
+    (Prescription, lambda ids: Prescription.objects.filter(pk__in=ids)
+                                           .values_list('patient_id', flat=True)),
+    (Appointment, lambda ids: Appointment.objects.filter(pk__in=ids)
+                                         .values_list('patient_id', flat=True)),
+    (HospitalStay, lambda ids: HospitalStay.objects.filter(pk__in=ids)
+                                           .values_list('patient_id', flat=True)),
+)
+
+
+def batches(items, size=PK_BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def changed_patients(since):
+    """
+    :return: The sorted primary keys of users whose export may have changed
+             since the provided time, according to the audit log.
+    """
+    pks = set()
+    entries = LogEntry.objects.filter(action_time__gte=since)
+    for model, patients_of in CHANGE_SOURCES:
+        content_type = ContentType.objects.get_for_model(model)
+        ids = set(int(object_id) for object_id in
+                  entries.filter(content_type=content_type)
+                         .values_list('object_id', flat=True)
+                         .iterator()
+                  if object_id.isdigit())
+        for batch in batches(sorted(ids)):
+            pks.update(patients_of(batch))
+    return sorted(pks)
+
+
+def export_shard(task):
+    """
+    Writes the patients in one primary key range to a gzipped NDJSON file.
+    Runs in a worker process.
+    :param task: A tuple of the output directory, the shard's index, the
+                 range of primary keys, and the list of primary keys to
+                 export, or None to export the whole range.
+    :return: The shard's manifest entry, or None if it had no patients.
+    """
+    directory, index, first_pk, last_pk, pks = task
+    patients = User.objects.filter(role='Patient', pk__gte=first_pk,
+                                   pk__lte=last_pk)
+    querysets = [patients] if pks is None else \
+        [patients.filter(pk__in=batch) for batch in batches(pks)]
+    name = 'patients-%05d.ndjson.gz' % index
+    path = os.path.join(directory, name)
+    count = 0
+    with gzip.open(path, 'wb') as f:
+        for queryset in querysets:
+            for user in User.iterate_for_export(queryset):
+                f.write(json.dumps(user.json_object(),
+                                   sort_keys=True).encode() + b'\n')
+                count += 1
+    if not count:
+        os.remove(path)
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return {
+        'file': name,
+        'first_pk': first_pk,
+        'last_pk': last_pk,
+        'count': count,
+        'bytes': os.path.getsize(path),
+        'sha256': digest.hexdigest(),
+    }
+
+
+class Command(BaseCommand):
+    help = 'Exports every patient\'s record as gzipped NDJSON shards, ' \
+           'split by primary key range across a pool of processes, ' \
+           'along with a manifest.json of row counts and checksums.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory',
+                            help='The directory to write the shards to.')
+        parser.add_argument('--workers', type=int,
+                            default=multiprocessing.cpu_count(),
+                            help='Worker processes. 1 exports in-process.')
+        parser.add_argument('--shard-size', type=int, default=50000,
+                            help='The width of each shard\'s primary key range.')
+        parser.add_argument('--since',
+                            help='Only export patients changed at or after '
+                                 'this local time, according to the audit '
+                                 'log. Changes that bypass the audit log, '
+                                 'such as edits made in a shell or directly '
+                                 'in the database, are missed; run a full '
+                                 'export after making any.')
+
+    def _tasks(self, directory, shard_size, pks):
+        bounds = User.objects.filter(role='Patient')\
+                             .aggregate(first=Min('pk'), last=Max('pk'))
+        if bounds['first'] is None:
+            return []
+        tasks = []
+        for index, first_pk in enumerate(range(bounds['first'],
+                                               bounds['last'] + 1, shard_size)):
+            last_pk = first_pk + shard_size - 1
+            shard_pks = None
+            if pks is not None:
+                shard_pks = pks[bisect.bisect_left(pks, first_pk):
+                                bisect.bisect_right(pks, last_pk)]
+                if not shard_pks:
+                    continue
+            tasks.append((directory, index, first_pk, last_pk, shard_pks))
+        return tasks
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        since = None
+        if options['since']:
+            since = parse_local_datetime(options['since'])
+            if since is None:
+                raise CommandError('Invalid --since time: %s' %
+                                   options['since'])
+        if options['shard_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--shard-size and --workers must be positive.')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        started = timezone.now()
+        pks = changed_patients(since) if since else None
+        tasks = self._tasks(directory, options['shard_size'], pks)
+        if options['workers'] == 1:
+            shards = [export_shard(task) for task in tasks]
+        else:
+            # Each worker opens its own database connection, so don't let
+            # them inherit this process's.
+            for connection in connections.all():
+                connection.close()
+            pool = multiprocessing.Pool(options['workers'])
+            try:
+                shards = pool.map(export_shard, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        shards = [shard for shard in shards if shard]
+
+        manifest = {
+            'started': started.isoformat(),
+            'since': since.isoformat() if since else None,
+            'count': sum(shard['count'] for shard in shards),
+            'shards': shards,
+        }
+        path = os.path.join(directory, 'manifest.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, sort_keys=True, indent=4,
+                      separators=(',', ': '))
+        os.rename(path + '.tmp', path)
+        self.stdout.write('Exported %d patients to %d shards in %s.' % (
+            manifest['count'], len(shards), directory))
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from health.models import Membership
+
+
+class Command(BaseCommand):
+    help = 'Copies conversation members and read receipts from the legacy ' \
+           'health_messagegroup_members and health_message_read_members ' \
+           'tables into per-member read watermarks.'
+
+    legacy_tables = ('health_messagegroup_members',
+                     'health_message_read_members')
+
+    batch_size = 500
+
+    # For each legacy membership, a member's watermark is the id just below
+    # the first message they haven't read or, if they've read everything,
+    # the newest message in the group.
+    watermark_query = """
+        SELECT gm.messagegroup_id, gm.user_id,
+               (SELECT MIN(m.id) FROM health_message m
+                 WHERE m.group_id = gm.messagegroup_id
+                   AND NOT EXISTS (
+                       SELECT 1 FROM health_message_read_members r
+                        WHERE r.message_id = m.id
+                          AND r.user_id = gm.user_id)),
+               (SELECT MAX(m.id) FROM health_message m
+                 WHERE m.group_id = gm.messagegroup_id)
+          FROM health_messagegroup_members gm
+    """
+
+    def handle(self, *args, **options):
+        tables = connection.introspection.table_names()
+        missing = [t for t in self.legacy_tables if t not in tables]
+        if missing:
+            self.stdout.write('Nothing to migrate: %s not found.' %
+                              ', '.join(missing))
+            return
+        existing = set(Membership.objects.values_list('group_id', 'user_id'))
+        memberships = []
+        with connection.cursor() as cursor:
+            cursor.execute(self.watermark_query)
+            for group_id, user_id, first_unread, latest in cursor.fetchall():
+                if (group_id, user_id) in existing:
+                    continue
+                if first_unread is not None:
+                    watermark = first_unread - 1
+                else:
+                    watermark = latest or 0
+                memberships.append(Membership(group_id=group_id,
+                                              user_id=user_id,
+                                              last_read_message_id=watermark))
+        with transaction.atomic():
+            Membership.objects.bulk_create(memberships,
+                                           batch_size=self.batch_size)
+        self.stdout.write('Migrated %d membership%s.' %
+                          (len(memberships),
+                           '' if len(memberships) == 1 else 's'))
@@ -1,12 +1,89 @@
-from django.core.management.base import BaseCommand
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
 from health.models import *
 from django.contrib.auth.models import Group
 import datetime
+import random
+
+FIRST_NAMES = [
+    "James", "Mary", "John", "Patricia", "Robert", "Jennifer", "Michael",
+    "Linda", "William", "Elizabeth", "David", "Barbara", "Richard", "Susan",
+    "Joseph", "Jessica", "Thomas", "Sarah", "Charles", "Karen", "Wei",
+    "Priya", "Mohammed", "Sofia", "Hiroshi", "Amara", "Mateo", "Olga",
+]
+
+LAST_NAMES = [
+    "Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller",
+    "Davis", "Rodriguez", "Martinez", "Hernandez", "Lopez", "Gonzalez",
+    "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin",
+    "Lee", "Nguyen", "Patel", "Kim", "Okafor", "Kowalski", "Rossi",
+]
+
+CITIES = [
+    ("Rochester", "NY", "146"), ("Buffalo", "NY", "142"),
+    ("Syracuse", "NY", "132"), ("Albany", "NY", "122"),
+    ("Erie", "PA", "165"), ("Hartford", "CT", "061"),
+]
+
+INSURERS = ["Excellus", "Aetna", "Cigna", "MVP Health Care",
+            "UnitedHealthcare", "Medicaid", "Medicare"]
+
+MEDICATIONS = [
+    ("Lisinopril", "10mg", "Once daily."),
+    ("Metformin", "500mg", "Twice daily with meals."),
+    ("Atorvastatin", "20mg", "Once daily at bedtime."),
+    ("Amoxicillin", "500mg", "Every 8 hours for 10 days."),
+    ("Albuterol", "90mcg", "Two puffs every 4 hours as needed."),
+    ("Ibuprofen", "400mg", "Every 6 hours as needed for pain."),
+    ("Levothyroxine", "50mcg", "Once daily before breakfast."),
+    ("Omeprazole", "20mg", "Once daily before a meal."),
+]
+
+MESSAGES = [
+    "Hi, I had a question about my prescription.",
+    "Your test results came back normal.",
+    "Can we move my appointment to next week?",
+    "Please remember to fast before your blood work.",
+    "Thanks, that works for me.",
+    "How have you been feeling since the last visit?",
+    "I've been having some side effects.",
+    "Let's talk about that at your next appointment.",
+]
 
 
 class Command(BaseCommand):
-    args = '<foo bar ...>'
-    help = 'our help string comes here'
+    help = 'Creates the sample hospitals and users, and optionally a ' \
+           'seeded, production-scale dataset on top of them. Every ' \
+           'generated user\'s password is "p@ssword".'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=0,
+                            help='Generated patients.')
+        parser.add_argument('--doctors', type=int, default=0,
+                            help='Generated doctors.')
+        parser.add_argument('--nurses', type=int, default=0,
+                            help='Generated nurses.')
+        parser.add_argument('--hospitals', type=int, default=0,
+                            help='Generated hospitals, in addition to the '
+                                 'sample hospitals.')
+        parser.add_argument('--appointments-per-patient', type=int,
+                            default=4)
+        parser.add_argument('--prescriptions-per-patient', type=int,
+                            default=2)
+        parser.add_argument('--past-stays-per-patient', type=int, default=1)
+        parser.add_argument('--conversations', type=int,
+                            help='Generated conversations. Defaults to one '
+                                 'for every ten patients.')
+        parser.add_argument('--messages-per-group', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Seed for the random generator, so runs '
+                                 'are repeatable.')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Users generated per transaction.')
 
     def _create_users(self):
         """
@@ -77,5 +154,257 @@ class Command(BaseCommand):
         patients.user_set.add(patient)
         h.admit(patient)
 
+    def _insert(self, model, objects):
+        """
+        Bulk-inserts the objects and sets their primary keys, which
+        bulk_create doesn't do on every backend. Assumes nothing else is
+        writing to the table.
+        :return: The objects.
+        """
+        last = model.objects.aggregate(last=Max('pk'))['last'] or 0
+        model.objects.bulk_create(objects)
+        pks = model.objects.filter(pk__gt=last).order_by('pk')\
+                                               .values_list('pk', flat=True)
+        for obj, pk in zip(objects, pks):
+            obj.pk = pk
+        return objects
+
+    def _create_hospitals(self, count):
+        hospitals = []
+        for i in range(count):
+            city, state, zipcode = self.random.choice(CITIES)
+            hospitals.append(Hospital(
+                name="%s %s Hospital" % (city, self.random.choice(LAST_NAMES)),
+                address="%d %s Ave" % (self.random.randint(1, 9999),
+                                       self.random.choice(LAST_NAMES)),
+                city=city, state=state,
+                zipcode=zipcode + "%02d" % self.random.randint(0, 99)))
+        self._insert(Hospital, hospitals)
+
+    def _user(self, role, hospital):
+        self.user_count += 1
+        first_name = self.random.choice(FIRST_NAMES)
+        last_name = self.random.choice(LAST_NAMES)
+        email = "%s.%s.%d@example.com" % (first_name.lower(),
+                                          last_name.lower(), self.user_count)
+        return User(username=email, email=email, password=self.password,
+                    first_name=first_name, last_name=last_name,
+                    phone_number="585%07d" % self.random.randint(0, 9999999),
+                    date_of_birth=self.today - datetime.timedelta(
+                        days=self.random.randint(18 * 365, 90 * 365)),
+                    role=role, current_hospital=hospital,
+                    date_joined=self.now)
+
+    def _generate_users(self, role, count, batch_size, generate_records=None):
+        """
+        Creates users in batches, each batch in its own transaction, along
+        with their group membership and an open stay at their hospital.
+        :param generate_records: Called with each batch of saved users to
+                                 create their other records.
+        :return: The created users' pks, keyed by hospital pk.
+        """
+        group = Group.objects.get(name=role)
+        by_hospital = {}
+        for start in range(0, count, batch_size):
+            with transaction.atomic():
+                users = []
+                for i in range(min(batch_size, count - start)):
+                    users.append(self._user(role,
+                                            self.random.choice(self.hospitals)))
+                if role == 'Patient':
+                    self._attach_medical_information(users)
+                self._insert(User, users)
+                SearchName.index(users)
+                User.groups.through.objects.bulk_create(
+                    [User.groups.through(user_id=user.pk, group_id=group.pk)
+                     for user in users])
+                HospitalStay.objects.bulk_create(
+                    [HospitalStay(patient_id=user.pk,
+                                  hospital_id=user.current_hospital_id,
+                                  admission=self._past(365))
+                     for user in users])
+                for user in users:
+                    by_hospital.setdefault(user.current_hospital_id, [])\
+                               .append(user.pk)
+                if generate_records:
+                    generate_records(users)
+            self.stdout.write('Created %d of %d %ss.' % (
+                min(start + batch_size, count), count, role.lower()))
+        return by_hospital
+
+    def _attach_medical_information(self, users):
+        insurances = self._insert(Insurance, [
+            Insurance(company=self.random.choice(INSURERS),
+                      policy_number="%010d" % self.random.randint(0, 10 ** 10))
+            for user in users])
+        information = self._insert(MedicalInformation, [
+            MedicalInformation(
+                sex=self.random.choice(MedicalInformation.SEX_CHOICES),
+                insurance_id=insurance.pk,
+                medications=None, allergies=self.random.choice(
+                    [None, None, "Penicillin", "Peanuts", "Latex"]),
+                medical_conditions=None, family_history=None,
+                additional_info=None)
+            for insurance in insurances])
+        for user, info in zip(users, information):
+            user.medical_information_id = info.pk
+
+    def _past(self, days):
+        return self.now - datetime.timedelta(
+            minutes=self.random.randint(0, days * 24 * 60))
+
+    def _create_patient_records(self, patients):
+        """
+        Creates past stays, prescriptions, and appointments with doctors at
+        their hospital for a batch of patients.
+        """
+        stays = []
+        prescriptions = []
+        appointments = []
+        for patient in patients:
+            for i in range(self.options['past_stays_per_patient']):
+                admission = self._past(3 * 365)
+                stays.append(HospitalStay(
+                    patient_id=patient.pk, admission=admission,
+                    hospital=self.random.choice(self.hospitals),
+                    discharge=admission + datetime.timedelta(
+                        hours=self.random.randint(2, 240))))
+            for i in range(self.options['prescriptions_per_patient']):
+                name, dosage, directions = self.random.choice(MEDICATIONS)
+                prescriptions.append(Prescription(
+                    patient_id=patient.pk, name=name, dosage=dosage,
+                    directions=directions, prescribed=self._past(365),
+                    active=self.random.random() < 0.5))
+            doctors = self.doctors.get(patient.current_hospital_id)
+            if not doctors:
+                continue
+            for i in range(self.options['appointments_per_patient']):
+                appointment = self._appointment(patient,
+                                                self.random.choice(doctors))
+                if appointment:
+                    appointments.append(appointment)
+        HospitalStay.objects.bulk_create(stays)
+        Prescription.objects.bulk_create(prescriptions)
+        Appointment.objects.bulk_create(appointments)
+
+    def _appointment(self, patient, doctor_id):
+        """
+        Picks a free half hour slot for the doctor, during business hours
+        in the 90 days on either side of today.
+        """
+        for attempt in range(5):
+            day = self.today + datetime.timedelta(
+                days=self.random.randint(-90, 90))
+            slot = self.random.randint(16, 33)  # 8:00 until 16:30
+            if (doctor_id, day, slot) in self.booked:
+                continue
+            self.booked.add((doctor_id, day, slot))
+            date = timezone.make_aware(
+                datetime.datetime.combine(day, datetime.time()) +
+                datetime.timedelta(minutes=30 * slot),
+                timezone.get_current_timezone())
+            return Appointment(patient_id=patient.pk, doctor_id=doctor_id,
+                               date=date, duration=30,
+                               end_date=date + datetime.timedelta(minutes=30))
+        return None
+
+    def _create_conversations(self, count, batch_size):
+        """
+        Creates conversations between a patient and one of their hospital's
+        doctors (and sometimes a nurse), with a history of messages and
+        each member's read position in it.
+        """
+        per_group = self.options['messages_per_group']
+        hospitals = [pk for pk in self.patients if pk in self.doctors]
+        if not hospitals:
+            return
+        for start in range(0, count, batch_size):
+            with transaction.atomic():
+                groups = []
+                members = []
+                for i in range(min(batch_size, count - start)):
+                    hospital = self.random.choice(hospitals)
+                    patient = self.random.choice(self.patients[hospital])
+                    doctor = self.random.choice(self.doctors[hospital])
+                    group_members = [patient, doctor]
+                    nurses = self.nurses.get(hospital)
+                    if nurses and self.random.random() < 0.3:
+                        group_members.append(self.random.choice(nurses))
+                    groups.append(MessageGroup(
+                        name=self.random.choice(["Follow up", "Test results",
+                                                 "Scheduling", "Question",
+                                                 "Prescription refill"])))
+                    members.append(group_members)
+                self._insert(MessageGroup, groups)
+
+                messages = []
+                for group, group_members in zip(groups, members):
+                    date = self._past(365)
+                    for i in range(per_group):
+                        date += datetime.timedelta(
+                            minutes=self.random.randint(1, 3 * 24 * 60))
+                        messages.append(Message(
+                            group_id=group.pk, date=date,
+                            sender_id=self.random.choice(group_members),
+                            body=self.random.choice(MESSAGES)))
+                self._insert(Message, messages)
+
+                memberships = []
+                for index, (group, group_members) in \
+                        enumerate(zip(groups, members)):
+                    history = messages[index * per_group:
+                                       (index + 1) * per_group]
+                    for user_id in group_members:
+                        read = self.random.randint(0, len(history))
+                        last_read = history[read - 1] if read else None
+                        memberships.append(Membership(
+                            group_id=group.pk, user_id=user_id,
+                            last_read_message_id=last_read.pk
+                                if last_read else 0,
+                            last_read_at=last_read.date
+                                if last_read else None))
+                Membership.objects.bulk_create(memberships)
+            self.stdout.write('Created %d of %d conversations.' % (
+                min(start + batch_size, count), count))
+
+    def _generate(self, options):
+        self.options = options
+        self.random = random.Random(options['seed'])
+        self.now = timezone.now()
+        self.today = timezone.localtime(self.now).date()
+        # Hashing is deliberately slow, so every user shares one hash.
+        self.password = make_password("p@ssword")
+        self.user_count = User.objects.aggregate(last=Max('pk'))['last'] or 0
+        self.booked = set()
+
+        self._create_hospitals(options['hospitals'])
+        self.hospitals = list(Hospital.objects.order_by('pk'))
+        batch_size = options['batch_size']
+        self.doctors = self._generate_users('Doctor', options['doctors'],
+                                          batch_size)
+        self.nurses = self._generate_users('Nurse', options['nurses'],
+                                         batch_size)
+        self.patients = self._generate_users('Patient', options['patients'],
+                                           batch_size,
+                                           self._create_patient_records)
+        conversations = options['conversations']
+        if conversations is None:
+            conversations = options['patients'] // 10
+        self._create_conversations(conversations, max(1, batch_size //
+                                   max(1, options['messages_per_group'])))
+        # bulk_create skips the receivers that keep the running totals.
+        call_command('rebuildstats', stdout=self.stdout)
+
     def handle(self, *args, **options):
-        self._create_users()
+        for name in ('patients', 'doctors', 'nurses', 'hospitals',
+                     'conversations', 'messages_per_group'):
+            if options[name] is not None and options[name] < 0:
+                raise CommandError('--%s can\'t be negative.' %
+                                   name.replace('_', '-'))
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        if not Group.objects.filter(name='Patient').exists():
+            self._create_users()
+        if any(options[name] for name in ('patients', 'doctors', 'nurses',
+                                          'hospitals')):
+            self._generate(options)
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from health.models import *
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the running totals shown on the System page from ' \
+           'the underlying rows.'
+
+    def _hospital_statistics(self):
+        statistics = dict((pk, Statistics(hospital_id=pk)) for pk in
+                          Hospital.objects.values_list('pk', flat=True))
+        stays = HospitalStay.objects.values('hospital_id')\
+                                    .annotate(count=Count('pk'))\
+                                    .order_by()
+        for row in stays:
+            statistics[row['hospital_id']].stay_count = row['count']
+        discharged = HospitalStay.objects.filter(discharge__isnull=False)\
+                                         .values_list('hospital_id',
+                                                      'admission',
+                                                      'discharge')
+        for hospital_id, admission, discharge in discharged.iterator():
+            row = statistics[hospital_id]
+            row.discharge_count += 1
+            row.total_stay_seconds += (discharge - admission).total_seconds()
+        return list(statistics.values())
+
+    def _system_statistics(self):
+        return Statistics(
+            prescription_count=Prescription.objects.count(),
+            active_prescription_count=Prescription.objects.filter(
+                active=True).count(),
+            appointment_count=Appointment.objects.count(),
+            conversation_count=MessageGroup.objects.count(),
+            message_count=Message.objects.count(),
+            admin_count=User.objects.filter(is_superuser=True).count())
+
+    def handle(self, *args, **options):
+        rows = self._hospital_statistics() + [self._system_statistics()]
+        with transaction.atomic():
+            Statistics.objects.all().delete()
+            Statistics.objects.bulk_create(rows)
+        self.stdout.write('Rebuilt statistics for %d hospital%s.' %
+                          (len(rows) - 1, '' if len(rows) == 2 else 's'))
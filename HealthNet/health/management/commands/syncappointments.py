@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from datetime import timedelta
+from health.models import Appointment
+
+
+class Command(BaseCommand):
+    help = 'Backfills and repairs the denormalized Appointment.end_date ' \
+           'column from each appointment\'s date and duration.'
+
+    def handle(self, *args, **options):
+        stale = []
+        appointments = Appointment.objects.values_list('pk', 'date',
+                                                       'duration', 'end_date')
+        for pk, date, duration, end_date in appointments.iterator():
+            expected = date + timedelta(minutes=duration)
+            if end_date != expected:
+                stale.append((pk, expected))
+        with transaction.atomic():
+            for pk, end_date in stale:
+                Appointment.objects.filter(pk=pk).update(end_date=end_date)
+        self.stdout.write('Updated the end date of %d appointment%s.' %
+                          (len(stale), '' if len(stale) == 1 else 's'))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from health.models import User, HospitalStay
+
+
+class Command(BaseCommand):
+    help = 'Backfills and repairs User.current_hospital from each user\'s ' \
+           'open hospital stay.'
+
+    # SQLite limits the number of parameters in a single query.
+    batch_size = 500
+
+    def handle(self, *args, **options):
+        # If a user somehow has several open stays, the newest one wins.
+        expected = dict(HospitalStay.objects
+                                    .filter(discharge__isnull=True)
+                                    .order_by('admission')
+                                    .values_list('patient_id', 'hospital_id')
+                                    .iterator())
+        stale = {}
+        users = User.objects.values_list('pk', 'current_hospital_id')
+        for pk, hospital_id in users.iterator():
+            expected_id = expected.get(pk)
+            if hospital_id != expected_id:
+                stale.setdefault(expected_id, []).append(pk)
+        with transaction.atomic():
+            for hospital_id, pks in stale.items():
+                for i in range(0, len(pks), self.batch_size):
+                    User.objects.filter(pk__in=pks[i:i + self.batch_size])\
+                                .update(current_hospital=hospital_id)
+        count = sum(len(pks) for pks in stale.values())
+        self.stdout.write('Updated the hospital of %d user%s.' %
+                          (count, '' if count == 1 else 's'))
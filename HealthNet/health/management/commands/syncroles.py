@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from health.models import User
+
+
+class Command(BaseCommand):
+    help = 'Backfills and repairs the denormalized User.role column from ' \
+           'each user\'s auth groups.'
+
+    # SQLite limits the number of parameters in a single query.
+    batch_size = 500
+
+    def _expected_roles(self):
+        """
+        :return: A dictionary mapping every user's pk to the name of their
+                 first group (matching User.group()).
+        """
+        roles = {}
+        memberships = User.groups.through.objects\
+                          .order_by('group_id')\
+                          .values_list('user_id', 'group__name')
+        for user_id, name in memberships.iterator():
+            roles.setdefault(user_id, name)
+        return roles
+
+    def handle(self, *args, **options):
+        expected = self._expected_roles()
+        stale = {}
+        for pk, role in User.objects.values_list('pk', 'role').iterator():
+            expected_role = expected.get(pk, '')
+            if role != expected_role:
+                stale.setdefault(expected_role, []).append(pk)
+        with transaction.atomic():
+            for role, pks in stale.items():
+                for i in range(0, len(pks), self.batch_size):
+                    User.objects.filter(pk__in=pks[i:i + self.batch_size])\
+                                .update(role=role)
+        count = sum(len(pks) for pks in stale.values())
+        self.stdout.write('Updated the role of %d user%s.' %
+                          (count, '' if count == 1 else 's'))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from health.models import User, SearchName
+
+
+class Command(BaseCommand):
+    help = 'Backfills and rebuilds the SearchName index used to find ' \
+           'message recipients by name or email.'
+
+    def handle(self, *args, **options):
+        count = 0
+        with transaction.atomic():
+            batch = []
+            for user in User.objects.only('first_name', 'last_name',
+                                          'email').iterator():
+                batch.append(user)
+                if len(batch) == SearchName.BATCH_SIZE:
+                    SearchName.index(batch)
+                    count += len(batch)
+                    batch = []
+            SearchName.index(batch)
+            count += len(batch)
+        self.stdout.write('Indexed the names of %d user%s.' %
+                          (count, '' if count == 1 else 's'))
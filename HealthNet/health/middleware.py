@@ -0,0 +1,166 @@
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from . import instrumentation
+from . import profiling
+from .form_utilities import audit_log, logger
+import cProfile
+import json
+import time
+
+
+class UserContext(object):
+    """
+    Memoizes facts about the logged-in user for the lifetime of a single
+    request, so the navbar and templates can ask for the user's role,
+    hospital, and unread count as often as they like while the database
+    is only hit once for each.
+    """
+
+    def __init__(self):
+        self._values = {}
+
+    def get(self, key, loader):
+        """
+        :param key: The name of the cached fact.
+        :param loader: A function that computes the fact if it hasn't
+                       been computed during this request.
+        :return: The cached (or freshly loaded) value.
+        """
+        if key not in self._values:
+            self._values[key] = loader()
+        return self._values[key]
+
+    def invalidate(self, *keys):
+        """
+        Forgets the provided facts (or all facts if none are provided) so
+        they will be reloaded the next time they are requested.
+        """
+        if not keys:
+            self._values.clear()
+        for key in keys:
+            self._values.pop(key, None)
+
+
+class UserContextMiddleware(object):
+    """
+    Installs a UserContext on the authenticated user of every request.
+    Must be listed after Django's AuthenticationMiddleware.
+    """
+
+    def process_request(self, request):
+        if request.user.is_authenticated():
+            request.user.request_context = UserContext()
+
+
+class AuditLogMiddleware(object):
+    """
+    Saves the audit log entries made while handling a request in one
+    batch before the response is returned.
+    """
+
+    def process_request(self, request):
+        audit_log.begin()
+
+    def process_response(self, request, response):
+        try:
+            audit_log.flush()
+        except Exception:
+            # The request's changes are already saved, so don't fail it.
+            # The entries are retried when the next request finishes.
+            logger.exception("Could not save audit log entries.")
+        return response
+
+
+class InstrumentationMiddleware(object):
+    """
+    Measures each request's total, view, template and SQL time, logs them
+    to the 'health.instrumentation' logger along with the timings of the
+    slowest queries, adds them to the response's Server-Timing header, and
+    records them in the rolling timings shown on the System page.
+    Only used when settings.INSTRUMENT_REQUESTS is True, since timing
+    every query has a cost. The slowest queries' SQL is only logged when
+    settings.INSTRUMENT_LOG_SQL is also True. Must be listed first so it
+    times the other middleware too.
+    """
+
+    def __init__(self):
+        if not getattr(settings, 'INSTRUMENT_REQUESTS', False):
+            raise MiddlewareNotUsed
+        instrumentation.install_template_timer()
+        instrumentation.install_query_timer()
+
+    def process_request(self, request):
+        request.instrumentation_started = time.time()
+        instrumentation.start_request()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.instrumentation_view_started = time.time()
+
+    def process_response(self, request, response):
+        started = getattr(request, 'instrumentation_started', None)
+        if started is None:
+            return response
+        finished = time.time()
+        queries = instrumentation.finish_request()
+        sql_ms = sum(query['seconds'] for query in queries) * 1000
+        total_ms = (finished - started) * 1000
+        view_started = getattr(request, 'instrumentation_view_started', None)
+        view_ms = (finished - view_started) * 1000 if view_started else 0.0
+        template_ms = instrumentation.template_seconds() * 1000
+        match = getattr(request, 'resolver_match', None)
+        name = match.view_name if match else 'unresolved'
+        instrumentation.timings.record(name, total_ms, sql_ms, len(queries))
+
+        log_sql = getattr(settings, 'INSTRUMENT_LOG_SQL', False)
+        slowest = []
+        for query in sorted(queries, key=lambda query: query['seconds'],
+                            reverse=True)[:instrumentation.SLOWEST_QUERY_COUNT]:
+            entry = {'ms': round(query['seconds'] * 1000, 2)}
+            if log_sql:
+                entry['sql'] = query['sql']
+            slowest.append(entry)
+        instrumentation.logger.info(json.dumps({
+            'view': name,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'total_ms': round(total_ms, 2),
+            'view_ms': round(view_ms, 2),
+            'template_ms': round(template_ms, 2),
+            'sql_ms': round(sql_ms, 2),
+            'queries': len(queries),
+            'slowest_queries': slowest,
+        }, sort_keys=True))
+        response['Server-Timing'] = \
+            'total;dur=%.1f, view;dur=%.1f, template;dur=%.1f, ' \
+            'sql;dur=%.1f;desc="%d queries"' % (total_ms, view_ms,
+                                                template_ms, sql_ms,
+                                                len(queries))
+        return response
+
+
+class ProfilingMiddleware(object):
+    """
+    Profiles the view and template rendering of the requests chosen by
+    profiling.should_profile with cProfile, and dumps the profiles to
+    settings.PROFILE_DIR. Only used when PROFILE_DIR is set. While the
+    sample rate is 0 the only cost is rereading it once a second.
+    """
+
+    def __init__(self):
+        if not getattr(settings, 'PROFILE_DIR', None):
+            raise MiddlewareNotUsed
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if profiling.should_profile(request):
+            request.profile = cProfile.Profile()
+            request.profile.enable()
+
+    def process_response(self, request, response):
+        profile = getattr(request, 'profile', None)
+        if profile is None:
+            return response
+        profile.disable()
+        del request.profile
+        profiling.save(profile, request.resolver_match.view_name)
+        return response
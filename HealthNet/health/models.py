@@ -1,7 +1,13 @@
-from django.db import models
-from django.db.models import Q
+from django.db import connections, models, router, transaction, \
+    IntegrityError
+from django.db.models import Q, F, Max, Count, Prefetch
+from django.db.models.signals import m2m_changed, pre_save, post_save, \
+    post_delete, post_migrate
+from django.dispatch import receiver
 from django.utils import timezone
 from datetime import timedelta
+import heapq
+import time
 from django.contrib.auth.models import AbstractUser, Group
 
 
@@ -86,34 +92,40 @@ class Hospital(models.Model):
 
     def __repr__(self):
         # "St. Jude Hospital at 1 Hospital Road, Waterbury, CT 06470"
-        return ("%s at %s, %s, %s %s" % self.name, self.address, self.city,
-                self.state, self.zipcode)
+        return "%s at %s, %s, %s %s" % (self.name, self.address, self.city,
+                                        self.state, self.zipcode)
 
     def admit(self, user):
-        current_hospital_query = HospitalStay.objects.filter(patient=user,
-            discharge__isnull=True)
-        if current_hospital_query.exists():
-            for stay in current_hospital_query.all():
-                stay.discharge = timezone.now()
-                stay.save()
-        HospitalStay.objects.create(patient=user, admission=timezone.now(),
-                           hospital=self)
+        """
+        Discharges the user from any hospital they're staying in, starts a
+        new stay at this hospital, and points the user's current_hospital
+        here.
+        """
+        now = timezone.now()
+        HospitalStay.end_stays(HospitalStay.objects.filter(
+            patient=user, discharge__isnull=True), now)
+        stay = HospitalStay.objects.create(patient=user, admission=now,
+                                           hospital=self)
+        Statistics.record(self, stay_count=1)
+        user.current_hospital = self
+        User.objects.filter(pk=user.pk).update(current_hospital=self)
+        return stay
 
     def discharge(self, user):
-        user_query = HospitalStay.objects.filter(patient=user,
-                                                hospital=self)
-        if user_query.exists():
-            stay = user_query.first()
-            stay.discharge = timezone.now()
-            stay.save()
+        """
+        Ends the user's open stay at this hospital, if they have one.
+        """
+        HospitalStay.end_stays(HospitalStay.objects.filter(
+            patient=user, hospital=self, discharge__isnull=True),
+            timezone.now())
+        if user.current_hospital_id == self.pk:
+            user.current_hospital = None
+            User.objects.filter(pk=user.pk).update(current_hospital=None)
 
     def users_in_group(self, group_name):
-        return list({stay.patient for stay in
-               HospitalStay.objects
-                           .filter(hospital=self, patient__groups__name=group_name)
-                           .distinct()
-                           .order_by('patient__first_name', 'patient__last_name')
-                           .all()})
+        return list(self.current_users
+                        .filter(role=group_name)
+                        .order_by('first_name', 'last_name'))
 
 
 class User(AbstractUser):
@@ -121,6 +133,16 @@ class User(AbstractUser):
     phone_number = models.CharField(max_length=30)
     medical_information = models.ForeignKey(MedicalInformation, null=True)
     emergency_contact = models.ForeignKey(EmergencyContact, null=True)
+    # The name of the user's group, kept in sync with `groups` by the
+    # m2m_changed receiver below so role filters don't need to join
+    # through auth_group. Run `manage.py syncroles` to repair it.
+    role = models.CharField(max_length=80, blank=True, default='',
+                            db_index=True)
+    # The hospital of the user's open HospitalStay, maintained by
+    # Hospital.admit and Hospital.discharge. Run
+    # `manage.py synchospitals` to repair it.
+    current_hospital = models.ForeignKey(Hospital, null=True, blank=True,
+                                         related_name='current_users')
 
     REQUIRED_FIELDS = ['date_of_birth', 'phone_number', 'email', 'first_name',
                        'last_name', 'hospital']
@@ -136,12 +158,13 @@ class User(AbstractUser):
             Returns all patients in the database.
         :return:
         """
+        patients = User.objects.filter(role='Patient')
         if self.is_superuser or self.is_doctor():
             # Admins and doctors can see all users as patients.
-            return Group.objects.get(name='Patient').user_set.all()
+            return patients
         elif self.is_nurse():
             # Nurses get all users inside their hospital.
-            return Group.objects.get(name='Patient').user_set.filter(hospital=self.hospital)
+            return patients.filter(current_hospital=self.current_hospital_id)
         else:
             # Users can only see themselves.
             return User.objects.filter(pk=self.pk)
@@ -151,7 +174,19 @@ class User(AbstractUser):
             or self.is_superuser \
             or user.is_patient() \
             and self.is_doctor() or (self.is_nurse()
-             and self.hospital == user.hospital)
+             and self.current_hospital_id is not None
+             and self.current_hospital_id == user.current_hospital_id)
+
+    def can_view_schedule(self, user):
+        """
+        :return: Whether this user may see when `user` is busy: their own
+                 schedule, any schedule for an admin, and the schedules of
+                 people at the same hospital for doctors and nurses.
+        """
+        return user.pk == self.pk or self.is_superuser or \
+            ((self.is_doctor() or self.is_nurse()) and
+             self.current_hospital_id is not None and
+             self.current_hospital_id == user.current_hospital_id)
 
     def active_patients(self):
         """
@@ -166,28 +201,74 @@ class User(AbstractUser):
     def latest_messages(self):
         return self.sent_messages.order_by('-date')
 
+    def inbox(self):
+        """
+        Loads every conversation this user is a member of, most recent
+        first, in a constant number of queries. Each group comes back with
+        its latest message, its members, and a `has_unread` flag already
+        loaded so rendering the inbox doesn't query per conversation.
+        The newest message is the one with the highest id, both for the
+        order and for the preview, so the two always agree.
+        :return: A list of MessageGroups.
+        """
+        groups = list(self.messagegroup_set
+                          .annotate(latest_message_id=Max('messages__id'))
+                          .prefetch_related('members')
+                          .order_by('-latest_message_id'))
+        group_ids = [group.pk for group in groups]
+        latest_messages = Message.objects.in_bulk(
+            [group.latest_message_id for group in groups
+             if group.latest_message_id is not None])
+        watermarks = dict(Membership.objects
+                                    .filter(user=self, group__in=group_ids)
+                                    .values_list('group_id',
+                                                 'last_read_message_id'))
+        for group in groups:
+            group.prefetched_latest_message = latest_messages.get(
+                group.latest_message_id)
+            group.has_unread = ((group.latest_message_id or 0) >
+                                watermarks.get(group.pk, 0))
+        return groups
+
     def unread_message_count(self):
-        return Message.objects.filter(group__members__pk=self.pk)\
-                              .exclude(read_members__pk=self.pk)\
-                              .distinct().count()
+        return self.cached('unread_message_count', lambda:
+            Message.objects.filter(
+                group__membership__user=self,
+                pk__gt=F('group__membership__last_read_message_id')
+            ).count())
+
+    @staticmethod
+    def unread_message_counts(user_ids):
+        """
+        Counts the unread messages of several users with one query.
+        :return: A dictionary of user ids to unread message counts.
+        """
+        counts = dict((user_id, 0) for user_id in user_ids)
+        counts.update(Message.objects.filter(
+            group__membership__user_id__in=user_ids,
+            pk__gt=F('group__membership__last_read_message_id')
+        ).values_list('group__membership__user_id')
+         .annotate(count=Count('pk')))
+        return counts
 
     def schedule(self):
         """
         :return: All appointments for which this person is needed.
         """
         if self.is_superuser:
-            return Appointment.objects
+            return Appointment.objects.select_related('patient', 'doctor')
         elif self.is_doctor():
             # Doctors see all appointments for which they are needed.
-            return Appointment.objects.filter(doctor=self)
+            return self.doctor_appointments.all()
         # Patients see all appointments
-        return Appointment.objects.filter(patient=self)
+        return self.patient_appointments.all()
 
     def upcoming_appointments(self):
         date = timezone.now()
         start_week = date - timedelta(date.weekday())
         end_week = start_week + timedelta(7)
-        return self.schedule().filter(date__range=[start_week, end_week])
+        return self.schedule().select_related('patient', 'doctor')\
+                              .filter(date__range=[start_week, end_week])
 
     def is_patient(self):
         """
@@ -213,36 +294,121 @@ class User(AbstractUser):
         :return: True if the user is a member of the group provided.
         """
         try:
-            return (Group.objects.get(name=group_name)
-                         .user_set.filter(pk=self.pk).exists())
+            return group_name in self.cached('group_names', lambda:
+                set(group.name for group in self.groups.all()))
         except ValueError:
             return False
 
+    def cached(self, key, loader):
+        """
+        Looks up a per-request fact about this user, installed by
+        UserContextMiddleware. Users loaded outside of a request always
+        hit the database.
+        :param key: The name of the fact.
+        :param loader: A function that loads the fact from the database.
+        :return: The value of the fact.
+        """
+        context = getattr(self, 'request_context', None)
+        if context is None:
+            return loader()
+        return context.get(key, loader)
+
+    def invalidate_cached(self, *keys):
+        """
+        Forgets per-request facts about this user after they change.
+        """
+        context = getattr(self, 'request_context', None)
+        if context is not None:
+            context.invalidate(*keys)
+
     def group(self):
         return self.groups.first()
 
-    def is_free(self, date, duration):
+    def role_from_groups(self):
+        """
+        :return: The role this user should have according to their groups.
+        """
+        group = self.group()
+        return group.name if group else ''
+
+    def is_free(self, date, duration, ignoring=None):
         """
         Checks the user's schedule for a given date and duration to see if
         the user does not have an appointment at that time.
+        Only appointments that end after the requested start are examined,
+        so the check doesn't slow down as the user's history grows.
         :param date:
         :param duration:
+        :param ignoring: An appointment to leave out of the check, such as
+                         one that is being moved.
         :return:
         """
-        schedule = self.schedule().all()
         end = date + timedelta(minutes=duration)
-        for appointment in schedule:
-            # If the dates intersect (meaning one starts while the other is
-            # in progress) then the person is not free at the provided date
-            # and time.
-            if (date <= appointment.date <= end or
-                    appointment.date <= date <= appointment.end()):
-                return False
-        return True
+        # If the dates intersect (meaning one starts while the other is
+        # in progress) then the person is not free at the provided date
+        # and time. Back-to-back appointments don't intersect.
+        conflicts = self.schedule().filter(date__lt=end, end_date__gt=date)
+        if ignoring is not None and ignoring.pk is not None:
+            conflicts = conflicts.exclude(pk=ignoring.pk)
+        return not conflicts.exists()
+
+    def busy_intervals(self, start, end):
+        """
+        :return: The (start, end) times of every appointment in the user's
+                 schedule that overlaps the provided range, ordered by start.
+        """
+        return self.schedule().filter(date__lt=end, end_date__gt=start)\
+                              .order_by('date')\
+                              .values_list('date', 'end_date')
+
+    def free_slots(self, start, end, duration, other=None, limit=None):
+        """
+        Finds the times between start and end at which an appointment of
+        the provided duration could be booked with this user and, if
+        provided, another user. Both schedules are read in order and swept
+        once, so the work is proportional to the number of appointments in
+        the range.
+        :param start: The earliest time a slot may begin.
+        :param end: The latest time a slot may end.
+        :param duration: The length of each slot, in minutes.
+        :param other: Another user who must also be free.
+        :param limit: The most slots to find, if provided.
+        :return: A list of (start, end) tuples, earliest first.
+        """
+        length = timedelta(minutes=duration)
+        busy = [self.busy_intervals(start, end)]
+        if other is not None and other.pk != self.pk:
+            busy.append(other.busy_intervals(start, end))
+        slots = []
+        cursor = start
+        for busy_start, busy_end in heapq.merge(*busy):
+            while cursor + length <= busy_start:
+                if len(slots) == limit:
+                    return slots
+                slots.append((cursor, cursor + length))
+                cursor += length
+            cursor = max(cursor, busy_end)
+        while cursor + length <= end and len(slots) != limit:
+            slots.append((cursor, cursor + length))
+            cursor += length
+        return slots
 
     def active_prescriptions(self):
+        if hasattr(self, 'prefetched_active_prescriptions'):
+            return self.prefetched_active_prescriptions
         return self.prescription_set.filter(active=True).all()
 
+    def active_patients_with_prescriptions(self):
+        """
+        Loads active_patients along with each patient's active
+        prescriptions in two queries.
+        :return: A list of Users.
+        """
+        return list(self.active_patients().prefetch_related(Prefetch(
+            'prescription_set',
+            queryset=Prescription.objects.filter(active=True),
+            to_attr='prefetched_active_prescriptions')))
+
     def json_object(self):
         json = {
             'name': self.get_full_name(),
@@ -250,33 +416,199 @@ class User(AbstractUser):
             'date_of_birth': self.date_of_birth.isoformat(),
             'phone_number': self.phone_number,
         }
-        if self.hospital:
-            json['hospital'] = self.hospital().json_object()
+        hospital = self.hospital()
+        if hospital:
+            json['hospital'] = hospital.json_object()
         if self.medical_information:
             json['medical_information'] = self.medical_information.json_object()
         if self.emergency_contact:
             json['emergency_contact'] = self.emergency_contact.json_object()
-        if self.prescription_set.all():
-            json['prescriptions'] = [p.json_object() for p in
-                self.prescription_set.all()]
-        if self.schedule():
-            json['appointments'] = [a.json_object() for a in self.schedule().all()]
+        prescriptions = self.prescription_set.all()
+        if prescriptions:
+            json['prescriptions'] = [p.json_object() for p in prescriptions]
+        appointments = self.schedule()
+        if appointments:
+            json['appointments'] = [a.json_object() for a in appointments]
         return json
 
+    @staticmethod
+    def with_export_data(users):
+        """
+        Loads everything json_object needs alongside the users, so
+        exporting any number of them takes a fixed number of queries.
+        :param users: A User queryset.
+        :return: The queryset with its related rows joined or prefetched.
+        """
+        appointments = Appointment.objects.select_related('patient', 'doctor')
+        return users.select_related('current_hospital',
+                                    'medical_information__insurance',
+                                    'emergency_contact')\
+                    .prefetch_related('groups', 'prescription_set',
+                                      Prefetch('patient_appointments',
+                                               queryset=appointments),
+                                      Prefetch('doctor_appointments',
+                                               queryset=appointments))
+
+    @staticmethod
+    def iterate_for_export(users, batch_size=200):
+        """
+        Yields the users with their export data, loading them `batch_size`
+        at a time in primary key order so only one batch is ever held in
+        memory.
+        :param users: A User queryset.
+        """
+        last_pk = 0
+        while True:
+            batch = list(User.with_export_data(users.filter(pk__gt=last_pk)
+                                                    .order_by('pk'))[:batch_size])
+            for user in batch:
+                yield user
+            if len(batch) < batch_size:
+                return
+            last_pk = batch[-1].pk
+
     def hospital(self):
-        patient_query = HospitalStay.objects.filter(patient=self,
-                                                    discharge__isnull=True)
-        if patient_query.exists():
-            stays = [x for x in patient_query.all()]
-            return stays[0].hospital
-        return None
+        return self.current_hospital
+
+    def message_recipients(self):
+        """
+        Returns the users this user can start a conversation with.
+        Administrators can message any doctor, nurse or patient. Everyone
+        else can message the active doctors, nurses and patients at their
+        hospital, except those with their own role. Users who aren't at a
+        hospital can't start conversations.
+        :return: A User queryset.
+        """
+        recipients = User.objects.filter(
+            is_active=True, role__in=['Patient', 'Doctor', 'Nurse']
+        ).exclude(pk=self.pk)
+        if self.is_superuser:
+            return recipients
+        if self.current_hospital_id is None:
+            return User.objects.none()
+        return recipients.exclude(role=self.role)\
+                         .filter(current_hospital=self.current_hospital_id)
+
+    def find_recipients(self, query, limit=10):
+        """
+        Finds the message recipients with a first name, last name, full
+        name or email that starts with the query, using range queries over
+        the SearchName index.
+        :return: Up to `limit` users, ordered by name.
+        """
+        prefix = SearchName.normalize(query)
+        if not prefix:
+            return []
+        names = SearchName.objects.filter(name__gte=prefix,
+                                          name__lt=prefix[:-1] +
+                                          chr(ord(prefix[-1]) + 1))
+        return list(self.message_recipients()
+                        .filter(pk__in=names.values('user_id'))
+                        .order_by('last_name', 'first_name', 'pk')[:limit])
+
+
+class SearchName(models.Model):
+    """
+    The lowercased names a user can be found by: their first name, last
+    name, full name and email. Kept up to date by the post_save receiver
+    below, so prefix searches are range scans over an index instead of
+    case-insensitive scans of the user table. Run
+    `manage.py syncsearchnames` to rebuild it.
+    """
+    user = models.ForeignKey(User, related_name='search_names')
+    name = models.CharField(max_length=254, db_index=True)
+
+    # The User fields the names are built from.
+    SOURCE_FIELDS = frozenset(['first_name', 'last_name', 'email'])
+
+    # SQLite limits the number of parameters in a single query.
+    BATCH_SIZE = 500
+
+    @staticmethod
+    def normalize(name):
+        return ' '.join(name.lower().split())[:254]
+
+    @classmethod
+    def names_for(cls, user):
+        names = set([user.first_name, user.last_name, user.email,
+                     '%s %s' % (user.first_name, user.last_name)])
+        return set(cls.normalize(name) for name in names) - set([''])
+
+    @classmethod
+    def index(cls, users):
+        """
+        Replaces the search names of the provided users.
+        """
+        users = list(users)
+        for start in range(0, len(users), cls.BATCH_SIZE):
+            batch = users[start:start + cls.BATCH_SIZE]
+            cls.objects.filter(user__in=[user.pk for user in batch]).delete()
+            cls.objects.bulk_create([cls(user_id=user.pk, name=name)
+                                     for user in batch
+                                     for name in cls.names_for(user)])
 
 
 class Appointment(models.Model):
     patient = models.ForeignKey(User, related_name='patient_appointments')
     doctor = models.ForeignKey(User, related_name='doctor_appointments')
-    date = models.DateTimeField()
+    date = models.DateTimeField(db_index=True)
     duration = models.IntegerField()
+    # Stored copy of end(), maintained by save(), so overlap checks can be
+    # answered from an index. Run `manage.py syncappointments` to repair it.
+    end_date = models.DateTimeField()
+
+    class Meta:
+        index_together = [
+            # Listing a person's schedule in order.
+            ('doctor', 'date'),
+            ('patient', 'date'),
+            # Conflict checks only visit appointments that haven't ended.
+            ('doctor', 'end_date'),
+            ('patient', 'end_date'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.end_date = self.end()
+        super(Appointment, self).save(*args, **kwargs)
+
+    def book(self):
+        """
+        Saves the appointment if both the doctor and the patient are free
+        for its whole duration. The check and the write happen atomically,
+        so two concurrent bookings can't both claim the same time.
+        :return: None if the appointment was saved, otherwise a message
+                 explaining the conflict.
+        """
+        with transaction.atomic():
+            self._lock_participants()
+            if not self.doctor.is_free(self.date, self.duration, ignoring=self):
+                return "The doctor is not free at that time." +\
+                       " Please specify a different time."
+            if not self.patient.is_free(self.date, self.duration,
+                                        ignoring=self):
+                return "The patient is not free at that time." +\
+                       " Please specify a different time."
+            self.save()
+        return None
+
+    def _lock_participants(self):
+        """
+        Makes bookings involving the same doctor or patient wait for each
+        other, in every thread and process, until the current transaction
+        ends. Must be the first statement of the transaction.
+        Most databases lock the participants' rows, in a consistent order
+        to avoid deadlocks. SQLite ignores SELECT ... FOR UPDATE and only
+        has a database-wide write lock, so a no-op write takes that lock
+        before anything is read, as BEGIN IMMEDIATE would. Reading first
+        would make a concurrent booking fail with "database is locked"
+        when upgrading to the write lock, rather than wait for it.
+        """
+        participants = User.objects.filter(pk__in=[self.doctor_id,
+                                                   self.patient_id])
+        if connections[router.db_for_write(User)].vendor == 'sqlite':
+            participants.update(role=F('role'))
+        else:
+            list(participants.select_for_update().order_by('pk'))
 
     def json_object(self):
         return {
@@ -303,6 +635,33 @@ class HospitalStay(models.Model):
     discharge = models.DateTimeField(null=True)
     hospital = models.ForeignKey(Hospital)
 
+    class Meta:
+        # Open stays are the ones with a null discharge.
+        index_together = [
+            ('patient', 'discharge'),
+            ('hospital', 'discharge'),
+        ]
+
+    def json_object(self):
+        return {
+            'hospital': self.hospital.name,
+            'admission': self.admission.isoformat(),
+            'discharge': self.discharge.isoformat() if self.discharge else None,
+        }
+
+    @staticmethod
+    def end_stays(stays, discharge):
+        """
+        Discharges every stay in the provided queryset at the same time
+        and adds them to their hospitals' statistics.
+        """
+        ended = list(stays.values_list('hospital_id', 'admission'))
+        stays.update(discharge=discharge)
+        for hospital_id, admission in ended:
+            Statistics.record(hospital_id, discharge_count=1,
+                              total_stay_seconds=
+                                  (discharge - admission).total_seconds())
+
 
 class Prescription(models.Model):
     patient = models.ForeignKey(User)
@@ -312,6 +671,15 @@ class Prescription(models.Model):
     prescribed = models.DateTimeField()
     active = models.BooleanField()
 
+    def deactivate(self):
+        """
+        Marks the prescription as no longer active.
+        """
+        if self.active:
+            self.active = False
+            self.save()
+            Statistics.record(active_prescription_count=-1)
+
     def json_object(self):
         return {
             'name': self.name,
@@ -327,12 +695,71 @@ class Prescription(models.Model):
 
 class MessageGroup(models.Model):
     name = models.CharField(max_length=140)
-    members = models.ManyToManyField(User)
+    members = models.ManyToManyField(User, through='Membership')
+
+    def add_members(self, users):
+        """
+        Adds the provided users to the conversation, skipping anyone who
+        is already a member.
+        """
+        existing = set(self.membership_set.values_list('user_id', flat=True))
+        Membership.objects.bulk_create([
+            Membership(group=self, user=user) for user in set(users)
+            if user.pk not in existing
+        ])
+
+    def mark_read(self, user):
+        """
+        Moves the user's read watermark up to the newest message in the
+        conversation with a single UPDATE, skipping the write entirely if
+        the user has already read everything.
+        :return: The number of memberships that changed.
+        """
+        with transaction.atomic():
+            latest_id = self.messages.aggregate(latest=Max('id'))['latest']
+            if latest_id is None:
+                return 0
+            return Membership.objects.filter(
+                group=self, user=user, last_read_message_id__lt=latest_id
+            ).update(last_read_message_id=latest_id,
+                     last_read_at=timezone.now())
+
+    def message_window(self, before=None, count=50):
+        """
+        Loads a window of the conversation, so long conversations can be
+        rendered a page at a time.
+        :param before: If provided, only messages with an id lower than
+                       this are returned.
+        :param count: The maximum number of messages to return.
+        :return: A tuple containing up to `count` of the newest matching
+                 messages, oldest first, and whether there are older ones.
+        """
+        messages = self.messages.select_related('sender').order_by('-id')
+        if before is not None:
+            messages = messages.filter(id__lt=before)
+        messages = list(messages[:count + 1])
+        has_older = len(messages) > count
+        return list(reversed(messages[:count])), has_older
+
+    def messages_after(self, after, count=50):
+        """
+        Loads the messages sent since a client last checked, so clients can
+        poll for new messages without reloading the conversation.
+        :param after: The id of the newest message the client has.
+        :param count: The maximum number of messages to return.
+        :return: A tuple containing up to `count` of the oldest messages
+                 with an id higher than `after`, oldest first, and whether
+                 there are newer ones.
+        """
+        messages = list(self.messages.select_related('sender')
+                                     .filter(id__gt=after)
+                                     .order_by('id')[:count + 1])
+        return messages[:count], len(messages) > count
 
     def latest_message(self):
-        if self.messages.count() == 0:
-            return None
-        return self.messages.order_by('-date').first()
+        if hasattr(self, 'prefetched_latest_message'):
+            return self.prefetched_latest_message
+        return self.messages.order_by('-id').first()
 
     def combined_names(self, full=False):
         names_count = self.members.count()
@@ -346,12 +773,271 @@ class MessageGroup(models.Model):
         return names
 
 
+class Membership(models.Model):
+    """
+    A user's membership in a MessageGroup, along with how far into the
+    conversation they've read. Every message in the group with an id less
+    than or equal to `last_read_message_id` has been read by the member.
+    """
+    user = models.ForeignKey(User)
+    group = models.ForeignKey(MessageGroup)
+    last_read_message_id = models.IntegerField(default=0)
+    last_read_at = models.DateTimeField(null=True)
+
+    class Meta:
+        unique_together = ('user', 'group')
+
+
 class Message(models.Model):
     sender = models.ForeignKey(User, related_name='sent_messages')
     group = models.ForeignKey(MessageGroup, related_name='messages')
     body = models.TextField()
     date = models.DateTimeField()
-    read_members = models.ManyToManyField(User, related_name='read_messages')
 
     def preview_text(self):
         return (self.body[:100] + "...") if len(self.body) > 100 else self.body
+
+    def json_object(self):
+        return {
+            'id': self.pk,
+            'sender_id': self.sender_id,
+            'sender': self.sender.get_full_name(),
+            'body': self.body,
+            'date': self.date.isoformat(),
+        }
+
+
+class Statistics(models.Model):
+    """
+    Running totals for the System page, updated as rows are written so the
+    page never has to count or scan them. Each hospital has a row of stay
+    totals, and the row without a hospital holds system-wide totals.
+    The rows are created after migrating and with each new hospital, so
+    recording only ever updates them.
+    Run `manage.py rebuildstats` to recompute them from scratch.
+    """
+    hospital = models.OneToOneField(Hospital, null=True)
+    stay_count = models.IntegerField(default=0)
+    discharge_count = models.IntegerField(default=0)
+    total_stay_seconds = models.FloatField(default=0)
+    prescription_count = models.IntegerField(default=0)
+    active_prescription_count = models.IntegerField(default=0)
+    appointment_count = models.IntegerField(default=0)
+    conversation_count = models.IntegerField(default=0)
+    message_count = models.IntegerField(default=0)
+    admin_count = models.IntegerField(default=0)
+
+    @classmethod
+    def record(cls, hospital=None, **changes):
+        """
+        Adds the provided amounts to a hospital's totals, or to the
+        system-wide totals if no hospital is provided, with one UPDATE.
+        :param hospital: A Hospital or hospital id.
+        """
+        if isinstance(hospital, Hospital):
+            hospital = hospital.pk
+        updates = dict((field, F(field) + amount)
+                       for field, amount in changes.items())
+        if cls.objects.filter(hospital=hospital).update(**updates):
+            return
+        if hospital is not None and \
+                not Hospital.objects.filter(pk=hospital).exists():
+            # The hospital is being deleted along with its totals.
+            return
+        # The row was deleted since it was created. Recreate it, letting
+        # whichever process gets there first win, then add to it.
+        try:
+            with transaction.atomic():
+                cls.objects.get_or_create(hospital_id=hospital)
+        except IntegrityError:
+            pass
+        cls.objects.filter(hospital=hospital).update(**updates)
+
+    @classmethod
+    def create_rows(cls):
+        """
+        Creates the system-wide row and each hospital's row, if they don't
+        exist yet.
+        """
+        if not cls.objects.filter(hospital__isnull=True).exists():
+            cls.objects.create()
+        cls.objects.bulk_create([
+            cls(hospital_id=pk) for pk in
+            Hospital.objects.filter(statistics__isnull=True)
+                            .values_list('pk', flat=True)])
+
+    @classmethod
+    def summary(cls, hospital):
+        """
+        Gathers everything shown on the System page for a hospital.
+        :return: A dictionary of statistics.
+        """
+        rows = dict((row.hospital_id, row) for row in
+                    cls.objects.filter(Q(hospital=hospital) |
+                                       Q(hospital__isnull=True)))
+        system = rows.get(None) or cls()
+        local = (hospital and rows.get(hospital.pk)) or cls()
+        roles = dict(User.objects.filter(current_hospital=hospital)
+                                 .values_list('role')
+                                 .annotate(count=Count('pk')))
+        # Which appointments are upcoming changes with the time rather than
+        # as rows are written, so they're counted as a range of the index
+        # on Appointment.date instead of being kept as a running total.
+        upcoming = Appointment.objects.filter(date__gte=timezone.now()).count()
+        average_stay = 0.0
+        if local.discharge_count:
+            average_stay = local.total_stay_seconds / local.discharge_count
+        average_message_count = 0
+        if system.conversation_count and system.message_count:
+            average_message_count = (float(system.message_count) /
+                                     float(system.conversation_count))
+        return {
+            "user_count": local.stay_count - local.discharge_count,
+            "stay_count": local.stay_count,
+            "discharge_count": local.discharge_count,
+            "average_stay": time.strftime('%H:%M:%S',
+                                          time.gmtime(average_stay)),
+            "patient_count": roles.get('Patient', 0),
+            "doctor_count": roles.get('Doctor', 0),
+            "nurse_count": roles.get('Nurse', 0),
+            "admin_count": system.admin_count,
+            "prescription_count": system.prescription_count,
+            "active_prescription_count": system.active_prescription_count,
+            "expired_prescription_count": (system.prescription_count -
+                                           system.active_prescription_count),
+            "appointment_count": system.appointment_count,
+            "upcoming_appointment_count": upcoming,
+            "past_appointment_count": system.appointment_count - upcoming,
+            "conversation_count": system.conversation_count,
+            "average_message_count": average_message_count,
+            "message_count": system.message_count
+        }
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def sync_user_role(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keeps User.role consistent with the user's groups whenever group
+    membership changes, from either side of the relationship.
+    """
+    if action == 'pre_clear' and reverse:
+        # The members of a cleared group aren't passed to post_clear.
+        instance._cleared_user_pks = set(
+            instance.user_set.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        instance.role = instance.role_from_groups()
+        User.objects.filter(pk=instance.pk).update(role=instance.role)
+        return
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_cleared_user_pks', set())
+    for user in User.objects.filter(pk__in=pk_set):
+        role = user.role_from_groups()
+        if user.role != role:
+            User.objects.filter(pk=user.pk).update(role=role)
+
+
+@receiver(post_save, sender=User)
+def index_search_names(sender, instance, update_fields, raw, **kwargs):
+    """
+    Reindexes a user's search names when their name or email may have
+    changed, but not when only other fields were saved, like last_login.
+    """
+    if raw:
+        return
+    if update_fields is None or SearchName.SOURCE_FIELDS & set(update_fields):
+        SearchName.index([instance])
+
+
+@receiver(post_migrate)
+def create_statistics_rows(sender, **kwargs):
+    if sender.name == 'health':
+        Statistics.create_rows()
+
+
+@receiver(post_save, sender=Hospital)
+def create_hospital_statistics(sender, instance, created, raw, **kwargs):
+    if created and not raw:
+        Statistics.objects.create(hospital=instance)
+
+
+@receiver(pre_save, sender=User)
+def remember_superuser(sender, instance, raw, update_fields, **kwargs):
+    """
+    Notes whether a user being saved was an admin before, so the admin
+    count can follow the change. Only saves that write is_superuser read
+    it back, so saving just last_login costs nothing.
+    """
+    instance._was_superuser = None
+    if raw or instance.pk is None or \
+            (update_fields is not None and 'is_superuser' not in update_fields):
+        return
+    instance._was_superuser = User.objects.filter(pk=instance.pk)\
+                                          .values_list('is_superuser', flat=True)\
+                                          .first()
+
+
+@receiver(post_save, sender=User)
+def count_admins(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    before = False if created else getattr(instance, '_was_superuser', None)
+    if before is not None and before != instance.is_superuser:
+        Statistics.record(admin_count=1 if instance.is_superuser else -1)
+
+
+@receiver(post_delete, sender=User)
+def count_deleted_admin(sender, instance, **kwargs):
+    if instance.is_superuser:
+        Statistics.record(admin_count=-1)
+
+
+@receiver(post_delete, sender=HospitalStay)
+def count_deleted_stay(sender, instance, **kwargs):
+    """
+    Removes stays deleted along with their patient from the totals.
+    """
+    changes = {'stay_count': -1}
+    if instance.discharge:
+        changes.update(discharge_count=-1, total_stay_seconds=-(
+            instance.discharge - instance.admission).total_seconds())
+    Statistics.record(instance.hospital_id, **changes)
+
+
+@receiver(post_save, sender=Prescription)
+def count_added_prescription(sender, instance, created, **kwargs):
+    if created:
+        Statistics.record(prescription_count=1,
+                          active_prescription_count=int(instance.active))
+
+
+@receiver(post_delete, sender=Prescription)
+def count_deleted_prescription(sender, instance, **kwargs):
+    Statistics.record(prescription_count=-1,
+                      active_prescription_count=-int(instance.active))
+
+
+# The system-wide Statistics counter kept for each counted model.
+STATISTICS_COUNTERS = {
+    Appointment: 'appointment_count',
+    MessageGroup: 'conversation_count',
+    Message: 'message_count',
+}
+
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_save, sender=MessageGroup)
+@receiver(post_save, sender=Message)
+def count_added_row(sender, instance, created, **kwargs):
+    if created:
+        Statistics.record(**{STATISTICS_COUNTERS[sender]: 1})
+
+
+@receiver(post_delete, sender=Appointment)
+@receiver(post_delete, sender=MessageGroup)
+@receiver(post_delete, sender=Message)
+def count_deleted_row(sender, instance, **kwargs):
+    Statistics.record(**{STATISTICS_COUNTERS[sender]: -1})
+
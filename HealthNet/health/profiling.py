@@ -0,0 +1,147 @@
+"""
+Profiles a sample of requests, and requests an administrator makes with
+`?profile=1`, with cProfile. Each profile is dumped to a directory named
+after the request's view under settings.PROFILE_DIR, which keeps only the
+newest settings.PROFILE_KEEP dumps, and the System page summarizes the
+functions with the most cumulative time in each view's dumps.
+The sample rate is set from the System page and shared with every
+process through a file in PROFILE_DIR.
+"""
+from django.conf import settings
+import os
+import pstats
+import random
+import re
+import time
+
+# How often each process rereads the sample rate, in seconds.
+RATE_REFRESH_INTERVAL = 1.0
+
+# The number of functions shown for each view on the System page.
+TOP_FUNCTIONS = 10
+
+RATE_FILE = 'sample_rate'
+
+_rate = {'directory': None, 'value': 0.0, 'read': 0.0}
+
+
+def directory():
+    return settings.PROFILE_DIR
+
+
+def view_directory(name):
+    """
+    :param name: A view name, such as 'health:home'.
+    :return: The directory the view's profiles are dumped to.
+    """
+    return os.path.join(directory(), re.sub(r'[^\w.-]', '.', name))
+
+
+def sample_rate():
+    """
+    :return: The fraction of requests to profile, rereading it at most
+             once every RATE_REFRESH_INTERVAL seconds.
+    """
+    now = time.time()
+    if _rate['directory'] != directory() or \
+            now - _rate['read'] >= RATE_REFRESH_INTERVAL:
+        try:
+            with open(os.path.join(directory(), RATE_FILE)) as f:
+                value = float(f.read())
+        except (IOError, ValueError):
+            value = 0.0
+        _rate.update(directory=directory(), value=value, read=now)
+    return _rate['value']
+
+
+def set_sample_rate(rate):
+    """
+    :param rate: The fraction of requests to profile. 0 stops profiling.
+    """
+    os.makedirs(directory(), exist_ok=True)
+    path = os.path.join(directory(), RATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        f.write(repr(rate))
+    os.replace(path + '.tmp', path)
+    _rate['read'] = 0.0
+
+
+def should_profile(request):
+    if 'profile' in request.GET and request.user.is_superuser:
+        return True
+    rate = sample_rate()
+    return rate > 0 and random.random() < rate
+
+
+def save(profile, name):
+    """
+    Dumps a profile to the view's directory, then deletes all but the
+    newest PROFILE_KEEP dumps there.
+    """
+    path = view_directory(name)
+    os.makedirs(path, exist_ok=True)
+    filename = os.path.join(path, '%016d-%d.prof' % (time.time() * 1000000,
+                                                      os.getpid()))
+    profile.dump_stats(filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
+    dumps = sorted(dump for dump in os.listdir(path) if dump.endswith('.prof'))
+    for old in dumps[:-getattr(settings, 'PROFILE_KEEP', 20)]:
+        try:
+            os.remove(os.path.join(path, old))
+        except OSError:
+            # Another process already removed it.
+            pass
+
+
+def load(path):
+    """
+    :return: The combined statistics of every dump in a view's directory,
+             and the number of dumps read.
+    """
+    stats = None
+    count = 0
+    for name in sorted(os.listdir(path)):
+        if not name.endswith('.prof'):
+            continue
+        try:
+            if stats is None:
+                stats = pstats.Stats(os.path.join(path, name))
+            else:
+                stats.add(os.path.join(path, name))
+            count += 1
+        except (IOError, EOFError, ValueError):
+            # Removed from the ring while it was being read.
+            continue
+    return stats, count
+
+
+def summary(limit=TOP_FUNCTIONS):
+    """
+    :return: A list of dictionaries describing each profiled view and the
+             `limit` functions with the most cumulative time in it, sorted
+             by view name.
+    """
+    if not os.path.isdir(directory()):
+        return []
+    views = []
+    for name in sorted(os.listdir(directory())):
+        path = os.path.join(directory(), name)
+        if not os.path.isdir(path):
+            continue
+        stats, count = load(path)
+        if not count:
+            continue
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][3],
+                           reverse=True)[:limit]
+        views.append({
+            'name': name,
+            'count': count,
+            'functions': [{
+                'function': pstats.func_std_string(function),
+                'calls': calls,
+                'own_ms': round(own * 1000 / count, 2),
+                'cumulative_ms': round(cumulative * 1000 / count, 2),
+            } for function, (primitive, calls, own, cumulative, callers)
+                in functions],
+        })
+    return views
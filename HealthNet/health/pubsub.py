@@ -0,0 +1,165 @@
+"""
+An in-process publish/subscribe channel that pushes new messages and
+unread counts to users connected to the event stream, so their pages
+don't have to poll for them. Each server process has its own broker, and
+subscribers only receive events published by the process serving them, so
+pages keep polling slowly while their stream is open to pick up what the
+other processes publish.
+"""
+from django.conf import settings
+from .models import User, Membership
+import json
+import queue
+import threading
+
+# The most events queued for a subscriber. Events published to a full
+# queue are dropped; the next unread event corrects the subscriber's count.
+QUEUE_SIZE = 100
+
+
+def format_event(event, data):
+    """
+    :return: The event in the text/event-stream format.
+    """
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
+
+
+class Subscription(object):
+    def __init__(self, broker, user_id):
+        self.broker = broker
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+
+    def get(self, timeout):
+        """
+        :return: The next (event, data) tuple published to the subscriber.
+        :raises queue.Empty: If nothing was published within `timeout`
+                             seconds.
+        """
+        return self.queue.get(timeout=timeout)
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class Broker(object):
+    """
+    Delivers events to the subscriptions of the users they're published
+    to, and bounds the number of subscriptions a process holds open at
+    settings.EVENT_STREAM_MAX_CONNECTIONS.
+    """
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        """
+        :return: A new Subscription, or None if the process already has
+                 as many subscriptions as it allows.
+        """
+        with self._lock:
+            if self._count >= settings.EVENT_STREAM_MAX_CONNECTIONS:
+                return None
+            subscription = Subscription(self, user_id)
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+            self._count += 1
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id, set())
+            if subscription not in subscriptions:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.user_id]
+            self._count -= 1
+
+    def subscriber_count(self):
+        return self._count
+
+    def subscribed(self, user_ids):
+        """
+        :return: The ids in `user_ids` that have at least one subscription.
+        """
+        with self._lock:
+            return [user_id for user_id in user_ids
+                    if user_id in self._subscriptions]
+
+    def publish(self, user_id, event, data):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait((event, data))
+            except queue.Full:
+                pass
+
+
+broker = Broker()
+
+
+def publish_message(message):
+    """
+    Publishes a new message, and the new unread count of each member of
+    its conversation, to the members who are subscribed. Makes no queries
+    if nobody is subscribed to this process.
+    """
+    if not broker.subscriber_count():
+        return
+    member_ids = Membership.objects.filter(group_id=message.group_id)\
+                                   .values_list('user_id', flat=True)
+    subscribed = broker.subscribed(list(member_ids))
+    if not subscribed:
+        return
+    counts = User.unread_message_counts(subscribed)
+    data = message.json_object()
+    data['group_id'] = message.group_id
+    for user_id in subscribed:
+        broker.publish(user_id, 'message', data)
+        broker.publish(user_id, 'unread', {'count': counts[user_id]})
+
+
+def publish_unread(user_id):
+    """
+    Publishes the user's unread count to them if they're subscribed, so
+    the badges in their other pages go down when they read a conversation.
+    Makes no queries if they aren't subscribed to this process.
+    """
+    if not broker.subscribed([user_id]):
+        return
+    count = User.unread_message_counts([user_id])[user_id]
+    broker.publish(user_id, 'unread', {'count': count})
+
+
+class EventStream(object):
+    """
+    The body of an event stream response: the initial events, then each
+    event published to the subscription, with a comment sent whenever the
+    stream has been idle for settings.EVENT_STREAM_HEARTBEAT seconds so
+    proxies keep the connection open and closed clients are noticed.
+    Django closes the stream when the response is closed, which ends the
+    subscription.
+    """
+
+    def __init__(self, subscription, initial=()):
+        self.subscription = subscription
+        self.initial = initial
+
+    def __iter__(self):
+        yield 'retry: %d\n\n' % (settings.EVENT_STREAM_HEARTBEAT * 1000)
+        for event, data in self.initial:
+            yield format_event(event, data)
+        while True:
+            try:
+                event, data = self.subscription.get(
+                    settings.EVENT_STREAM_HEARTBEAT)
+            except queue.Empty:
+                yield ': heartbeat\n\n'
+                continue
+            yield format_event(event, data)
+
+    def close(self):
+        self.subscription.close()
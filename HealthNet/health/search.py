@@ -0,0 +1,184 @@
+"""
+Full-text search over the messages in a user's conversations. On SQLite
+an FTS5 index of message bodies, kept in sync with the message table by
+triggers, answers searches ranked by bm25 with highlighted snippets.
+Other databases, and SQLite builds without FTS5, fall back to matching
+every term with `icontains`, newest first.
+"""
+from django.db import connections, DatabaseError
+from django.db.models.signals import post_migrate
+from django.dispatch import receiver
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from .models import Message, Membership
+import re
+
+# The number of results shown on each page.
+PAGE_SIZE = 20
+
+# The number of words around the matches in each snippet.
+SNIPPET_WORDS = 16
+
+INDEX_TABLE = 'health_message_fts'
+
+# Marks the matches in FTS5 snippets before they're escaped as HTML.
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+TRIGGERS = (
+    ('health_message_fts_insert', 'AFTER INSERT', '''
+        INSERT INTO {index}(rowid, body) VALUES (new.id, new.body);'''),
+    ('health_message_fts_delete', 'AFTER DELETE', '''
+        INSERT INTO {index}({index}, rowid, body)
+        VALUES ('delete', old.id, old.body);'''),
+    ('health_message_fts_update', 'AFTER UPDATE OF body', '''
+        INSERT INTO {index}({index}, rowid, body)
+        VALUES ('delete', old.id, old.body);
+        INSERT INTO {index}(rowid, body) VALUES (new.id, new.body);'''),
+)
+
+# Whether each database has the index, by alias.
+_has_index = {}
+
+
+@receiver(post_migrate)
+def create_index(sender, using='default', **kwargs):
+    """
+    Creates the message index and the triggers that maintain it, and
+    indexes every existing message, if the index doesn't exist yet.
+    """
+    connection = connections[using]
+    if sender.name != 'health' or connection.vendor != 'sqlite':
+        return
+    table = Message._meta.db_table
+    with connection.cursor() as cursor:
+        if INDEX_TABLE in connection.introspection.table_names(cursor):
+            _has_index[using] = True
+            return
+        try:
+            cursor.execute(
+                "CREATE VIRTUAL TABLE %s USING fts5(body, content='%s', "
+                "content_rowid='id')" % (INDEX_TABLE, table))
+        except DatabaseError:
+            # This SQLite wasn't built with FTS5.
+            _has_index[using] = False
+            return
+        for name, when, statements in TRIGGERS:
+            cursor.execute('CREATE TRIGGER %s %s ON %s BEGIN %s END' % (
+                name, when, table, statements.format(index=INDEX_TABLE)))
+        cursor.execute("INSERT INTO %s(%s) VALUES ('rebuild')" % (
+            INDEX_TABLE, INDEX_TABLE))
+    _has_index[using] = True
+
+
+def has_index(using='default'):
+    if using not in _has_index:
+        connection = connections[using]
+        _has_index[using] = connection.vendor == 'sqlite' and \
+            INDEX_TABLE in connection.introspection.table_names()
+    return _has_index[using]
+
+
+def terms(query):
+    """
+    :return: The words in a search, lowercased.
+    """
+    return re.findall(r'\w+', query.lower())
+
+
+def match_expression(words):
+    """
+    Quotes each word so FTS5 treats it as a term rather than syntax, and
+    matches the last word as a prefix so results appear while typing.
+    """
+    quoted = ['"%s"' % word for word in words]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def highlight(snippet):
+    """
+    :return: The snippet as HTML, with the matches wrapped in <mark>.
+    """
+    return mark_safe(escape(snippet).replace(MATCH_START, '<mark>')
+                                    .replace(MATCH_END, '</mark>'))
+
+
+def fallback_snippet(body, words):
+    """
+    Builds a snippet of the words around the first match, for databases
+    without the index.
+    """
+    body_words = body.split()
+    first = 0
+    for i, word in enumerate(body_words):
+        if any(term in word.lower() for term in words):
+            first = i
+            break
+    start = max(0, first - SNIPPET_WORDS // 2)
+    snippet = ' '.join(body_words[start:start + SNIPPET_WORDS])
+    pattern = re.compile('(%s)' % '|'.join(re.escape(word) for word in words),
+                         re.IGNORECASE)
+    snippet = pattern.sub(MATCH_START + r'\1' + MATCH_END, snippet)
+    if start > 0:
+        snippet = '...' + snippet
+    if start + SNIPPET_WORDS < len(body_words):
+        snippet += '...'
+    return highlight(snippet)
+
+
+def ranked_ids(user, words, offset, limit):
+    """
+    :return: A list of (message id, snippet) tuples from the index, best
+             match first.
+    """
+    connection = connections['default']
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT message.id, snippet({index}, 0, %s, %s, %s, %s) '
+            'FROM {index} '
+            'JOIN {messages} message ON message.id = {index}.rowid '
+            'JOIN {memberships} membership '
+            'ON membership.group_id = message.group_id '
+            'WHERE {index} MATCH %s AND membership.user_id = %s '
+            'ORDER BY bm25({index}), message.id DESC '
+            'LIMIT %s OFFSET %s'.format(
+                index=INDEX_TABLE, messages=Message._meta.db_table,
+                memberships=Membership._meta.db_table),
+            [MATCH_START, MATCH_END, '...', SNIPPET_WORDS,
+             match_expression(words), user.pk, limit, offset])
+        return [(pk, highlight(snippet)) for pk, snippet in cursor.fetchall()]
+
+
+def search(user, query, page=1):
+    """
+    Searches the messages in the user's conversations.
+    :param user: The user searching.
+    :param query: The words to search for. Every word must match.
+    :param page: The page of results, starting from 1.
+    :return: A tuple containing a list of up to PAGE_SIZE messages with a
+             `snippet` attribute, and whether there are more results.
+    """
+    words = terms(query)
+    if not words:
+        return [], False
+    offset = (page - 1) * PAGE_SIZE
+    if has_index():
+        ranked = ranked_ids(user, words, offset, PAGE_SIZE + 1)
+        messages = Message.objects.select_related('sender', 'group')\
+                                  .in_bulk([pk for pk, snippet in ranked])
+        results = []
+        for pk, snippet in ranked[:PAGE_SIZE]:
+            message = messages[pk]
+            message.snippet = snippet
+            results.append(message)
+        return results, len(ranked) > PAGE_SIZE
+
+    messages = Message.objects.select_related('sender', 'group')\
+                              .filter(group__membership__user=user)
+    for word in words:
+        messages = messages.filter(body__icontains=word)
+    messages = list(messages.order_by('-id')[offset:offset + PAGE_SIZE + 1])
+    for message in messages:
+        message.snippet = fallback_snippet(message.body, words)
+    return messages[:PAGE_SIZE], len(messages) > PAGE_SIZE
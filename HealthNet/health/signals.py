@@ -0,0 +1,35 @@
+"""
+Signals sent by the views when users do something worth recording in the
+activity log. Every signal provides the acting `user` and the `id` of the
+object acted upon, and is sent with the object's model as the sender.
+Logins and logouts use django.contrib.auth's signals.
+"""
+from django.dispatch import Signal
+
+user_login_attempt = Signal(providing_args=['username', 'result'])
+user_sign_up_attempt = Signal(providing_args=['username', 'email', 'result'])
+user_signed_up = Signal(providing_args=['user', 'id', 'email'])
+user_edit_profile = Signal(providing_args=['user', 'id'])
+edits_patient_profile = Signal(providing_args=['user', 'id'])
+exports_patient_information = Signal(providing_args=['user', 'id'])
+
+doc_adds_prescription = Signal(providing_args=['user', 'id'])
+doc_edits_prescription = Signal(providing_args=['user', 'id'])
+doc_deleted_prescription = Signal(providing_args=['user', 'id'])
+
+add_appointment = Signal(providing_args=['user', 'id'])
+edits_appointment = Signal(providing_args=['user', 'id'])
+deleted_appointment = Signal(providing_args=['user', 'id'])
+
+hospital_transferred_patient = Signal(providing_args=['user', 'id',
+                                                      'hospital'])
+
+doc_discharges_patient = Signal(providing_args=['user', 'id'])
+
+# HealthNet has no views yet for changing a password, releasing test
+# results, extending a stay or uploading a doctor's update, so nothing
+# sends these. The activity log records them once something does.
+password_changed = Signal(providing_args=['user', 'id'])
+doc_releases_test_results = Signal(providing_args=['user', 'id'])
+extended_stay_for_patient = Signal(providing_args=['user', 'id'])
+doc_uploads_update = Signal(providing_args=['user', 'id'])
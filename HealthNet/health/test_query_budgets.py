@@ -0,0 +1,129 @@
+from django.contrib.admin.models import LogEntry, CHANGE
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from datetime import date, timedelta
+from .models import *
+from .tests import ScratchActivityLog
+from io import StringIO
+
+# The most queries each view may make for each role, no matter how much
+# data there is. `{group}` is replaced with one of the user's
+# conversations.
+BUDGETS = {
+    '/': {'admin': 7, 'doctor': 7, 'nurse': 6, 'patient': 8},
+    '/messages/': {'admin': 8, 'doctor': 8, 'nurse': 8, 'patient': 8},
+    '/messages/{group}/': {'doctor': 12, 'nurse': 12, 'patient': 12},
+    '/schedule/': {'admin': 9, 'doctor': 9, 'nurse': 9, 'patient': 9},
+    '/add_appointment/': {'admin': 6, 'doctor': 6, 'nurse': 6, 'patient': 6},
+    '/prescriptions/': {'admin': 6, 'doctor': 6, 'nurse': 6, 'patient': 6},
+    '/users/': {'admin': 8, 'doctor': 8, 'nurse': 8, 'patient': 8},
+    '/users/me/': {'admin': 11, 'doctor': 7, 'nurse': 7, 'patient': 9},
+    '/users/me/info.json': {'admin': 8, 'doctor': 7, 'nurse': 7,
+                            'patient': 7},
+    '/logs/': {'admin': 11},
+}
+
+
+class QueryBudgetTestCase(ScratchActivityLog, TestCase):
+    """
+    Renders every view as each role with a small amount of data and then
+    with ten times as much, and checks that the number of queries stays
+    the same and within its budget.
+    """
+
+    def setUp(self):
+        call_command('populatedb', stdout=StringIO())
+        self.users = {
+            'admin': User.objects.get(username='admin'),
+            'doctor': User.objects.get(email='turk@sacredheart.org'),
+            'nurse': User.objects.get(email='carla@sacredheart.org'),
+            'patient': User.objects.get(email='duwayne@theroc-johnson.com'),
+        }
+        self.hospital = self.users['doctor'].hospital()
+        self.patient_group = Group.objects.get(name='Patient')
+        self.created = 0
+
+    def _grow(self, count):
+        """
+        Adds `count` patients to the hospital, each with appointments,
+        prescriptions, a conversation with every role, and audit log
+        entries.
+        """
+        doctor = self.users['doctor']
+        content_type = ContentType.objects.get_for_model(User)
+        now = timezone.now()
+        for i in range(count):
+            self.created += 1
+            email = 'patient%d@example.com' % self.created
+            patient = User.objects.create_user(
+                email, email=email, password='p@ssword', phone_number='0',
+                first_name='Patient', last_name=str(self.created),
+                date_of_birth=date(1990, 1, 1))
+            self.patient_group.user_set.add(patient)
+            self.hospital.admit(patient)
+            for user in (patient, self.users['patient']):
+                for days in (-self.created, self.created):
+                    Appointment.objects.create(
+                        patient=user, doctor=doctor, duration=30,
+                        date=now + timedelta(days=days, minutes=i))
+                Prescription.objects.create(
+                    patient=user, name='Tylenol', dosage='1',
+                    directions='Daily', prescribed=now, active=True)
+            group = MessageGroup.objects.create(name='Group %d' % self.created)
+            group.add_members([patient] + list(self.users.values()))
+            for user in self.users.values():
+                Message.objects.create(group=group, sender=user,
+                                       body='Hello', date=now)
+            LogEntry.objects.log_action(doctor.pk, content_type.pk,
+                                        patient.pk, repr(patient), CHANGE,
+                                        'Changed fields.')
+
+    def _count_queries(self):
+        """
+        :return: A dictionary of (path, role) to the list of queries the
+                 view made.
+        """
+        queries = {}
+        for path, budgets in sorted(BUDGETS.items()):
+            for role in sorted(budgets):
+                user = self.users[role]
+                group = Membership.objects.filter(user=user)\
+                                          .order_by('-group_id')\
+                                          .values_list('group_id', flat=True)\
+                                          .first()
+                self.client.login(username=user.username,
+                                  password='p@ssword')
+                url = path.format(group=group)
+                with CaptureQueriesContext(connection) as captured:
+                    response = self.client.get(url)
+                    if response.streaming:
+                        b''.join(response.streaming_content)
+                self.assertEqual(response.status_code, 200,
+                                 '%s as %s' % (url, role))
+                queries[(path, role)] = [query['sql'] for query in
+                                         captured.captured_queries]
+                self.client.logout()
+        return queries
+
+    def test_views_make_a_constant_number_of_queries(self):
+        self._grow(3)
+        small = self._count_queries()
+        self._grow(27)
+        large = self._count_queries()
+        failures = []
+        for (path, role), queries in sorted(large.items()):
+            budget = BUDGETS[path][role]
+            if len(queries) != len(small[(path, role)]) or \
+                    len(queries) > budget:
+                failures.append('%s as %s made %d queries with less data, '
+                                '%d with more, and has a budget of %d:\n%s' % (
+                                    path, role, len(small[(path, role)]),
+                                    len(queries), budget,
+                                    '\n'.join('    ' + sql
+                                              for sql in queries)))
+        if failures:
+            self.fail('\n\n'.join(failures))
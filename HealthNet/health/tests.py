@@ -1,9 +1,56 @@
-from django.test import TestCase
+from django.test import Client, TestCase, TransactionTestCase, RequestFactory
+from django.test.utils import override_settings
+from django.db import connection, transaction, IntegrityError
+from django.http import HttpResponse
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command, CommandError
+from io import StringIO
+import gzip
+import hashlib
+import json
+import logging.handlers
+import os
+import tempfile
+import threading
+import time
 import datetime
+from datetime import timedelta
 from .models import *
+from .middleware import AuditLogMiddleware, UserContext
+from . import activitylog, auditlog, changefeed, form_utilities, instrumentation
+from . import profiling, pubsub, search
+from django.contrib.admin.models import LogEntry, CHANGE
+from django.contrib.contenttypes.models import ContentType
 
 
-class UserTestCase(TestCase):
+class ScratchActivityLog(object):
+    """
+    Writes the activity log to a scratch file while a test class runs, so
+    tests stay out of the real one however they're run.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.activity_log_file = os.path.join(
+            tempfile.gettempdir(),
+            'healthnet_test_activity_%d_%s.log' % (os.getpid(), cls.__name__))
+        cls._activity_log = override_settings(
+            ACTIVITY_LOG_FILE=cls.activity_log_file)
+        cls._activity_log.enable()
+        super(ScratchActivityLog, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(ScratchActivityLog, cls).tearDownClass()
+        # Write out buffered events before the real file comes back.
+        for handler in activitylog.logger.handlers:
+            handler.flush()
+        cls._activity_log.disable()
+        for path in activitylog.log_files(cls.activity_log_file):
+            os.remove(path)
+
+
+class UserTestCase(ScratchActivityLog, TestCase):
 
     def setUp(self):
         """
@@ -90,4 +137,1013 @@ class UserTestCase(TestCase):
     def test_can_add_prescription(self):
         self.assertTrue(self.doctor.can_add_prescription())
         self.assertFalse(self.patient.can_add_prescription())
-        self.assertFalse(self.nurse.can_add_prescription())
\ No newline at end of file
+        self.assertFalse(self.nurse.can_add_prescription())
+
+    def test_request_context_memoizes_user_facts(self):
+        patient = User.objects.get(pk=self.patient.pk)
+        patient.request_context = UserContext()
+        with self.assertNumQueries(3):
+            for _ in range(3):
+                self.assertTrue(patient.is_patient())
+                self.assertFalse(patient.is_doctor())
+                self.assertIsNotNone(patient.hospital())
+                self.assertEqual(patient.unread_message_count(), 0)
+
+    def test_role_tracks_groups(self):
+        doctors = Group.objects.get(name='Doctor')
+        nurses = Group.objects.get(name='Nurse')
+        self.nurse.groups.clear()
+        self.assertEqual(User.objects.get(pk=self.nurse.pk).role, '')
+        doctors.user_set.add(self.nurse)
+        self.assertEqual(User.objects.get(pk=self.nurse.pk).role, 'Doctor')
+        doctors.user_set.clear()
+        self.assertEqual(User.objects.get(pk=self.doctor.pk).role, '')
+        self.nurse.groups.add(nurses)
+        self.assertTrue(self.nurse.is_nurse())
+
+    def test_nurses_only_edit_users_at_their_hospital(self):
+        self.assertTrue(self.nurse.can_edit_user(self.patient))
+        User.objects.filter(pk__in=[self.nurse.pk, self.patient.pk])\
+                    .update(current_hospital=None)
+        nurse = User.objects.get(pk=self.nurse.pk)
+        self.assertFalse(nurse.can_edit_user(
+            User.objects.get(pk=self.patient.pk)))
+        self.assertTrue(nurse.can_edit_user(nurse))
+
+    def test_syncroles_repairs_stale_roles(self):
+        User.objects.filter(pk=self.patient.pk).update(role='Doctor')
+        call_command('syncroles', stdout=StringIO())
+        self.assertEqual(User.objects.get(pk=self.patient.pk).role, 'Patient')
+
+    def _start_conversations(self, count):
+        for i in range(count):
+            group = MessageGroup.objects.create(name="Conversation %d" % i)
+            group.add_members([self.patient, self.doctor, self.nurse])
+            for sender in [self.patient, self.doctor]:
+                Message.objects.create(sender=sender, group=group,
+                                       body="Hello", date=timezone.now())
+
+    def test_inbox_query_count_is_constant(self):
+        self.client.login(username=self.patient.email, password="p@ssword")
+        self._start_conversations(2)
+        with self.assertNumQueries(8):
+            self.client.get('/messages/')
+        self._start_conversations(20)
+        with self.assertNumQueries(8):
+            response = self.client.get('/messages/')
+        groups = response.context['groups']
+        self.assertEqual(len(groups), 22)
+        self.assertTrue(all(group.has_unread for group in groups))
+        self.assertEqual(groups[0].latest_message().sender, self.doctor)
+
+    def test_inbox_orders_and_previews_by_the_newest_message(self):
+        self._start_conversations(2)
+        first, second = MessageGroup.objects.order_by('pk')
+        # A message written last but dated earlier, as populatedb makes.
+        Message.objects.create(sender=self.nurse, group=first, body="Late",
+                               date=timezone.now() - timedelta(days=1))
+        groups = self.patient.inbox()
+        self.assertEqual(groups[0], first)
+        self.assertEqual(groups[0].latest_message().body, "Late")
+        self.assertEqual(first.latest_message().body, "Late")
+
+    def test_read_watermarks(self):
+        self._start_conversations(2)
+        self.assertEqual(self.nurse.unread_message_count(), 4)
+        group = MessageGroup.objects.first()
+        self.assertEqual(group.mark_read(self.nurse), 1)
+        self.assertEqual(group.mark_read(self.nurse), 0)
+        self.assertEqual(self.nurse.unread_message_count(), 2)
+        Message.objects.create(sender=self.doctor, group=group,
+                               body="One more thing", date=timezone.now())
+        self.assertEqual(self.nurse.unread_message_count(), 3)
+
+    def test_conversation_renders_recent_window(self):
+        self._start_conversations(1)
+        group = MessageGroup.objects.get()
+        for i in range(60):
+            Message.objects.create(sender=self.doctor, group=group,
+                                   body="Message %d" % i, date=timezone.now())
+        self.client.login(username=self.patient.email, password="p@ssword")
+        response = self.client.get('/messages/%d/' % group.pk)
+        messages = response.context['messages']
+        self.assertEqual(len(messages), 50)
+        self.assertTrue(response.context['has_older'])
+        self.assertEqual(messages[-1].body, "Message 59")
+        self.assertEqual(self.patient.unread_message_count(), 0)
+        self.assertTrue(response.context['poll'])
+        response = self.client.get('/messages/%d/?before=%d' %
+                                   (group.pk, messages[0].pk))
+        self.assertEqual(len(response.context['messages']), 12)
+        self.assertFalse(response.context['has_older'])
+        self.assertFalse(response.context['poll'])
+        self.assertNotContains(response, 'updates.json')
+
+        # Polling from the newest window only picks up what's new since.
+        cursor = self.client.get('/messages/%d/' % group.pk).context['cursor']
+        Message.objects.create(sender=self.doctor, group=group,
+                               body="Message 60", date=timezone.now())
+        updates = json.loads(self.client.get(
+            '/messages/%d/updates.json' % group.pk,
+            {'after': cursor}).content.decode())
+        self.assertEqual([message['body'] for message in updates['messages']],
+                         ["Message 60"])
+
+    def test_conversation_updates_return_new_messages(self):
+        self._start_conversations(1)
+        group = MessageGroup.objects.get()
+        self.client.login(username=self.patient.email, password="p@ssword")
+        cursor = self.client.get('/messages/%d/' % group.pk).context['cursor']
+        url = '/messages/%d/updates.json' % group.pk
+        self.assertEqual(json.loads(self.client.get(
+            url, {'after': cursor}).content.decode()),
+            {'messages': [], 'cursor': cursor, 'has_more': False})
+        for i in range(55):
+            Message.objects.create(sender=self.doctor, group=group,
+                                   body="Message %d" % i, date=timezone.now())
+        self.assertEqual(self.patient.unread_message_count(), 55)
+        updates = json.loads(self.client.get(
+            url, {'after': cursor}).content.decode())
+        self.assertEqual(len(updates['messages']), 50)
+        self.assertTrue(updates['has_more'])
+        self.assertEqual(updates['messages'][0]['body'], "Message 0")
+        self.assertEqual(updates['messages'][0]['sender_id'], self.doctor.pk)
+        updates = json.loads(self.client.get(
+            url, {'after': updates['cursor']}).content.decode())
+        self.assertEqual([message['body'] for message in updates['messages']],
+                         ["Message %d" % i for i in range(50, 55)])
+        self.assertFalse(updates['has_more'])
+        self.assertEqual(self.patient.unread_message_count(), 0)
+        self.assertEqual(self.client.get(url, {'after': 'x'}).status_code, 400)
+        self.client.login(username="admin", password="p@ssword")
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_is_free_only_checks_overlapping_appointments(self):
+        start = timezone.now()
+        for i in range(1, 50):
+            Appointment.objects.create(doctor=self.doctor, patient=self.patient,
+                                       date=start - timedelta(hours=i),
+                                       duration=30)
+        Appointment.objects.create(doctor=self.doctor, patient=self.patient,
+                                   date=start, duration=30)
+        self.doctor.request_context = UserContext()
+        self.doctor.is_doctor()
+        with self.assertNumQueries(1):
+            self.assertFalse(self.doctor.is_free(start + timedelta(minutes=15), 30))
+        self.assertFalse(self.doctor.is_free(start - timedelta(minutes=15), 30))
+        self.assertTrue(self.doctor.is_free(start + timedelta(minutes=30), 30))
+        self.assertTrue(self.patient.is_free(start - timedelta(minutes=30), 30))
+        self.assertTrue(self.nurse.is_free(start, 30))
+
+    def test_rejected_edit_keeps_original_appointment(self):
+        start = timezone.now()
+        first = Appointment.objects.create(doctor=self.doctor,
+                                           patient=self.patient,
+                                           date=start, duration=30)
+        Appointment.objects.create(doctor=self.doctor, patient=self.patient,
+                                   date=start + timedelta(hours=1),
+                                   duration=30)
+        first.date = start + timedelta(minutes=45)
+        self.assertIsNotNone(first.book())
+        self.assertEqual(Appointment.objects.get(pk=first.pk).date, start)
+        first.date = start + timedelta(minutes=15)
+        self.assertIsNone(first.book())
+        self.assertEqual(Appointment.objects.count(), 2)
+
+    def test_syncappointments_repairs_end_dates(self):
+        start = timezone.now()
+        appointment = Appointment.objects.create(
+            doctor=self.doctor, patient=self.patient, date=start, duration=45)
+        Appointment.objects.filter(pk=appointment.pk).update(end_date=start)
+        self.assertTrue(self.doctor.is_free(start + timedelta(minutes=15), 30))
+        out = StringIO()
+        call_command('syncappointments', stdout=out)
+        self.assertIn('Updated the end date of 1 appointment.', out.getvalue())
+        self.assertEqual(Appointment.objects.get(pk=appointment.pk).end_date,
+                         start + timedelta(minutes=45))
+        self.assertFalse(self.doctor.is_free(start + timedelta(minutes=15), 30))
+
+    def test_free_slots_sweep_both_schedules(self):
+        start = timezone.now().replace(minute=0, second=0, microsecond=0)
+        other_patient = User.objects.create_user(
+            "elliot@sacredheart.org", password="p@ssword",
+            phone_number="18005553333",
+            date_of_birth=datetime.date(year=1980, month=6, day=7))
+        Group.objects.get(name="Patient").user_set.add(other_patient)
+        Appointment.objects.create(doctor=self.doctor, patient=other_patient,
+                                   date=start + timedelta(minutes=30),
+                                   duration=30)
+        Appointment.objects.create(doctor=self.doctor, patient=other_patient,
+                                   date=start + timedelta(minutes=90),
+                                   duration=15)
+        Appointment.objects.create(doctor=self.nurse, patient=self.patient,
+                                   date=start + timedelta(minutes=150),
+                                   duration=30)
+        slots = self.doctor.free_slots(start, start + timedelta(hours=4), 30,
+                                       other=self.patient)
+        self.assertEqual([slot_start - start for slot_start, _ in slots],
+                         [timedelta(minutes=m) for m in (0, 60, 105, 180, 210)])
+
+        self.client.login(username=self.patient.email, password="p@ssword")
+        response = self.client.get('/appointments/free.json', {
+            'doctor': self.doctor.pk,
+            'patient': self.patient.pk,
+            'start': timezone.localtime(start).replace(tzinfo=None).isoformat(),
+            'end': timezone.localtime(start + timedelta(hours=4))
+                           .replace(tzinfo=None).isoformat(),
+        })
+        self.assertEqual(len(json.loads(response.content.decode())), 5)
+        response = self.client.get('/appointments/free.json', {'doctor': 'me'})
+        self.assertEqual(response.status_code, 400)
+
+        # Slots are capped, earliest first, however short they are.
+        week = {'doctor': self.doctor.pk, 'duration': 1,
+                'start': timezone.localtime(start).replace(tzinfo=None)
+                                 .isoformat()}
+        slots = json.loads(self.client.get('/appointments/free.json',
+                                           week).content.decode())
+        self.assertEqual(len(slots), 100)
+        self.assertEqual(slots[0]['start'],
+                         timezone.localtime(start).isoformat())
+
+        # Another patient's busy times are only visible to staff at their
+        # hospital.
+        week['patient'] = other_patient.pk
+        response = self.client.get('/appointments/free.json', week)
+        self.assertEqual(response.status_code, 403)
+        week['patient'] = self.patient.pk
+        self.client.login(username=self.nurse.email, password="p@ssword")
+        self.assertEqual(self.client.get('/appointments/free.json',
+                                         week).status_code, 200)
+        Hospital.objects.get(name="Highland Hospital").admit(self.patient)
+        self.assertEqual(self.client.get('/appointments/free.json',
+                                         week).status_code, 403)
+
+
+    def test_current_hospital_follows_admissions(self):
+        h2 = Hospital.objects.get(name="RIT Health Center")
+        h2.admit(self.patient)
+        self.assertEqual(self.patient.hospital(), h2)
+        self.assertEqual(User.objects.get(pk=self.patient.pk).current_hospital, h2)
+        self.assertEqual(HospitalStay.objects.filter(patient=self.patient,
+                                                     discharge__isnull=True).count(), 1)
+        h2.discharge(self.patient)
+        self.assertIsNone(User.objects.get(pk=self.patient.pk).hospital())
+        User.objects.filter(pk=self.doctor.pk).update(current_hospital=None)
+        call_command('synchospitals', stdout=StringIO())
+        self.assertEqual(User.objects.get(pk=self.doctor.pk).hospital().name,
+                         "University of Rochester Medical Center")
+
+    def test_statistics_match_a_rebuild(self):
+        self._start_conversations(3)
+        h = self.patient.hospital()
+        Hospital.objects.get(name="Highland Hospital").admit(self.patient)
+        h.admit(self.patient)
+        for active in [True, True, False]:
+            Prescription.objects.create(patient=self.patient, name="Tylenol",
+                                        dosage="1", directions="Daily",
+                                        prescribed=timezone.now(),
+                                        active=active)
+        Prescription.objects.first().deactivate()
+        Appointment.objects.create(doctor=self.doctor, patient=self.patient,
+                                   date=timezone.now(), duration=30)
+        Message.objects.first().delete()
+        incremental = Statistics.summary(h)
+        call_command('rebuildstats', stdout=StringIO())
+        self.assertEqual(incremental, Statistics.summary(h))
+        self.assertEqual(incremental['stay_count'], 7)
+        self.assertEqual(incremental['user_count'], 6)
+        self.assertEqual(incremental['active_prescription_count'], 1)
+        self.assertEqual(incremental['message_count'], 5)
+        with self.assertNumQueries(3):
+            Statistics.summary(h)
+
+    def test_statistics_follow_admins_and_deleted_stays(self):
+        h = self.patient.hospital()
+        admins = Statistics.summary(h)['admin_count']
+        self.assertEqual(admins, User.objects.filter(is_superuser=True).count())
+        self.doctor.is_superuser = True
+        self.doctor.save()
+        self.doctor.save()
+        self.assertEqual(Statistics.summary(h)['admin_count'], admins + 1)
+        # Saves that don't write is_superuser don't read it back.
+        with self.assertNumQueries(1):
+            self.doctor.save(update_fields=['last_login'])
+        User.objects.get(pk=self.doctor.pk).delete()
+        self.assertEqual(Statistics.summary(h)['admin_count'], admins)
+
+        Hospital.objects.get(name="Highland Hospital").admit(self.patient)
+        h.admit(self.patient)
+        User.objects.get(pk=self.patient.pk).delete()
+        incremental = Statistics.summary(h)
+        call_command('rebuildstats', stdout=StringIO())
+        self.assertEqual(incremental, Statistics.summary(h))
+
+    def test_statistics_rows_exist_before_anything_is_recorded(self):
+        hospital = Hospital.objects.create(name="Strong Memorial")
+        self.assertTrue(Statistics.objects.filter(hospital=hospital).exists())
+        self.assertTrue(Statistics.objects.filter(hospital__isnull=True)
+                                          .exists())
+        Statistics.objects.filter(hospital=hospital).delete()
+        Statistics.record(hospital, stay_count=2)
+        Statistics.record(hospital, stay_count=1)
+        self.assertEqual(Statistics.objects.get(hospital=hospital).stay_count, 3)
+        pk = hospital.pk
+        hospital.delete()
+        self.assertFalse(Statistics.objects.filter(hospital_id=pk).exists())
+
+    def test_audit_log_pages_and_filters(self):
+        content_type = ContentType.objects.get_for_model(User)
+        for i in range(120):
+            user = self.doctor if i % 2 else self.nurse
+            LogEntry.objects.log_action(user.pk, content_type.pk, self.patient.pk,
+                                        repr(self.patient), CHANGE, "Change %d" % i)
+        seen = []
+        cursor = None
+        while True:
+            entries, cursor = auditlog.page(
+                auditlog.filtered_entries({'user': str(self.doctor.pk)}), cursor)
+            seen.extend(entry.change_message for entry in entries)
+            if cursor is None:
+                break
+        self.assertEqual(seen, ["Change %d" % i for i in range(119, 0, -2)])
+
+        self.client.login(username="admin", password="p@ssword")
+        response = self.client.get('/logs/', {'user': self.nurse.pk})
+        self.assertEqual(len(response.context['logs']), 50)
+        self.assertIn('before=', response.context['next_query'])
+        response = self.client.get('/logs.csv', {'object_id': self.patient.pk})
+        rows = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(rows), 121)
+        self.assertTrue(rows[1].endswith(',Change 119'))
+
+    def test_audit_log_entries_are_saved_in_one_batch(self):
+        request = RequestFactory().get('/')
+        request.user = self.doctor
+        before = LogEntry.objects.count()
+        form_utilities.audit_log.begin()
+        for _ in range(10):
+            form_utilities.change(request, self.patient, "Checked in.")
+        form_utilities.deletion(request, self.patient)
+        self.assertEqual(LogEntry.objects.count(), before)
+        with self.assertNumQueries(1):
+            form_utilities.audit_log.flush()
+        self.assertEqual(LogEntry.objects.count(), before + 11)
+        self.assertEqual(form_utilities.audit_log.pending(), 0)
+
+        # Outside a request, entries are saved right away.
+        form_utilities.change(request, self.patient, "Checked out.")
+        self.assertEqual(LogEntry.objects.count(), before + 12)
+
+        prescription = Prescription.objects.create(
+            patient=self.patient, name="Tylenol", dosage="1", directions="Daily",
+            prescribed=timezone.now(), active=True)
+        self.client.login(username=self.doctor.email, password="p@ssword")
+        self.client.get('/delete_prescription/%d/' % prescription.pk)
+        self.assertEqual(form_utilities.audit_log.pending(), 0)
+        self.assertEqual(LogEntry.objects.count(), before + 13)
+
+    def test_audit_log_flush_only_saves_its_own_requests_entries(self):
+        request = RequestFactory().get('/')
+        request.user = self.doctor
+        queued = threading.Event()
+        flushed = threading.Event()
+
+        def other_request():
+            form_utilities.audit_log.begin()
+            form_utilities.change(request, self.patient, "Other request.")
+            queued.set()
+            flushed.wait(5)
+            # Drop the entry rather than saving it from another connection.
+            form_utilities.audit_log.begin()
+
+        thread = threading.Thread(target=other_request)
+        thread.start()
+        queued.wait(5)
+        form_utilities.audit_log.begin()
+        form_utilities.change(request, self.patient, "This request.")
+        form_utilities.audit_log.flush()
+        flushed.set()
+        thread.join()
+        self.assertEqual(LogEntry.objects.latest('pk').change_message,
+                         "This request.")
+        self.assertFalse(LogEntry.objects.filter(
+            change_message="Other request.").exists())
+
+    def test_failed_audit_log_flush_keeps_entries_queued(self):
+        request = RequestFactory().get('/')
+        request.user = self.doctor
+        before = LogEntry.objects.count()
+        form_utilities.audit_log.begin()
+        form_utilities.change(request, self.patient, "Checked in.")
+        form_utilities.change(request, self.patient, "Checked out.")
+        broken = form_utilities.audit_log._local.entries[-1]
+        broken.object_repr = None
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            form_utilities.audit_log.flush()
+        self.assertEqual(form_utilities.audit_log.pending(), 2)
+        self.assertEqual(LogEntry.objects.count(), before)
+
+        # The next request retries them. If they still can't be saved,
+        # the request succeeds anyway and they stay queued.
+        middleware = AuditLogMiddleware()
+        middleware.process_request(request)
+        with self.assertLogs('health.form_utilities', 'ERROR'), \
+                transaction.atomic():
+            response = middleware.process_response(request, HttpResponse())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(form_utilities.audit_log.pending(), 2)
+
+        broken.object_repr = str(self.patient)
+        middleware.process_request(request)
+        middleware.process_response(request, HttpResponse())
+        self.assertEqual(form_utilities.audit_log.pending(), 0)
+        self.assertEqual(LogEntry.objects.count(), before + 2)
+
+    def test_activity_log_records_view_events(self):
+        prescription = Prescription.objects.create(
+            patient=self.patient, name="Tylenol", dosage="1", directions="Daily",
+            prescribed=timezone.now(), active=True)
+        with self.assertLogs('health.activity') as logs:
+            self.client.post('/login/', {'email': self.doctor.email,
+                                         'password': "p@ssword"})
+            self.client.get('/delete_prescription/%d/' % prescription.pk)
+        events = [json.loads(record.getMessage()) for record in logs.records]
+        self.assertEqual([event['event'] for event in events],
+                         ['user_login_attempt', 'user_logged_in',
+                          'doc_deleted_prescription'])
+        self.assertEqual(events[2]['user_id'], self.doctor.pk)
+        self.assertEqual(events[2]['extra'], {'ID': prescription.pk})
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'activity.log')
+            with open(path + '.1', 'w') as backup:
+                backup.write(logs.records[0].getMessage() + '\n')
+            with open(path, 'w') as current:
+                for record in logs.records[1:]:
+                    current.write(record.getMessage() + '\n')
+            self.assertEqual(len(list(activitylog.read_events(path))), 3)
+            deleted = list(activitylog.read_events(
+                path, events=['doc_deleted_prescription', 'user_login_attempt'],
+                since=timezone.now() - timedelta(minutes=1)))
+            self.assertEqual([event['event'] for event in deleted],
+                             ['user_login_attempt', 'doc_deleted_prescription'])
+            self.assertEqual(list(activitylog.read_events(
+                path, until=timezone.now() - timedelta(minutes=1))), [])
+
+    def test_activity_log_is_written_to_the_configured_file(self):
+        activitylog.log('user_logged_out', self.doctor, "User Logged Out", {})
+        for handler in activitylog.logger.handlers:
+            handler.flush()
+        self.assertEqual([event['event'] for event in
+                          activitylog.read_events(self.activity_log_file)],
+                         ['user_logged_out'])
+
+    def test_activity_log_is_written_while_the_process_is_quiet(self):
+        target = logging.handlers.BufferingHandler(100)
+        handler = activitylog.TimedMemoryHandler(100, interval=0.05,
+                                                 target=target)
+        try:
+            handler.handle(logging.makeLogRecord({'msg': 'event',
+                                                 'levelno': logging.INFO}))
+            self.assertEqual(target.buffer, [])
+            deadline = time.time() + 5
+            while not target.buffer and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual([record.msg for record in target.buffer],
+                             ['event'])
+        finally:
+            handler.close()
+
+    def _book_history(self, patient, count):
+        start = timezone.now() - timedelta(days=count)
+        for i in range(count):
+            Appointment.objects.create(patient=patient, doctor=self.doctor,
+                                       date=start + timedelta(days=i), duration=30)
+            Prescription.objects.create(patient=patient, name="Tylenol", dosage="1",
+                                        directions="Daily", prescribed=timezone.now(),
+                                        active=True)
+
+    def _streamed_export(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+            body = b''.join(response.streaming_content).decode()
+        return len(queries), body
+
+    def test_exports_stream_in_a_fixed_number_of_queries(self):
+        self.client.login(username="admin", password="p@ssword")
+        url = '/users/%d/info.json' % self.patient.pk
+        self._book_history(self.patient, 1)
+        few, _ = self._streamed_export(url)
+        self._book_history(self.patient, 10)
+        many, body = self._streamed_export(url)
+        self.assertEqual(few, many)
+        exported = json.loads(body)
+        # Sent in a few large chunks rather than one per JSON token.
+        self.assertLessEqual(len(list(self.client.get(url).streaming_content)),
+                             len(body) // 8192 + 1)
+        self.assertEqual(len(exported['appointments']), 11)
+        self.assertEqual(len(exported['prescriptions']), 11)
+        self.assertEqual(exported['hospital']['name'], self.patient.hospital().name)
+
+        url = '/hospitals/%d/patients.ndjson' % self.patient.current_hospital_id
+        few, _ = self._streamed_export(url)
+        patients = Group.objects.get(name='Patient')
+        for i in range(5):
+            email = "patient%d@example.com" % i
+            patient = User.objects.create_user(email, email=email, password="p@ssword",
+                                               phone_number="0",
+                                               date_of_birth=datetime.date(1990, 1, 1))
+            patients.user_set.add(patient)
+            self.patient.current_hospital.admit(patient)
+            self._book_history(patient, 3)
+        many, body = self._streamed_export(url)
+        self.assertEqual(few, many)
+        lines = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([line['email'] for line in lines],
+                         [self.patient.email] + ["patient%d@example.com" % i for i in range(5)])
+        self.assertEqual(len(lines[0]['appointments']), 11)
+
+    def test_exportpatients_writes_shards_and_manifest(self):
+        patients = Group.objects.get(name='Patient')
+        for i in range(4):
+            email = "patient%d@example.com" % i
+            patient = User.objects.create_user(email, email=email, password="p@ssword",
+                                               phone_number="0",
+                                               date_of_birth=datetime.date(1990, 1, 1))
+            patients.user_set.add(patient)
+        with tempfile.TemporaryDirectory() as directory:
+            call_command('exportpatients', directory, workers=1, shard_size=2,
+                         stdout=StringIO())
+            with open(os.path.join(directory, 'manifest.json')) as f:
+                manifest = json.load(f)
+            self.assertEqual(manifest['count'], 5)
+            exported = []
+            for shard in manifest['shards']:
+                path = os.path.join(directory, shard['file'])
+                with open(path, 'rb') as f:
+                    self.assertEqual(hashlib.sha256(f.read()).hexdigest(), shard['sha256'])
+                with gzip.open(path, 'rt') as f:
+                    lines = [json.loads(line) for line in f]
+                self.assertEqual(len(lines), shard['count'])
+                exported.extend(line['email'] for line in lines)
+            self.assertEqual(sorted(exported), sorted(
+                User.objects.filter(role='Patient').values_list('email', flat=True)))
+
+        request = RequestFactory().get('/')
+        request.user = self.doctor
+        # Changes to insurance and emergency contacts count as changes to
+        # the patients they belong to.
+        contact = EmergencyContact.objects.create(
+            first_name="Jordan", last_name="Dorian",
+            phone_number="18005554444", relationship="Sibling")
+        User.objects.filter(pk=patient.pk).update(emergency_contact=contact)
+        form_utilities.change(request, contact, ['phone_number'])
+        form_utilities.change(request,
+                              self.patient.medical_information.insurance,
+                              ['policy_number'])
+        form_utilities.audit_log.flush()
+        with tempfile.TemporaryDirectory() as directory:
+            since = timezone.localtime(timezone.now() - timedelta(minutes=1))
+            call_command('exportpatients', directory, workers=1,
+                         since=since.strftime('%Y-%m-%d %H:%M:%S'), stdout=StringIO())
+            with open(os.path.join(directory, 'manifest.json')) as f:
+                manifest = json.load(f)
+            self.assertEqual(manifest['count'], 2)
+
+    def test_change_feed_resumes_from_a_cursor(self):
+        request = RequestFactory().get('/')
+        request.user = self.doctor
+        prescription = Prescription.objects.create(
+            patient=self.patient, name="Tylenol", dosage="1", directions="Daily",
+            prescribed=timezone.now(), active=True)
+        form_utilities.addition(request, prescription)
+        stay = HospitalStay.objects.get(patient=self.patient)
+        form_utilities.change(request, stay, ['discharge'])
+        form_utilities.addition(request, Hospital.objects.first())
+        form_utilities.deletion(request, prescription)
+        form_utilities.audit_log.flush()
+
+        self.client.login(username="admin", password="p@ssword")
+        with self.settings(CHANGE_FEED_DELAY=0):
+            first = json.loads(self.client.get('/changes.json', {'limit': 2}).content.decode())
+            rest = json.loads(self.client.get(
+                '/changes.json', {'after': first['cursor']}).content.decode())
+            done = json.loads(self.client.get(
+                '/changes.json', {'after': rest['cursor']}).content.decode())
+        self.assertEqual([(c['model'], c['action']) for c in first['changes']],
+                         [('prescription', 'addition'), ('hospitalstay', 'change')])
+        self.assertEqual(first['changes'][0]['object']['patient_id'], self.patient.pk)
+        self.assertEqual(first['changes'][1]['object']['hospital'], stay.hospital.name)
+        self.assertEqual([(c['model'], c['action'], c['object']) for c in rest['changes']],
+                         [('prescription', 'deletion', None)])
+        self.assertEqual(done, {'changes': [], 'cursor': rest['cursor']})
+        with self.settings(CHANGE_FEED_DELAY=60):
+            self.assertEqual(changefeed.changes()[0], [])
+
+    def test_change_feed_waits_for_unsettled_lower_ids(self):
+        content_type = ContentType.objects.get_for_model(User)
+        now = timezone.now()
+        first, second = [LogEntry.objects.create(
+            user=self.doctor, content_type=content_type,
+            object_id=str(self.patient.pk), object_repr="Patient",
+            action_flag=CHANGE) for _ in range(2)]
+        # The lower id was saved later than the higher one.
+        LogEntry.objects.filter(pk=first.pk).update(
+            action_time=now - timedelta(seconds=1))
+        LogEntry.objects.filter(pk=second.pk).update(
+            action_time=now - timedelta(seconds=30))
+        after = first.pk - 1
+        with self.settings(CHANGE_FEED_DELAY=5):
+            self.assertEqual(changefeed.changes(after), ([], after))
+        with self.settings(CHANGE_FEED_DELAY=0):
+            results, cursor = changefeed.changes(after)
+        self.assertEqual([change['id'] for change in results],
+                         [first.pk, second.pk])
+        self.assertEqual(cursor, second.pk)
+
+    def test_populatedb_rejects_empty_batches(self):
+        with self.assertRaisesMessage(CommandError,
+                                      '--batch-size must be at least 1.'):
+            call_command('populatedb', patients=1, batch_size=0,
+                         stdout=StringIO())
+
+    def test_populatedb_scale_mode_is_consistent(self):
+        users = User.objects.count()
+        call_command('populatedb', patients=30, doctors=3, nurses=2, hospitals=1,
+                     conversations=4, messages_per_group=5, seed=7, stdout=StringIO())
+        self.assertEqual(User.objects.count(), users + 35)
+        self.assertEqual(User.objects.filter(role='Patient').count(), 31)
+        self.assertEqual(Message.objects.count(), 20)
+        for membership in Membership.objects.all():
+            if membership.last_read_message_id:
+                message = Message.objects.get(pk=membership.last_read_message_id)
+                self.assertEqual(message.group_id, membership.group_id)
+        patient = User.objects.filter(role='Patient').last()
+        self.assertTrue(patient.check_password("p@ssword"))
+        self.assertEqual(patient.hospital(), HospitalStay.objects.get(
+            patient=patient, discharge__isnull=True).hospital)
+        out = StringIO()
+        call_command('syncroles', stdout=out)
+        self.assertIn('0 users', out.getvalue())
+        self.assertEqual(Statistics.summary(None)['message_count'], 20)
+
+    def test_instrumentation_times_requests(self):
+        instrumentation.timings.clear()
+        self.assertNotIn('Server-Timing', self.client.get('/login/'))
+        with self.settings(INSTRUMENT_REQUESTS=True):
+            client = Client()
+            client.login(username="admin", password="p@ssword")
+            with self.assertLogs('health.instrumentation') as logs:
+                response = client.get('/')
+                client.get('/')
+        self.assertIn('sql;dur=', response['Server-Timing'])
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['view'], 'health:home')
+        self.assertEqual(line['status'], 200)
+        self.assertGreater(line['queries'], 0)
+        self.assertGreater(line['template_ms'], 0)
+        self.assertLessEqual(len(line['slowest_queries']),
+                             instrumentation.SLOWEST_QUERY_COUNT)
+        instrumentation.start_request()
+        User.objects.filter(username="admin").exists()
+        queries = instrumentation.finish_request()
+        self.assertEqual(len(queries), 1)
+        self.assertIn('%s', queries[0]['sql'])
+        self.assertNotIn('admin', queries[0]['sql'])
+        self.assertTrue(line['slowest_queries'])
+        for query in line['slowest_queries']:
+            self.assertIn('ms', query)
+            self.assertNotIn('sql', query)
+        with self.settings(INSTRUMENT_REQUESTS=True, INSTRUMENT_LOG_SQL=True):
+            with self.assertLogs('health.instrumentation') as sql_logs:
+                client.get('/')
+        line = json.loads(sql_logs.records[0].getMessage())
+        self.assertTrue(all('sql' in query
+                            for query in line['slowest_queries']))
+        self.assertNotIn(client.session.session_key,
+                         sql_logs.records[0].getMessage())
+        summary = instrumentation.timings.summary()
+        self.assertEqual([(row['name'], row['count']) for row in summary],
+                         [('health:home', 3)])
+        self.assertFalse(connection.force_debug_cursor)
+        self.client.login(username="admin", password="p@ssword")
+        self.assertContains(self.client.get('/logs/'), 'health:home')
+        instrumentation.timings.clear()
+
+    def test_profiling_keeps_a_ring_of_dumps(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                self.settings(PROFILE_DIR=directory, PROFILE_KEEP=2):
+            client = Client()
+            client.login(username="turk@sacredheart.org", password="p@ssword")
+            client.get('/?profile=1')
+            self.assertEqual(profiling.summary(), [])
+
+            self.client.login(username="admin", password="p@ssword")
+            self.assertEqual(self.client.post(
+                '/profiling/', {'sample_rate': '2'}).status_code, 400)
+            self.client.post('/profiling/', {'sample_rate': '1'})
+            self.assertEqual(profiling.sample_rate(), 1.0)
+            for i in range(3):
+                client.get('/')
+            self.client.post('/profiling/', {'sample_rate': '0'})
+            client.get('/')
+            self.client.get('/users/?profile=1')
+            self.assertEqual(len(os.listdir(os.path.join(directory,
+                                                         'health.home'))), 2)
+            profiles = profiling.summary()
+            self.assertEqual([(profile['name'], profile['count'])
+                              for profile in profiles],
+                             [('health.home', 2), ('health.profiling', 1),
+                              ('health.users', 1)])
+            self.assertEqual(len(profiles[0]['functions']),
+                             profiling.TOP_FUNCTIONS)
+            self.assertContains(self.client.get('/logs/'), 'health.users')
+
+    def test_event_stream_pushes_messages_to_every_subscriber(self):
+        self._start_conversations(1)
+        group = MessageGroup.objects.get()
+        subscriptions = [pubsub.broker.subscribe(user.pk) for user in
+                         [self.patient, self.doctor, self.nurse] * 20]
+        received = []
+
+        def listen(subscription):
+            received.append((subscription.user_id, subscription.get(5),
+                             subscription.get(5)))
+
+        listeners = [threading.Thread(target=listen, args=(subscription,))
+                     for subscription in subscriptions]
+        for listener in listeners:
+            listener.start()
+        message = Message.objects.create(sender=self.doctor, group=group,
+                                         body="Results", date=timezone.now())
+        with self.assertNumQueries(2):
+            pubsub.publish_message(message)
+        for listener in listeners:
+            listener.join()
+        for subscription in subscriptions:
+            subscription.close()
+        self.assertEqual(pubsub.broker.subscriber_count(), 0)
+        self.assertEqual(len(received), 60)
+        unread = dict((user_id, second[1]['count'])
+                      for user_id, first, second in received)
+        self.assertEqual(unread, dict((user.pk, user.unread_message_count())
+                                      for user in [self.patient, self.doctor,
+                                                   self.nurse]))
+        self.assertEqual(set(first[1]['body'] for user_id, first, second
+                             in received), {"Results"})
+
+
+    def _search(self, query, page=1):
+        response = self.client.get('/messages/search/',
+                                   {'q': query, 'page': page})
+        return [(message.body, message.snippet)
+                for message in response.context['results']], \
+            response.context['has_next']
+
+    def test_message_search_is_ranked_and_scoped(self):
+        self.assertTrue(search.has_index())
+        self._start_conversations(2)
+        first, second = MessageGroup.objects.order_by('pk')
+        Message.objects.create(sender=self.doctor, group=first, date=timezone.now(),
+                               body="Your test results are in. The results look <good>.")
+        Message.objects.create(sender=self.doctor, group=second, date=timezone.now(),
+                               body="We ran one more test, and the results came back.")
+        edited = Message.objects.create(sender=self.doctor, group=second,
+                                        date=timezone.now(), body="Tylenol daily")
+        other = MessageGroup.objects.create(name="Private")
+        other.add_members([self.doctor, self.nurse])
+        Message.objects.create(sender=self.doctor, group=other, date=timezone.now(),
+                               body="Test results for someone else")
+
+        self.client.login(username=self.patient.email, password="p@ssword")
+        results, has_next = self._search("test RESULT")
+        self.assertEqual([body for body, snippet in results], [
+            "Your test results are in. The results look <good>.",
+            "We ran one more test, and the results came back."])
+        self.assertIn("<mark>results</mark> look &lt;good&gt;", results[0][1])
+        self.assertFalse(has_next)
+        self.assertEqual(self._search("tylenol")[0][0][0], "Tylenol daily")
+
+        edited.body = "Ibuprofen daily"
+        edited.save()
+        self.assertEqual(self._search("tylenol")[0], [])
+        self.assertEqual(len(self._search("ibuprofen")[0]), 1)
+        edited.delete()
+        self.assertEqual(self._search("ibuprofen")[0], [])
+        self.assertEqual(self._search('"*')[0], [])
+
+        # Other databases match every word in the newest messages first.
+        search._has_index['default'] = False
+        try:
+            results, has_next = self._search("test RESULT")
+        finally:
+            del search._has_index['default']
+        self.assertEqual([body for body, snippet in results], [
+            "We ran one more test, and the results came back.",
+            "Your test results are in. The results look <good>."])
+        self.assertIn("<mark>result</mark>s look &lt;good&gt;", results[1][1])
+
+        for i in range(search.PAGE_SIZE + 5):
+            Message.objects.create(sender=self.doctor, group=first,
+                                   date=timezone.now(), body="Follow up %d" % i)
+        results, has_next = self._search("follow")
+        self.assertEqual(len(results), search.PAGE_SIZE)
+        self.assertTrue(has_next)
+        results, has_next = self._search("follow", page=2)
+        self.assertEqual(len(results), 5)
+        self.assertFalse(has_next)
+
+    def _recipients(self, query):
+        response = self.client.get('/messages/recipients.json', {'q': query})
+        return [recipient['email'] for recipient in
+                json.loads(response.content.decode())['recipients']]
+
+    def test_recipient_search_uses_the_name_index(self):
+        self.assertEqual(set(self.nurse.search_names.values_list('name', flat=True)),
+                         {"carla", "turkleton", "carla turkleton",
+                          "carla@sacredheart.org"})
+        other = Hospital.objects.create(name="Other")
+        email = "elliot@sacredheart.org"
+        elsewhere = User.objects.create_user(
+            email, email=email, first_name="Elliot", last_name="Reid",
+            password="p@ssword", phone_number="0",
+            date_of_birth=datetime.date(1980, 1, 1))
+        Group.objects.get(name="Doctor").user_set.add(elsewhere)
+        other.admit(elsewhere)
+
+        self.client.login(username=self.patient.email, password="p@ssword")
+        self.assertEqual(self._recipients("TURK"),
+                         ["carla@sacredheart.org", "turk@sacredheart.org"])
+        self.assertEqual(self._recipients("carla t"), ["carla@sacredheart.org"])
+        self.assertEqual(self._recipients("jd@"), ["jd@sacredheart.org"])
+        self.assertEqual(self._recipients("elliot"), [])
+        self.assertEqual(self._recipients("duwayne"), [])
+        self.assertEqual(self._recipients(""), [])
+
+        nurse = User.objects.get(pk=self.nurse.pk)
+        nurse.last_name = "Espinosa"
+        nurse.save()
+        self.assertEqual(self._recipients("turk"), ["turk@sacredheart.org"])
+        self.assertEqual(self._recipients("esp"), ["carla@sacredheart.org"])
+        # The session, the user, and one query for the search.
+        with self.assertNumQueries(3):
+            self.client.get('/messages/recipients.json', {'q': "esp"})
+
+        response = self.client.post('/add_group/', {
+            'name': "Question", 'message': "Hello",
+            'recipient': [str(elsewhere.pk)]})
+        self.assertEqual(response.context['error_message'], "Could not find user.")
+        self.assertFalse(MessageGroup.objects.exists())
+
+        # Users without a hospital can't find each other.
+        User.objects.filter(pk__in=[self.patient.pk, elsewhere.pk])\
+                    .update(current_hospital=None)
+        self.assertEqual(self._recipients("elliot"), [])
+        self.assertFalse(User.objects.get(pk=self.patient.pk)
+                         .message_recipients().exists())
+
+        self.client.login(username="admin", password="p@ssword")
+        self.assertEqual(self._recipients("elliot"), [email])
+
+        SearchName.objects.all().delete()
+        call_command('syncsearchnames', stdout=StringIO())
+        self.assertEqual(self._recipients("reid"), [email])
+
+
+class AppointmentBookingTestCase(ScratchActivityLog, TransactionTestCase):
+
+    def setUp(self):
+        dob = datetime.date(year=1980, month=6, day=7)
+        self.doctor = User.objects.create_user("jd@sacredheart.org",
+                                               password=None, phone_number="18005553333",
+                                               date_of_birth=dob)
+        Group.objects.create(name="Doctor").user_set.add(self.doctor)
+        self.patients = [
+            User.objects.create_user("patient%d@example.com" % i,
+                                     password=None, phone_number="18005553333",
+                                     date_of_birth=dob)
+            for i in range(8)
+        ]
+
+    def test_concurrent_bookings_for_the_same_slot(self):
+        start = timezone.now() + timedelta(days=1)
+        results = []
+
+        def book(patient):
+            try:
+                results.append(Appointment(doctor=self.doctor, patient=patient,
+                                           date=start, duration=30).book())
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=book, args=(patient,))
+                   for patient in self.patients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), len(self.patients))
+        self.assertEqual(results.count(None), 1)
+        self.assertEqual(Appointment.objects.filter(doctor=self.doctor).count(), 1)
+
+    def test_bookings_on_separate_connections_wait_for_each_other(self):
+        """
+        Pauses the first booking between its conflict check and its write,
+        and starts a second booking for the same slot on another
+        connection meanwhile. The second must wait, then see the first.
+        """
+        start = timezone.now() + timedelta(days=1)
+        checked = threading.Event()
+        is_free = User.is_free
+        results = {}
+
+        def slow_is_free(user, *args, **kwargs):
+            free = is_free(user, *args, **kwargs)
+            if threading.current_thread().name == 'first':
+                checked.set()
+                time.sleep(0.5)
+            return free
+
+        def book(patient):
+            try:
+                results[threading.current_thread().name] = Appointment(
+                    doctor=self.doctor, patient=patient, date=start,
+                    duration=30).book()
+            finally:
+                connection.close()
+
+        User.is_free = slow_is_free
+        try:
+            first = threading.Thread(target=book, args=(self.patients[0],),
+                                     name='first')
+            second = threading.Thread(target=book, args=(self.patients[1],),
+                                      name='second')
+            first.start()
+            self.assertTrue(checked.wait(5))
+            second.start()
+            first.join()
+            second.join()
+        finally:
+            User.is_free = is_free
+        self.assertIsNone(results['first'])
+        self.assertEqual(results['second'], "The doctor is not free at that time."
+                                            " Please specify a different time.")
+        self.assertEqual(Appointment.objects.filter(doctor=self.doctor).count(), 1)
+
+
+class EventStreamTestCase(ScratchActivityLog, TransactionTestCase):
+    """
+    Reads the event stream over HTTP. Closing a streamed response closes
+    the database connection, so these tests can't run in a transaction.
+    """
+
+    def setUp(self):
+        dob = datetime.date(year=1980, month=6, day=7)
+        Group.objects.create(name="Doctor")
+        Group.objects.create(name="Patient")
+        self.doctor = User.objects.create_user("jd@sacredheart.org",
+                                               password="p@ssword", phone_number="0",
+                                               date_of_birth=dob)
+        self.patient = User.objects.create_user("duwayne@theroc-johnson.com",
+                                                password="p@ssword", phone_number="0",
+                                                date_of_birth=dob)
+        self.group = MessageGroup.objects.create(name="Results")
+        self.group.add_members([self.doctor, self.patient])
+        Message.objects.create(sender=self.doctor, group=self.group, body="Hello",
+                               date=timezone.now())
+
+    def test_stream_sends_unread_counts_and_messages(self):
+        with self.settings(EVENT_STREAM_MAX_CONNECTIONS=1,
+                           EVENT_STREAM_HEARTBEAT=0.05):
+            self.client.login(username=self.patient.username, password="p@ssword")
+            response = self.client.get('/events/')
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            self.assertEqual(self.client.get('/events/').status_code, 503)
+            events = iter(response.streaming_content)
+            self.assertEqual(next(events), b'retry: 50\n\n')
+            self.assertEqual(next(events),
+                             b'event: unread\ndata: {"count": 1}\n\n')
+            self.assertEqual(next(events), b': heartbeat\n\n')
+            self.client.post('/messages/%d/' % self.group.pk, {'message': "Thanks"})
+            self.assertTrue(next(events).startswith(b'event: message\n'))
+            self.assertEqual(next(events),
+                             b'event: unread\ndata: {"count": 0}\n\n')
+            response.close()
+        self.assertEqual(pubsub.broker.subscriber_count(), 0)
+
+    def test_reading_a_conversation_publishes_the_unread_count(self):
+        subscription = pubsub.broker.subscribe(self.patient.pk)
+        try:
+            self.client.login(username=self.patient.username, password="p@ssword")
+            self.client.get('/messages/%d/' % self.group.pk)
+            self.assertEqual(subscription.get(1), ('unread', {'count': 0}))
+            self.client.get('/messages/%d/' % self.group.pk)
+            Message.objects.create(sender=self.doctor, group=self.group,
+                                   body="Results", date=timezone.now())
+            self.client.get('/messages/%d/updates.json' % self.group.pk,
+                            {'after': '0'})
+            self.assertEqual(subscription.get(1), ('unread', {'count': 0}))
+            self.assertTrue(subscription.queue.empty())
+        finally:
+            subscription.close()
@@ -11,19 +11,29 @@ urlpatterns = patterns('',
     url(r'prescriptions/?$', views.prescriptions, name='prescriptions'),
     url(r'messages/?$', views.messages, name='messages'),
     url(r'messages/(\d+)/?$', views.conversation, name='conversation'),
+    url(r'events/?$', views.events, name='events'),
+    url(r'messages/recipients.json/?$', views.recipients, name='recipients'),
+    url(r'messages/search/?$', views.search_messages, name='search_messages'),
+    url(r'messages/(\d+)/updates.json/?$', views.conversation_updates,
+        name='conversation_updates'),
     url(r'delete_prescription/(\d+)/?$', views.delete_prescription, name='delete_prescription'),
     url(r'edit_prescription/(\d+)?/?$', views.prescription_form, name='edit_prescription'),
     url(r'add_prescription/?$', views.add_prescription_form, name='add_prescription'),
     url(r'delete_appointment/(\d+)/?$', views.delete_appointment, name='delete_appointment'),
     url(r'edit_appointment/(\d+)?/?$', views.appointment_form, name='edit_appointment'),
     url(r'add_appointment/?$', views.add_appointment_form, name='add_appointment'),
+    url(r'appointments/free.json/?$', views.free_slots, name='free_slots'),
     url(r'add_group/?$', views.add_group, name='add_group'),
     url(r'users/(\d+)/?$', views.medical_information, name='medical_information'),
     url(r'users/me/?$', views.my_medical_information, name='my_medical_information'),
     url(r'signup/?$', views.signup, name='signup'),
     url(r'users/(\d+)/info.json/?$', views.export, name='export'),
     url(r'users/me/info.json/?$', views.export_me, name='export_me'),
+    url(r'hospitals/(\d+)/patients.ndjson/?$', views.export_hospital, name='export_hospital'),
     url(r'users/?$', views.users, name='users'),
     url(r'logs/?$', views.logs, name='logs'),
+    url(r'logs.csv/?$', views.logs_csv, name='logs_csv'),
+    url(r'profiling/?$', views.set_profile_sample_rate, name='profiling'),
+    url(r'changes.json/?$', views.changes, name='changes'),
     url(r'^/?$', views.home, name='home'),
 )
\ No newline at end of file
@@ -1,18 +1,50 @@
+from django.conf import settings
 from django.shortcuts import render, redirect, get_object_or_404
-from django.utils import dateparse
 from django.core.exceptions import PermissionDenied
-from django.contrib.admin.models import LogEntry
 from django.contrib.auth import logout, login, authenticate
 from django.contrib.auth.decorators import login_required, user_passes_test
-from django.http import HttpResponse
-from django.db.models import Max
+from django.contrib.contenttypes.models import ContentType
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.http import StreamingHttpResponse
 from . import form_utilities
 from .form_utilities import *
+from . import auditlog
+from . import changefeed
 from . import checks
+from . import instrumentation
+from . import profiling
+from . import pubsub
+from . import search
+from . import signals
 from .models import *
 import datetime
 import json
-import time
+
+# The number of messages rendered at a time in a conversation.
+CONVERSATION_PAGE_SIZE = 50
+
+# The most users suggested for a recipient search.
+RECIPIENT_SEARCH_LIMIT = 10
+
+# How often an open conversation checks for new messages, in seconds.
+CONVERSATION_POLL_INTERVAL = 5
+
+# How often it checks while the event stream is open. The stream only
+# announces messages sent through the same server process, so this picks
+# up the ones sent through the others.
+CONVERSATION_STREAM_POLL_INTERVAL = 60
+
+# The longest range of time the free slot finder will search.
+MAX_FREE_SLOT_RANGE = datetime.timedelta(days=31)
+
+# The most free slots listed at once, earliest first.
+MAX_FREE_SLOTS = 100
+
+# The number of patients loaded at a time while exporting a hospital.
+EXPORT_BATCH_SIZE = 200
+
+# Exports are streamed in pieces of about this many characters.
+EXPORT_CHUNK_SIZE = 8192
 
 
 def login_view(request):
@@ -56,6 +88,8 @@ def login_user_from_form(request, body):
         return None, "You must provide an email and password."
     email = email.lower()  # all emails are lowercase in the database.
     user = authenticate(username=email, password=password)
+    signals.user_login_attempt.send(sender=User, username=email,
+                                    result=user is not None)
     remember = body.get("remember")
     if user is None:
         return None, "Invalid username or password."
@@ -103,6 +137,9 @@ def handle_prescription_form(request, body, prescription=None):
             prescription.patient = patient
         prescription.save()
         change(request, prescription, changed_fields)
+        signals.doc_edits_prescription.send(sender=Prescription,
+                                            user=request.user,
+                                            id=prescription.pk)
     else:
         prescription = Prescription.objects.create(name=name, dosage=dosage,
                                         patient=patient, directions=directions,
@@ -111,6 +148,9 @@ def handle_prescription_form(request, body, prescription=None):
         if not prescription:
             return None, "We could not create that prescription. Please try again."
         addition(request, prescription)
+        signals.doc_adds_prescription.send(sender=Prescription,
+                                           user=request.user,
+                                           id=prescription.pk)
     return prescription, None
 
 
@@ -125,7 +165,7 @@ def prescriptions(request, error=None):
     context = {
         "navbar":"prescriptions",
         "logged_in_user": request.user,
-        "prescriptions": request.user.prescription_set.filter(active=True).all()
+        "patients": request.user.active_patients_with_prescriptions()
     }
     if error:
         context["error_message"] = error
@@ -155,9 +195,10 @@ def prescription_form(request, prescription_id):
 
 def delete_prescription(request, prescription_id):
     p = get_object_or_404(Prescription, pk=prescription_id)
-    p.active = False
-    p.save()
+    p.deactivate()
     deletion(request, p, repr(p))
+    signals.doc_deleted_prescription.send(sender=Prescription,
+                                          user=request.user, id=p.pk)
     return redirect('health:prescriptions')
 
 
@@ -174,8 +215,14 @@ def signup(request):
     context['is_signup'] = True
     if request.POST:
         user, message = handle_user_form(request, request.POST)
+        signals.user_sign_up_attempt.send(sender=User,
+                                          username=request.POST.get('email'),
+                                          email=request.POST.get('email'),
+                                          result=user is not None)
         if user:
             addition(request, user)
+            signals.user_signed_up.send(sender=User, user=user, id=user.pk,
+                                        email=user.email)
             if request.user.is_authenticated():
                 return redirect('health:signup')
             else:
@@ -226,20 +273,18 @@ def handle_add_group_form(request, body):
         return None, "All fields are required."
     if not [r for r in recipient_ids if r.isdigit()]:
         return None, "Invalid recipient."
+    ids = [int(r) for r in recipient_ids if r.isdigit()]
+    recipients = request.user.message_recipients().filter(pk__in=ids)
+    if len(recipients) != len(set(ids)):
+        return None, "Could not find user."
     group = MessageGroup.objects.create(
         name=name
     )
-    try:
-        ids = [int(r) for r in recipient_ids]
-        recipients = User.objects.filter(pk__in=ids)
-    except User.DoesNotExist:
-        return None, "Could not find user."
-    group.members.add(request.user)
-    for r in recipients:
-        group.members.add(r)
-    group.save()
-    Message.objects.create(sender=request.user, body=message,
-                           group=group, date=timezone.now())
+    group.add_members([request.user] + list(recipients))
+    message = Message.objects.create(sender=request.user, body=message,
+                                     group=group, date=timezone.now())
+    group.mark_read(request.user)
+    pubsub.publish_message(message)
     return group, None
 
 @login_required
@@ -281,6 +326,13 @@ def medical_information(request, user_id):
     if request.POST:
         user, message = handle_user_form(request, request.POST, user=requested_user)
         if user:
+            if is_editing_own_medical_information:
+                signals.user_edit_profile.send(sender=User, user=request.user,
+                                               id=user.pk)
+            else:
+                signals.edits_patient_profile.send(sender=User,
+                                                   user=request.user,
+                                                   id=user.pk)
             return redirect('health:medical_information', user.pk)
         elif message:
             context['error_message'] = message
@@ -355,6 +407,8 @@ def handle_user_form(request, body, user=None):
                 user.medical_information.insurance.policy_number = policy
                 user.medical_information.insurance.company = company
                 user.medical_information.insurance.save()
+                change(request, user.medical_information.insurance,
+                       ['policy_number', 'company'])
             else:
                 user.medical_information.insurance = Insurance.objects.create(
                     policy_number=policy,
@@ -375,17 +429,25 @@ def handle_user_form(request, body, user=None):
             )
             addition(request, user.medical_information)
             user.medical_information = medical_information
-        if (hospital and
-            not HospitalStay.objects.filter(patient=user, hospital=hospital,
-                                           discharge__isnull=True).exists()):
-            hospital.admit(user)
+        if hospital and user.current_hospital_id != hospital.pk:
+            ended = list(HospitalStay.objects.filter(patient=user,
+                                                     discharge__isnull=True))
+            stay = hospital.admit(user)
+            for ended_stay in ended:
+                change(request, ended_stay, ['discharge'])
+                signals.doc_discharges_patient.send(sender=User,
+                                                    user=request.user,
+                                                    id=user.pk)
+            addition(request, stay)
+            signals.hospital_transferred_patient.send(sender=User,
+                                                      user=request.user,
+                                                      id=user.pk,
+                                                      hospital=hospital.pk)
         if user.is_superuser:
             if not user.groups.filter(pk=group.pk).exists():
-                for user_group in user.groups.all():
-                    user_group.user_set.remove(user)
-                    user_group.save()
-                group.user_set.add(user)
-                group.save()
+                user.groups.clear()
+                user.groups.add(group)
+                user.invalidate_cached('group_names')
         user.save()
         change(request, user, 'Changed fields.')
         return user, None
@@ -408,37 +470,46 @@ def handle_user_form(request, body, user=None):
             medical_information=medical_information)
         if user is None:
             return None, "We could not create that user. Please try again."
-        hospital.admit(user)
+        stay = hospital.admit(user) if hospital else None
         request.user = user
         addition(request, user)
         addition(request, medical_information)
         addition(request, insurance)
-        group.user_set.add(user)
+        if stay:
+            addition(request, stay)
+        user.groups.add(group)
         return user, None
 
 @login_required
 def messages(request, error=None):
-    other_groups = ['Patient', 'Doctor', 'Nurse']
-    if not request.user.is_superuser:
-        other_groups.remove(request.user.groups.first().name)
-    recipients = (User.objects.filter(groups__name__in=other_groups))
-    message_groups = request.user.messagegroup_set\
-                            .annotate(max_date=Max('messages__date'))\
-                            .order_by('-max_date').all()
-    for group in message_groups:
-        for message in group.messages.all():
-            if request.user not in message.read_members.all():
-                group.has_unread = True
-                break
     context = {
         'navbar': 'messages',
         'user': request.user,
-        'recipients': recipients,
-        'groups': message_groups,
+        'groups': request.user.inbox(),
         'error_message': error
     }
     return render(request, 'messages.html', context)
 
+@login_required
+def search_messages(request):
+    """
+    Searches the messages in the user's conversations for the words in
+    `q`, a page at a time.
+    """
+    query = request.GET.get('q', '')
+    page = request.GET.get('page', '1')
+    page = int(page) if page.isdigit() and int(page) > 0 else 1
+    results, has_next = search.search(request.user, query, page)
+    context = {
+        'navbar': 'messages',
+        'user': request.user,
+        'query': query,
+        'results': results,
+        'page': page,
+        'has_next': has_next
+    }
+    return render(request, 'search.html', context)
+
 def users(request):
 
     hospital = request.user.hospital()
@@ -453,14 +524,24 @@ def users(request):
     }
     return render(request, 'users.html', context)
 
+@login_required
+def recipients(request):
+    """
+    Returns the message recipients whose name or email starts with `q` as
+    JSON, for the recipient field of the Send Message form.
+    """
+    users = request.user.find_recipients(request.GET.get('q', ''),
+                                         limit=RECIPIENT_SEARCH_LIMIT)
+    return HttpResponse(json.dumps({'recipients': [{
+        'id': user.pk,
+        'name': user.get_full_name(),
+        'email': user.email,
+        'role': user.role,
+    } for user in users]}), content_type='application/json')
+
 @login_required
 def conversation(request, id):
     group = get_object_or_404(MessageGroup, pk=id)
-    context = {
-        "user": request.user,
-        "group": group,
-        "message_names": group.combined_names(full=True)
-    }
     if request.POST:
         message = request.POST.get('message')
         if message:
@@ -468,16 +549,78 @@ def conversation(request, id):
                                          body=message, date=timezone.now())
             group.messages.add(msg)
             group.save()
+            # The sender has read everything up to their own message.
+            group.mark_read(request.user)
+            pubsub.publish_message(msg)
             # redirect to avoid the issues with reloading
             # sending the message again.
             return redirect('health:conversation', group.pk)
-    for message in group.messages.all():
-        if request.user not in message.read_members.all():
-            message.read_members.add(request.user)
-            message.save()
-
+    before = request.GET.get('before')
+    before = int(before) if before and before.isdigit() else None
+    messages, has_older = group.message_window(
+        before=before, count=CONVERSATION_PAGE_SIZE)
+    if group.mark_read(request.user):
+        request.user.invalidate_cached('unread_message_count')
+        pubsub.publish_unread(request.user.pk)
+    context = {
+        "user": request.user,
+        "group": group,
+        "message_names": group.combined_names(full=True),
+        "messages": messages,
+        "has_older": has_older,
+        # Only the newest window follows new messages. An older window
+        # ends before them, so polling it would append the rest of the
+        # thread below it.
+        "poll": before is None,
+        "cursor": messages[-1].pk if messages else 0,
+        "poll_interval": CONVERSATION_POLL_INTERVAL,
+        "stream_poll_interval": CONVERSATION_STREAM_POLL_INTERVAL
+    }
     return render(request, 'conversation.html', context)
 
+@login_required
+def events(request):
+    """
+    Streams new messages and the user's unread count as Server-Sent
+    Events. Each process holds at most EVENT_STREAM_MAX_CONNECTIONS
+    streams open, and responds 503 when it's full.
+    """
+    subscription = pubsub.broker.subscribe(request.user.pk)
+    if subscription is None:
+        response = HttpResponse("Too many connections.", status=503)
+        response['Retry-After'] = str(settings.EVENT_STREAM_HEARTBEAT)
+        return response
+    stream = pubsub.EventStream(subscription, initial=[
+        ('unread', {'count': request.user.unread_message_count()})])
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@login_required
+def conversation_updates(request, id):
+    """
+    Returns the messages in a conversation after the `after` message id as
+    JSON, and marks them read. Open conversations poll this with the
+    returned cursor instead of reloading the page.
+    """
+    group = get_object_or_404(MessageGroup, pk=id,
+                              membership__user=request.user)
+    after = request.GET.get('after', '0')
+    if not after.isdigit():
+        return HttpResponseBadRequest("Invalid cursor.")
+    messages, has_more = group.messages_after(
+        int(after), count=CONVERSATION_PAGE_SIZE)
+    if messages and group.mark_read(request.user):
+        request.user.invalidate_cached('unread_message_count')
+        pubsub.publish_unread(request.user.pk)
+    cursor = messages[-1].pk if messages else int(after)
+    return HttpResponse(json.dumps({
+        'messages': [message.json_object() for message in messages],
+        'cursor': cursor,
+        'has_more': has_more,
+    }), content_type='application/json')
+
 
 def handle_appointment_form(request, body, user, appointment=None):
     """
@@ -487,13 +630,8 @@ def handle_appointment_form(request, body, user, appointment=None):
     :param user: The user intending to create the appointment.
     :return: A tuple containing either a valid appointment or failure message.
     """
-    date_string = body.get("date")
-    try:
-        parsed = dateparse.parse_datetime(date_string)
-        if not parsed:
-            return None, "Invalid date or time."
-        parsed = timezone.make_aware(parsed, timezone.get_current_timezone())
-    except:
+    parsed = parse_local_datetime(body.get("date"))
+    if not parsed:
         return None, "Invalid date or time."
     duration = int(body.get("duration"))
     doctor_id = int(body.get("doctor", user.pk))
@@ -513,23 +651,27 @@ def handle_appointment_form(request, body, user, appointment=None):
             changed.append('duration')
         if appointment.doctor != doctor:
             changed.append('doctor')
-        appointment.delete()
-    if not doctor.is_free(parsed, duration):
-        return None, "The doctor is not free at that time." +\
-                     " Please specify a different time."
-
-    if not patient.is_free(parsed, duration):
-        return None, "The patient is not free at that time." +\
-                     " Please specify a different time."
-    appointment = Appointment.objects.create(date=parsed, duration=duration,
-                                             doctor=doctor, patient=patient)
+    else:
+        appointment = Appointment()
+    appointment.date = parsed
+    appointment.duration = duration
+    appointment.doctor = doctor
+    appointment.patient = patient
+
+    # Edits happen in place, so if the new time is taken the original
+    # appointment is left untouched.
+    message = appointment.book()
+    if message:
+        return None, message
 
     if is_change:
         change(request, appointment, changed)
+        signals.edits_appointment.send(sender=Appointment, user=request.user,
+                                       id=appointment.pk)
     else:
         addition(request, appointment)
-    if not appointment:
-        return None, "We could not create the appointment. Please try again."
+        signals.add_appointment.send(sender=Appointment, user=request.user,
+                                     id=appointment.pk)
     return appointment, None
 
 @login_required
@@ -567,9 +709,11 @@ def schedule(request, error=None):
         "doctors": hospital.users_in_group('Doctor'),
         "patients": hospital.users_in_group('Patient'),
         "schedule_future": request.user.schedule()
+                                       .select_related('patient', 'doctor')
                                        .filter(date__gte=now)
                                        .order_by('date'),
         "schedule_past": request.user.schedule()
+                                     .select_related('patient', 'doctor')
                                      .filter(date__lt=now)
                                      .order_by('-date')
     }
@@ -584,52 +728,139 @@ def add_appointment_form(request):
 @login_required
 def delete_appointment(request, appointment_id):
     a = get_object_or_404(Appointment, pk=appointment_id)
+    appointment_id = a.pk
+    deletion(request, a, repr(a))
     a.delete()
+    signals.deleted_appointment.send(sender=Appointment, user=request.user,
+                                     id=appointment_id)
     return redirect('health:schedule')
 
+@login_required
+def free_slots(request):
+    """
+    Lists the times at which a doctor, and optionally a patient, could be
+    booked for an appointment.
+    Accepts the query parameters:
+        doctor: The doctor's id.
+        patient: The patient's id (optional). Only the patient, and admins
+                 and staff at the patient's hospital, may check them.
+        start: The beginning of the search, in the site's timezone.
+        end: The end of the search (optional, defaults to a week later).
+        duration: The length of the appointment in minutes (default 30).
+    :return: A JSON list of up to MAX_FREE_SLOTS objects with 'start' and
+             'end' keys, earliest first.
+    """
+    doctor_id = request.GET.get('doctor', '')
+    patient_id = request.GET.get('patient', '')
+    duration = request.GET.get('duration', '30')
+    if not doctor_id.isdigit() or not duration.isdigit() or \
+            (patient_id and not patient_id.isdigit()):
+        return HttpResponseBadRequest("Invalid doctor, patient or duration.")
+    doctor = get_object_or_404(User, pk=int(doctor_id))
+    patient = get_object_or_404(User, pk=int(patient_id)) if patient_id else None
+    # Anyone can look for an opening with a doctor, but nobody else's
+    # schedule is visible to people who couldn't already see it.
+    for user in [doctor, patient]:
+        if user is not None and not user.is_doctor() and \
+                not request.user.can_view_schedule(user):
+            raise PermissionDenied
+    duration = int(duration)
+    start = parse_local_datetime(request.GET.get('start'))
+    end = parse_local_datetime(request.GET.get('end'))
+    if start and not request.GET.get('end'):
+        end = start + datetime.timedelta(days=7)
+    if not start or not end or duration == 0:
+        return HttpResponseBadRequest("Invalid date range.")
+    if end - start > MAX_FREE_SLOT_RANGE:
+        return HttpResponseBadRequest("Date range is too long.")
+    slots = [{
+        'start': timezone.localtime(slot_start).isoformat(),
+        'end': timezone.localtime(slot_end).isoformat()
+    } for slot_start, slot_end in doctor.free_slots(start, end, duration,
+                                                    other=patient,
+                                                    limit=MAX_FREE_SLOTS)]
+    return HttpResponse(json.dumps(slots), content_type='application/json')
+
 
 @login_required
 @user_passes_test(checks.admin_check)
 def logs(request):
-    group_count = MessageGroup.objects.count()
-    average_count = 0
-    message_count = Message.objects.count()
-    hospital = request.user.hospital()
-    if group_count > 0 and message_count > 0:
-        average_count = float(message_count) / float(group_count)
-    stays = HospitalStay.objects.filter(discharge__isnull=False)
-    average_stay = 0.0
-    if stays:
-        for stay in stays:
-            average_stay += float((stay.discharge - stay.admission).total_seconds())
-        average_stay /= len(stays)
-    average_stay_formatted = time.strftime('%H:%M:%S', time.gmtime(average_stay))
+    """
+    Renders the System page: statistics for the admin's hospital and one
+    page of the audit log, filtered by the query parameters accepted by
+    auditlog.filtered_entries.
+    """
+    entries = auditlog.filtered_entries(request.GET)
+    page, next_cursor = auditlog.page(entries, request.GET.get('before'))
+    next_query = None
+    if next_cursor:
+        next_query = request.GET.copy()
+        next_query['before'] = next_cursor
+        next_query = next_query.urlencode()
+    filters = request.GET.copy()
+    filters.pop('before', None)
     context = {
         "navbar": "logs",
         "user": request.user,
-        "logs": LogEntry.objects.all().order_by('-action_time'),
-        "stats": {
-            "user_count": HospitalStay.objects.filter(hospital=hospital, discharge__isnull=True).count(),
-            "stay_count": HospitalStay.objects.filter(hospital=hospital).count(),
-            "discharge_count": HospitalStay.objects.filter(hospital=hospital, discharge__isnull=False).count(),
-            "average_stay": average_stay_formatted,
-            "patient_count": HospitalStay.objects.filter(hospital=hospital, patient__groups__name='Patient').distinct().count(),
-            "doctor_count": HospitalStay.objects.filter(hospital=hospital, patient__groups__name='Doctor').distinct().count(),
-            "nurse_count": HospitalStay.objects.filter(hospital=hospital, patient__groups__name='Nurse').distinct().count(),
-            "admin_count": User.objects.filter(is_superuser=True).count(),
-            "prescription_count": Prescription.objects.count(),
-            "active_prescription_count": Prescription.objects.filter(active=True).count(),
-            "expired_prescription_count": Prescription.objects.filter(active=False).count(),
-            "appointment_count": Appointment.objects.count(),
-            "upcoming_appointment_count": Appointment.objects.filter(date__gte=timezone.now()).count(),
-            "past_appointment_count": Appointment.objects.filter(date__lt=timezone.now()).count(),
-            "conversation_count": group_count,
-            "average_message_count": average_count,
-            "message_count": message_count
-        }
+        "logs": page,
+        "next_query": next_query,
+        "filters": filters,
+        "filter_query": filters.urlencode(),
+        "content_types": ContentType.objects.filter(app_label='health')
+                                            .order_by('model'),
+        "stats": Statistics.summary(request.user.hospital()),
+        "timings": instrumentation.timings.summary(),
+        "profile_sample_rate": profiling.sample_rate(),
+        "profiles": profiling.summary()
     }
     return render(request, 'logs.html', context)
 
+@login_required
+@user_passes_test(checks.admin_check)
+def set_profile_sample_rate(request):
+    """
+    Sets the fraction of requests profiled, from 0 (off) to 1, from the
+    form on the System page.
+    """
+    try:
+        rate = float(request.POST.get('sample_rate', ''))
+    except ValueError:
+        return HttpResponseBadRequest("Invalid sample rate.")
+    if not 0 <= rate <= 1:
+        return HttpResponseBadRequest("Invalid sample rate.")
+    profiling.set_sample_rate(rate)
+    return redirect('health:logs')
+
+@login_required
+@user_passes_test(checks.admin_check)
+def logs_csv(request):
+    """
+    Streams every audit log entry matching the System page's filters as
+    CSV, a batch at a time, so exports of any size use constant memory.
+    """
+    entries = auditlog.filtered_entries(request.GET)
+    response = StreamingHttpResponse(auditlog.csv_rows(entries),
+                                     content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="logs.csv"'
+    return response
+
+@login_required
+@user_passes_test(checks.admin_check)
+def changes(request):
+    """
+    Returns the changes to users, appointments, prescriptions and hospital
+    stays after the `after` cursor, as JSON. Consumers pass the returned
+    cursor back to read the next changes.
+    """
+    after = request.GET.get('after', '0')
+    limit = request.GET.get('limit', str(changefeed.MAX_LIMIT))
+    if not after.isdigit() or not limit.isdigit() or int(limit) < 1:
+        return HttpResponseBadRequest("Invalid cursor or limit.")
+    results, cursor = changefeed.changes(
+        int(after), min(int(limit), changefeed.MAX_LIMIT))
+    return HttpResponse(json.dumps({'changes': results, 'cursor': cursor}),
+                        content_type='application/json')
+
 @login_required
 def home(request):
     context = {
@@ -645,10 +876,61 @@ def export_me(request):
 
 @login_required
 def export(request, id):
-    user = get_object_or_404(User, pk=id)
+    user = get_object_or_404(User.with_export_data(User.objects), pk=id)
     if user != request.user and not request.user.is_superuser:
         raise PermissionDenied
-    json_object = json.dumps(user.json_object(), sort_keys=True,
-        indent=4, separators=(',', ': '))
-    return HttpResponse(json_object,
+    signals.exports_patient_information.send(sender=User, user=request.user,
+                                             id=user.pk)
+    encoder = json.JSONEncoder(sort_keys=True, indent=4,
+                               separators=(',', ': '))
+    return StreamingHttpResponse(
+        chunked(encoder.iterencode(user.json_object())),
         content_type='application/force-download')
+
+
+def chunked(pieces, size=EXPORT_CHUNK_SIZE):
+    """
+    Joins an iterable of strings into chunks of at least `size` characters,
+    except the last, so a stream of small pieces isn't written one at a
+    time.
+    """
+    buffered = []
+    length = 0
+    for piece in pieces:
+        buffered.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(buffered)
+            buffered = []
+            length = 0
+    if buffered:
+        yield ''.join(buffered)
+
+
+def export_lines(users, exporter, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields each user's json_object as a line of JSON, loading the users
+    `batch_size` at a time so only one batch is ever held in memory.
+    :param users: A User queryset.
+    :param exporter: The user downloading the export.
+    """
+    for user in User.iterate_for_export(users, batch_size):
+        signals.exports_patient_information.send(sender=User, user=exporter,
+                                                 id=user.pk)
+        yield json.dumps(user.json_object(), sort_keys=True) + '\n'
+
+@login_required
+@user_passes_test(checks.admin_check)
+def export_hospital(request, id):
+    """
+    Streams every patient currently staying at a hospital as
+    newline-delimited JSON, one patient per line.
+    """
+    hospital = get_object_or_404(Hospital, pk=id)
+    response = StreamingHttpResponse(
+        chunked(export_lines(hospital.current_users.filter(role='Patient'),
+                             request.user)),
+        content_type='application/x-ndjson')
+    response['Content-Disposition'] = \
+        'attachment; filename="hospital-%d-patients.ndjson"' % hospital.pk
+    return response